@@ -0,0 +1,75 @@
+#
+# Precompile the primer schemes listed in the manifest into a catalog.
+#
+# Usage: compile-primer-catalog.pl module-dir
+#
+# module-dir is lib/Bio/P3/SARS2Assembly, holding primer_schemes/ with its
+# bvbrc_manifest.json. For each scheme we write the ivar-format primer BED
+# that sars2-onecodex used to generate on every run, and an index,
+# primer_catalog/index.tsv, with one line per scheme:
+#
+#	primer-name path version reference-fasta ivar-bed source-bed latest
+#
+# The file paths are relative to module-dir, and latest is 1 for the
+# version used when none is requested. sars2-onecodex reads the index
+# instead of decoding the manifest.
+#
+
+use strict;
+use JSON::XS;
+use File::Slurp;
+use File::Path 'make_path';
+
+@ARGV == 1 or die "Usage: $0 module-dir\n";
+
+my $module_dir = shift;
+
+my $manifest_file = "$module_dir/primer_schemes/bvbrc_manifest.json";
+my $manifest = decode_json(scalar read_file($manifest_file));
+
+my @orgs = @{$manifest->{organisms}};
+my($org) = grep { $_->{name} eq "SARS-CoV-2" } @orgs;
+$org //= $orgs[0];
+my $primers = $org->{primers};
+
+my $catalog = "primer_catalog";
+make_path("$module_dir/$catalog");
+
+my $index = "$module_dir/$catalog/index.tsv";
+open(IDX, ">", "$index.tmp") or die "Cannot write $index.tmp: $!";
+
+for my $name (sort keys %$primers)
+{
+    my $primer = $primers->{$name};
+    my $schemes = $primer->{schemes};
+    for my $i (0 .. $#$schemes)
+    {
+	my $scheme = $schemes->[$i];
+	my $vers = $scheme->{version};
+	my $dir = "primer_schemes/$primer->{path}/$vers";
+	my $reference = "$dir/$scheme->{reference}";
+	my $bed = "$dir/$scheme->{primers}";
+
+	-f "$module_dir/$reference" or die "Missing reference $reference for $name $vers\n";
+
+	make_path("$module_dir/$catalog/$primer->{path}");
+	my $ivar_bed = "$catalog/$primer->{path}/$vers.primer.bed";
+
+	open(BED_IN, "<", "$module_dir/$bed") or die "Cannot open $module_dir/$bed: $!";
+	open(BED_OUT, ">", "$module_dir/$ivar_bed") or die "Cannot open $module_dir/$ivar_bed: $!";
+	while (<BED_IN>)
+	{
+	    chomp;
+	    my @x = split m/\t/;
+	    print BED_OUT join("\t", @x[0..3], 60, $x[3]=~m/LEFT|(F$)/ ? "+" : "-") . "\n";
+	}
+	close(BED_IN);
+	close(BED_OUT);
+
+	my $latest = $i == $#$schemes ? 1 : 0;
+	print IDX join("\t", $name, $primer->{path}, $vers, $reference, $ivar_bed, $bed, $latest), "\n";
+	print "$name $vers: $ivar_bed\n";
+    }
+}
+close(IDX);
+rename("$index.tmp", $index) or die "Cannot rename $index.tmp to $index: $!";
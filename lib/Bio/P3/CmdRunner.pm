@@ -16,6 +16,10 @@ use File::Which;
 use File::Basename;
 use Digest::MD5 'md5_hex';
 use Cwd;
+use Symbol 'gensym';
+use Fcntl qw(F_GETFD F_SETFD FD_CLOEXEC);
+
+our $StreamBufferSize = 4 * 1024 * 1024;
 
 sub new
 {
@@ -23,6 +27,7 @@ sub new
     my $self = {
 	commands => {},
 	log => [],
+	streams => [],
     };
 
     return bless $self, $class;
@@ -109,6 +114,171 @@ sub run_with_timeout
     }
 }
 
+#
+# Run a producer command with its standard output streamed directly into
+# the standard input of a consumer pipeline, rather than through an
+# intermediate file.
+#
+# $label names the stream in the report. If $timeout is set, the whole
+# pipeline is killed and we die if it has not finished after that many
+# seconds. $producer is a command list; @consumer is an IPC::Run pipeline
+# specification.
+#
+
+sub run_streamed
+{
+    my($self, $label, $timeout, $producer, @consumer) = @_;
+    return $self->run_fanout($label, $timeout, $producer, \@consumer);
+}
+
+#
+# Run a producer command and stream its standard output to each of a set of
+# consumer pipelines at once, tee-style. Each consumer is an arrayref holding
+# an IPC::Run pipeline specification; the stream is attached to the standard
+# input of its first command.
+#
+# The data passes through this process so that we can count the bytes;
+# that count is the size of the intermediate file we would otherwise
+# have written once and read back once per consumer. We record it along
+# with the time at which the producer finished so the report can show what
+# the streaming saved.
+#
+# The consumers are fed in lockstep, so the slowest one sets the pace.
+# Unlike run_with_timeout we cannot rerun a stream that timed out, since
+# its input is gone, so a timeout is fatal.
+#
+
+sub run_fanout
+{
+    my($self, $label, $timeout, $producer, @consumers) = @_;
+
+    my($prod_h, $from) = $self->start_producer($producer);
+    return $self->pump_fanout($label, $timeout, $prod_h, $from, '', $producer, @consumers);
+}
+
+#
+# Start a producer command with its standard output on a pipe, for
+# callers that need to look at the start of the stream (with sysread)
+# before deciding how to consume it. Hand the harness and handle, along
+# with whatever was already read, to pump_fanout.
+#
+
+sub start_producer
+{
+    my($self, $producer) = @_;
+
+    my $from = gensym;
+    my $prod_h = IPC::Run::start($producer, '>pipe', $from);
+    _set_cloexec($from);
+    return($prod_h, $from);
+}
+
+sub pump_fanout
+{
+    my($self, $label, $timeout, $prod_h, $from, $head, $producer, @consumers) = @_;
+
+    print STDERR "Execute streamed $label" . ($timeout ? " with timeout=$timeout" : "") . ":\n";
+    my $logged = $self->make_command_log([$producer, map { ('|', @$_) } @consumers]);
+
+    local $SIG{PIPE} = 'IGNORE';
+
+    my $start = gettimeofday;
+
+    my @sinks;
+    my $bytes = 0;
+    my $prod_end;
+    my $ok = eval {
+	local $SIG{ALRM} = sub { die "timeout\n" };
+	alarm($timeout) if $timeout;
+
+	for my $consumer (@consumers)
+	{
+	    my $to = gensym;
+	    my($first, @rest) = @$consumer;
+	    my $h = IPC::Run::start($first, '<pipe', $to, @rest);
+	    _set_cloexec($to);
+	    push(@sinks, { fh => $to, harness => $h, name => $first->[0] });
+	}
+
+	my $buf = $head;
+	my $n = length($buf);
+	while (1)
+	{
+	    if ($n == 0)
+	    {
+		$n = sysread($from, $buf, $StreamBufferSize);
+		defined($n) or die "Error reading from $producer->[0]: $!";
+		last if $n == 0;
+	    }
+	    $bytes += $n;
+
+	    for my $sink (@sinks)
+	    {
+		next if $sink->{error};
+		my $off = 0;
+		while ($off < $n)
+		{
+		    my $w = syswrite($sink->{fh}, $buf, $n - $off, $off);
+		    if (!defined($w))
+		    {
+			$sink->{error} = "$!";
+			last;
+		    }
+		    $off += $w;
+		}
+	    }
+	    $n = 0;
+	}
+	$prod_end = gettimeofday;
+	close($from);
+	close($_->{fh}) foreach @sinks;
+
+	my $ok = $prod_h->finish;
+	for my $sink (@sinks)
+	{
+	    $sink->{harness}->finish or $ok = 0;
+	    if ($sink->{error})
+	    {
+		warn "Error writing to $sink->{name}: $sink->{error}\n";
+		$ok = 0;
+	    }
+	}
+	alarm(0);
+	$ok;
+    };
+    alarm(0);
+    if ($@)
+    {
+	my $err = $@;
+	$_->kill_kill foreach $prod_h, map { $_->{harness} } @sinks;
+	die $err eq "timeout\n" ? "Streamed $label timed out after $timeout seconds: \n" . Dumper($producer, \@consumers) : $err;
+    }
+
+    my $end = gettimeofday;
+    my $elap = $end - $start;
+    print STDERR "Streamed run returns $ok bytes=$bytes elapsed=$elap\n";
+
+    push(@{$self->{log}}, [$logged, getcwd, $start, $end, $elap]);
+    push(@{$self->{streams}}, {
+	label => $label,
+	bytes => $bytes,
+	consumers => scalar @sinks,
+	io_bytes_avoided => (1 + @sinks) * $bytes,
+	elapsed => $elap,
+	producer_elapsed => $prod_end - $start,
+	tail_elapsed => $end - $prod_end,
+    });
+
+    $ok or die "Failed running streamed pipeline: \n" . Dumper($producer, \@consumers);
+}
+
+sub _set_cloexec
+{
+    my($fh) = @_;
+    my $flags = fcntl($fh, F_GETFD, 0);
+    fcntl($fh, F_SETFD, $flags | FD_CLOEXEC) if defined($flags);
+}
+
 sub get_version
 {
     my($self, $cmd) = @_;
@@ -196,6 +366,13 @@ sub report
 	commands => [],
 	log => $self->{log},
     };
+    if (@{$self->{streams}})
+    {
+	my $saved = 0;
+	$saved += $_->{io_bytes_avoided} foreach @{$self->{streams}};
+	$report->{streams} = $self->{streams};
+	$report->{io_bytes_avoided} = $saved;
+    }
     for my $cmd (sort keys %{$self->{commands}})
     {
 	my $n = $self->{commands}->{$cmd};
@@ -0,0 +1,342 @@
+package Bio::P3::LazyGTO;
+
+#
+# Lightweight access to a GTO file for tools that read a few top-level
+# sections and add or replace a few others.
+#
+# Loading a GenomeTypeObject and writing it back with destroy_to_file
+# builds the whole genome as Perl data, and re-encodes and re-sorts all of
+# it, features included, to change a couple of small blocks. Here we scan
+# the top level of the file a chunk at a time, noting the byte offsets of
+# each section's value without decoding it, and decode only the sections
+# asked for (read and update). The features may be decoded one at a time,
+# keeping only those the caller wants. Writing copies the untouched
+# sections from the original file and encodes only the updated ones.
+#
+# Memory use is bounded by the sections decoded and the longest string in
+# the file (a contig's DNA), not by the size of the GTO.
+#
+# Keys are written in sorted order if canonical is set, as destroy_to_file
+# does with canonical; the untouched values are copied as they are, so
+# they stay canonical if they were.
+#
+
+use strict;
+use JSON::XS;
+use File::Temp;
+
+use constant CHUNK => 65536;
+
+#
+# new($file, read => [keys], update => [keys])
+#
+# Sections named in read or update are decoded into the object's hash;
+# only those named in update are written back from it.
+#
+
+sub new
+{
+    my($class, $file, %opts) = @_;
+
+    my %update = map { $_ => 1 } @{$opts{update} // []};
+    my %want = (%update, map { $_ => 1 } @{$opts{read} // []});
+
+    my $self = bless {
+	_file => $file,
+	_span => {},
+	_order => [],
+	_update => \%update,
+    }, $class;
+
+    my $json = JSON::XS->new->utf8->allow_nonref;
+    my $s = $self->_scanner(0);
+
+    _match($s, qr/\G\s*\{/) or die "$file: GTO is not a JSON object\n";
+    if ((_peek($s) // '') ne '}')
+    {
+	while (1)
+	{
+	    my $key = _match($s, qr/\G\s*("(?:[^"\\]++|\\.)*+")\s*:/)
+		or die "$file: bad GTO key at offset " . _offset($s) . "\n";
+	    $key = $json->decode($key);
+	    _peek($s);
+	    my $start = _offset($s);
+	    _skip_value($s);
+
+	    $self->{_span}->{$key} = [$start, _offset($s) - $start];
+	    push(@{$self->{_order}}, $key);
+
+	    my $sep = _match($s, qr/\G\s*([,}])/) or die "$file: bad GTO text at offset " . _offset($s) . "\n";
+	    last if $sep eq '}';
+	}
+    }
+
+    for my $key (grep { $self->{_span}->{$_} } keys %want)
+    {
+	$self->{$key} = $json->decode($self->_read_span($s->{fh}, @{$self->{_span}->{$key}}));
+    }
+    close($s->{fh});
+
+    return $self;
+}
+
+sub contigs
+{
+    my($self) = @_;
+    return @{$self->{contigs} // []};
+}
+
+#
+# Return the features, or with $filter only those for which $filter
+# returns true. Unless the features were read when the GTO was loaded,
+# they are decoded one at a time from the file, so only the ones kept are
+# held in memory.
+#
+
+sub features
+{
+    my($self, $filter) = @_;
+
+    my @features;
+    if ($self->{features})
+    {
+	@features = @{$self->{features}};
+	return $filter ? grep { $filter->($_) } @features : @features;
+    }
+
+    my $span = $self->{_span}->{features} or return;
+    my $json = JSON::XS->new->utf8;
+    my $s = $self->_scanner($span->[0], $span->[0] + $span->[1]);
+    open(my $fh, "<:raw", $self->{_file}) or die "Cannot open $self->{_file}: $!";
+
+    _match($s, qr/\G\s*\[/) or die "$self->{_file}: features is not a list\n";
+    if ((_peek($s) // '') ne ']')
+    {
+	while (1)
+	{
+	    _peek($s);
+	    my $start = _offset($s);
+	    _skip_value($s);
+	    my $feature = $json->decode($self->_read_span($fh, $start, _offset($s) - $start));
+	    push(@features, $feature) if !$filter || $filter->($feature);
+
+	    my $sep = _match($s, qr/\G\s*([,\]])/) or die "$self->{_file}: bad features text at offset " . _offset($s) . "\n";
+	    last if $sep eq ']';
+	}
+    }
+    close($fh);
+    close($s->{fh});
+    return @features;
+}
+
+sub extract_contig_sequences_to_temp_file
+{
+    my($self) = @_;
+
+    my $tmp = File::Temp->new(UNLINK => 0);
+    for my $ctg ($self->contigs)
+    {
+	print $tmp ">$ctg->{id}\n$ctg->{dna}\n";
+    }
+    close($tmp);
+    return "$tmp";
+}
+
+#
+# Write the GTO to $file, through a temporary file renamed into place, so
+# $file may be the file we were read from.
+#
+
+sub write
+{
+    my($self, $file, $opts) = @_;
+
+    my $coder = JSON::XS->new->utf8->allow_nonref->pretty;
+    $coder->canonical(1) if $opts->{canonical};
+    my $key_coder = JSON::XS->new->utf8->allow_nonref;
+
+    my $span = $self->{_span};
+    my $update = $self->{_update};
+    my @keys = @{$self->{_order}};
+    push(@keys, grep { !$span->{$_} && exists($self->{$_}) } sort keys %$update);
+    @keys = sort @keys if $opts->{canonical};
+
+    open(my $in, "<:raw", $self->{_file}) or die "Cannot open $self->{_file}: $!";
+    my $tmp = "$file.tmp.$$";
+    open(my $fh, ">:raw", $tmp) or die "Cannot write $tmp: $!";
+    print $fh "{";
+    my $sep = "\n";
+    for my $key (@keys)
+    {
+	if ($update->{$key})
+	{
+	    next unless exists($self->{$key});
+	    my $val = $coder->encode($self->{$key});
+	    chomp($val);
+	    print $fh $sep, "   ", $key_coder->encode($key), " : ", $val;
+	}
+	else
+	{
+	    print $fh $sep, "   ", $key_coder->encode($key), " : ";
+	    my($start, $len) = @{$span->{$key}};
+	    seek($in, $start, 0) or die "Cannot seek $self->{_file}: $!";
+	    while ($len > 0)
+	    {
+		my $n = read($in, my $buf, $len < CHUNK ? $len : CHUNK);
+		$n or die "Error reading $self->{_file}: " . (defined($n) ? "unexpected end of file" : $!) . "\n";
+		print $fh $buf;
+		$len -= $n;
+	    }
+	}
+	$sep = ",\n";
+    }
+    print $fh "\n}\n";
+    close($in);
+    close($fh) or die "Error writing $tmp: $!";
+    rename($tmp, $file) or die "Cannot rename $tmp to $file: $!";
+}
+
+sub _read_span
+{
+    my($self, $fh, $start, $len) = @_;
+
+    seek($fh, $start, 0) or die "Cannot seek $self->{_file}: $!";
+    my $n = read($fh, my $text, $len);
+    defined($n) && $n == $len or die "Error reading $self->{_file} at offset $start\n";
+    return $text;
+}
+
+#
+# A scanner reads the file from byte offset $start (up to $limit if given)
+# into a buffer a chunk at a time, dropping what it has scanned past.
+#
+
+sub _scanner
+{
+    my($self, $start, $limit) = @_;
+
+    open(my $fh, "<:raw", $self->{_file}) or die "Cannot open $self->{_file}: $!";
+    seek($fh, $start, 0) or die "Cannot seek $self->{_file}: $!";
+    my $s = { fh => $fh, file => $self->{_file}, buf => '', base => $start, limit => $limit };
+    pos($s->{buf}) = 0;
+    return $s;
+}
+
+sub _offset
+{
+    my($s) = @_;
+    return $s->{base} + pos($s->{buf});
+}
+
+#
+# Read another chunk into the buffer. Returns false at the end of the input.
+#
+
+sub _fill
+{
+    my($s) = @_;
+
+    my $pos = pos($s->{buf}) // 0;
+    substr($s->{buf}, 0, $pos, '');
+    $s->{base} += $pos;
+
+    my $want = CHUNK;
+    if (defined($s->{limit}))
+    {
+	my $left = $s->{limit} - $s->{base} - length($s->{buf});
+	$want = $left if $left < $want;
+    }
+    my $n = $want > 0 ? read($s->{fh}, $s->{buf}, $want, length($s->{buf})) : 0;
+    defined($n) or die "Error reading $s->{file}: $!";
+    pos($s->{buf}) = 0;
+    return $n > 0;
+}
+
+#
+# Match $re at the scan position, reading more of the input until it
+# matches or the input ends. $re must not match a prefix of a longer
+# match, nor the empty string. Returns the first capture, or 1 if there
+# is none; undef if it does not match.
+#
+
+sub _match
+{
+    my($s, $re) = @_;
+
+    while (1)
+    {
+	if ($s->{buf} =~ /$re/gc)
+	{
+	    return $1 // 1;
+	}
+	_fill($s) or return undef;
+    }
+}
+
+#
+# Skip whitespace and return the next character, reading more of the
+# input as needed; undef at the end of the input. (A zero-length /gc
+# match may not repeat at the same position, so we do not peek with a
+# lookahead.)
+#
+
+sub _peek
+{
+    my($s) = @_;
+
+    while (1)
+    {
+	$s->{buf} =~ /\G\s+/gc;
+	my $pos = pos($s->{buf});
+	return substr($s->{buf}, $pos, 1) if $pos < length($s->{buf});
+	_fill($s) or return undef;
+    }
+}
+
+#
+# Move the scan position past the JSON value that starts there, without
+# decoding it.
+#
+
+sub _skip_value
+{
+    my($s) = @_;
+
+    my $c = _peek($s) // die "$s->{file}: unexpected end of file\n";
+    if ($c eq '"')
+    {
+	_match($s, qr/\G"(?:[^"\\]++|\\.)*+"/) or die "$s->{file}: unterminated string\n";
+	return;
+    }
+    if ($c ne '{' && $c ne '[')
+    {
+	#
+	# A number, true, false or null runs to the next delimiter.
+	#
+	while (1)
+	{
+	    $s->{buf} =~ /\G[^,}\]\s]+/gc;
+	    return if pos($s->{buf}) < length($s->{buf}) || !_fill($s);
+	}
+    }
+
+    my $depth = 0;
+    while (1)
+    {
+	next if $s->{buf} =~ /\G[^"\[\]{}]+/gc;
+	next if $s->{buf} =~ /\G"(?:[^"\\]++|\\.)*+"/gc;
+	if ($s->{buf} =~ /\G[\[{]/gc)
+	{
+	    $depth++;
+	    next;
+	}
+	if ($s->{buf} =~ /\G[\]}]/gc)
+	{
+	    return if --$depth == 0;
+	    next;
+	}
+	_fill($s) or die "$s->{file}: unexpected end of file\n";
+    }
+}
+
+1;
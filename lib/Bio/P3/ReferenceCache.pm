@@ -0,0 +1,111 @@
+package Bio::P3::ReferenceCache;
+
+#
+# Content-addressed cache of prepared references and their indexes.
+#
+# The assembly scripts prepare the same handful of references (trimmed
+# FASTA, minimap2 .mmi, bowtie2 index) for every sample. Here a prepared
+# reference lives in a directory named by a hash of the source reference's
+# contents plus whatever parameters affect the preparation (primer scheme
+# version, trim length, ...), so each one is built once and then shared.
+#
+# Entries are built in a private temporary directory and renamed into
+# place, so a reader never sees a partial entry. A lock file per entry keeps
+# concurrent workers from all building the same entry at once; if the
+# filesystem does not support flock we fall back to letting them race,
+# which is still safe since only one rename can win.
+#
+
+use strict;
+use Digest::MD5;
+use Fcntl ':flock';
+use File::Path qw(make_path remove_tree);
+
+sub new
+{
+    my($class, $dir) = @_;
+
+    make_path($dir);
+    -d $dir or die "Cannot create reference cache directory $dir: $!";
+
+    my $self = {
+	dir => $dir,
+    };
+    return bless $self, $class;
+}
+
+#
+# Return the cache key for a source file and a list of parameters.
+#
+
+sub key
+{
+    my($self, $source, @params) = @_;
+
+    open(my $fh, "<", $source) or die "Cannot open $source: $!";
+    my $content = Digest::MD5->new->addfile($fh)->hexdigest;
+    close($fh);
+
+    return Digest::MD5::md5_hex(join("\0", $content, @params));
+}
+
+#
+# Return the directory for the entry for $source and @params, building it
+# with $builder if necessary. $builder is called with the directory to
+# populate and must die on failure.
+#
+
+sub get
+{
+    my($self, $source, $params, $builder) = @_;
+
+    my $key = $self->key($source, @$params);
+    my $entry = "$self->{dir}/$key";
+
+    return $entry if -f "$entry/.complete";
+
+    my $lock;
+    if (open($lock, ">>", "$entry.lock"))
+    {
+	if (!flock($lock, LOCK_EX))
+	{
+	    warn "Cannot lock $entry.lock, building without lock: $!\n";
+	}
+	return $entry if -f "$entry/.complete";
+    }
+    else
+    {
+	warn "Cannot open $entry.lock, building without lock: $!\n";
+    }
+
+    print STDERR "Building reference cache entry $entry for $source @$params\n";
+    my $tmp = "$entry.tmp.$$";
+    remove_tree($tmp);
+    make_path($tmp);
+
+    eval { $builder->($tmp); };
+    if ($@)
+    {
+	my $err = $@;
+	remove_tree($tmp);
+	die "Failed building reference cache entry for $source: $err";
+    }
+
+    open(my $done, ">", "$tmp/.complete") or die "Cannot write $tmp/.complete: $!";
+    print $done join("\t", $source, @$params), "\n";
+    close($done);
+
+    if (!rename($tmp, $entry))
+    {
+	#
+	# Someone else finished first.
+	#
+	remove_tree($tmp);
+	-f "$entry/.complete" or die "Cannot rename $tmp to $entry: $!";
+    }
+
+    close($lock) if $lock;
+    return $entry;
+}
+
+1;
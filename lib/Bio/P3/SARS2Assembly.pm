@@ -16,9 +16,9 @@ use base 'Exporter';
 
 our @EXPORT_OK = qw(reference_fasta_path primer_bedpe_path run_cmds vigor_workflow report_template
 		    reference_gff_path reference_spike_aa_path mpath
-		    add_variants_to_gto add_quality_estimate_to_gto
+		    add_variants_to_gto add_quality_estimate_to_gto reference_cds_index
 		    artic_bed artic_reference
-		    artic_primer_schemes_path manifest
+		    artic_primer_schemes_path manifest primer_catalog
 		   );
 
 our $ReferenceSpikeAA = "YP_009724390.1.aa.fa";
@@ -29,6 +29,7 @@ our $ArticSchemes = "primer_schemes";
 our $VigorWorkflow = "vigor.wf";
 our $ReportTemplate = "report.tt";
 our $Manifest = "bvbrc_manifest.json";
+our $PrimerCatalog = "primer_catalog/index.tsv";
 
 sub mpath
 {
@@ -51,6 +52,38 @@ sub manifest
     return $ref;
 }
 
+#
+# Read the primer catalog written by compile-primer-catalog.pl at build
+# time. Returns a hash keyed by primer name, each entry holding the
+# primer's path, its versions in manifest order, the latest version, and
+# the reference and ivar-format BED for each version; or undef if there is
+# no catalog, in which case callers fall back to the manifest.
+#
+
+sub primer_catalog
+{
+    my $mpath = mpath();
+    open(my $fh, "<", "$mpath/$PrimerCatalog") or return undef;
+
+    my $catalog = {};
+    while (<$fh>)
+    {
+	chomp;
+	my($name, $path, $vers, $reference, $bed, $source_bed, $latest) = split(/\t/);
+	my $primer = $catalog->{$name} //= { path => $path, versions => [], schemes => {} };
+	push(@{$primer->{versions}}, $vers);
+	$primer->{latest} = $vers if $latest;
+	$primer->{schemes}->{$vers} = {
+	    version => $vers,
+	    reference => "$mpath/$reference",
+	    bed => "$mpath/$bed",
+	    source_bed => "$mpath/$source_bed",
+	};
+    }
+    close($fh);
+    return $catalog;
+}
+
 sub reference_fasta_path
 {
     my $ref = mpath() . "/$ReferenceFasta";
@@ -153,16 +186,23 @@ sub run_cmds
     $ok or die "Failed running pipeline: \n" . Dumper(\@cmds);
 }
 
-sub add_variants_to_gto
+#
+# Index of the reference CDS features: the gene name for each CDS ID, and
+# for each genome position the first CDS (in GFF order) whose range
+# start <= pos < end contains it, and the extent (first start, last end)
+# of each CDS ID. Built on first use and kept for the life of the process.
+#
+
+our $CdsIndex;
+
+sub reference_cds_index
 {
-    my($file, $gto) = @_;
-    #
-    # Read reference.
-    #
+    return $CdsIndex if $CdsIndex;
 
     my %gene;
+    my @by_pos;
+    my %extent;
 
-    my @prots;
     open(R, "<", reference_gff_path) or die "Cannot open reference " . reference_gff_path . ": $!";
     while (<R>)
     {
@@ -179,10 +219,27 @@ sub add_variants_to_gto
 	}
 
 	$gene{$attrh->{ID}} = $attrh->{gene};
-	push(@prots, [$start, $end, $attrh]);
+	my $item = [$start, $end, $attrh];
+	$by_pos[$_] //= $item foreach $start .. $end - 1;
+
+	my $ext = $extent{$attrh->{ID}} //= [$start, $end];
+	$ext->[0] = $start if $start < $ext->[0];
+	$ext->[1] = $end if $end > $ext->[1];
     }
     close(R);
-    
+
+    $CdsIndex = { gene => \%gene, by_pos => \@by_pos, extent => \%extent };
+    return $CdsIndex;
+}
+
+sub add_variants_to_gto
+{
+    my($file, $gto) = @_;
+
+    my $index = reference_cds_index();
+    my $gene = $index->{gene};
+    my $by_pos = $index->{by_pos};
+
     open(V, "<", $file) or die "Cannot open variants file $file: $!\n";
     my $hdr = <V>;
     chomp $hdr;
@@ -210,16 +267,7 @@ sub add_variants_to_gto
 	    freq => $freq,
 	};
 
-	my $prot;
-	for my $item (@prots)
-	{
-	    my($s, $e, $attr) = @$item;
-	    if ($pos >= $s && $pos < $e)
-	    {
-		$prot = $item;
-		last;
-	    }
-	}
+	my $prot = $pos >= 0 ? $by_pos->[$pos] : undef;
 
 	if ($prot)
 	{
@@ -253,10 +301,9 @@ sub add_variants_to_gto
     my $vlist = [];
     for my $id (sort keys %snplist)
     {
-	my $gene = $gene{$id};
 	my $tv = {
 	    reference => $id,
-	    gene => $gene,
+	    gene => $gene->{$id},
 	    snps => $snplist{$id} // [],
 	};
 	push(@$vlist, $tv);
@@ -0,0 +1,601 @@
+package Bio::P3::SpikeVariants;
+
+#
+# In-process spike protein variant caller.
+#
+# This computes the same per-genome summary as sars2-get-blast-variants
+# (frames, insertions, and substitutions relative to the reference spike
+# protein) without building a BLAST database and running tblastn for
+# every genome.
+#
+# Each contig is translated in the three frames over a window around the
+# spike locus of the reference genome; contigs assembled against the
+# reference are close to reference coordinates. Exact k-mer matches to the
+# reference protein are grouped into diagonal runs and chained colinearly;
+# the gaps between chained runs are filled by an affine gap global
+# alignment (BLOSUM62, the tblastn defaults of 11/1), and the ends are
+# extended ungapped with an X-drop. The alignment of each frame is then
+# split into segments with an X-drop, which stand in for BLAST's HSPs
+# and go through the same length and identity filters and the same
+# merge. If nothing passes the filters in the window we try the whole
+# contig on both strands.
+#
+
+use strict;
+use gjoseqlib;
+use Bio::P3::SARS2Assembly qw(reference_spike_aa_path reference_cds_index);
+
+our $Blosum62 = <<'END';
+   A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+* -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+END
+
+our %Score;
+{
+    my($hdr, @rows) = split(/\n/, $Blosum62);
+    my @cols = split(' ', $hdr);
+    for my $row (@rows)
+    {
+	my($aa, @vals) = split(' ', $row);
+	@{$Score{$aa}}{@cols} = @vals;
+    }
+}
+
+our %Codon;
+{
+    my @b = qw(T C A G);
+    my @aa = split(//, "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG");
+    for my $i (0..63)
+    {
+	$Codon{$b[$i >> 4] . $b[($i >> 2) & 3] . $b[$i & 3]} = $aa[$i];
+    }
+}
+
+our %Iupac = (A => 'A', C => 'C', G => 'G', T => 'T', U => 'T',
+	      R => 'AG', Y => 'CT', S => 'CG', W => 'AT', K => 'GT', M => 'AC',
+	      B => 'CGT', D => 'AGT', H => 'ACT', V => 'ACG', N => 'ACGT');
+
+sub new
+{
+    my($class, %opts) = @_;
+
+    my $reference = $opts{reference} // reference_spike_aa_path;
+    open(my $fh, "<", $reference) or die "Cannot open spike reference $reference: $!";
+    my($ref_id, $ref_def, $ref_seq) = read_next_fasta_seq($fh);
+    close($fh);
+    $ref_seq or die "No sequence in spike reference $reference\n";
+    $ref_seq = uc($ref_seq);
+
+    my $self = {
+	ref_id => $ref_id,
+	ref_seq => $ref_seq,
+	ref => [split(//, $ref_seq)],
+	min_len => $opts{min_len} // 50,
+	min_pid => $opts{min_pid} // 0.85,
+	gap_char => $opts{gap_char} // 'X',
+	k => $opts{k} // 5,
+	margin => $opts{margin} // 3000,
+	gap_open => $opts{gap_open} // 11,
+	gap_extend => $opts{gap_extend} // 1,
+	xdrop => $opts{xdrop} // 20,
+	seg_xdrop => $opts{seg_xdrop} // 40,
+	band => $opts{band} // 16,
+	max_cells => $opts{max_cells} // 250_000,
+	codon_cache => {},
+    };
+
+    #
+    # The spike locus on the reference genome, if the reference protein is
+    # one of the reference CDS features.
+    #
+    my $extent = reference_cds_index()->{extent}->{"cds-$ref_id"};
+    $self->{locus} = $extent if $extent;
+
+    my %kmers;
+    my $k = $self->{k};
+    for my $i (0 .. length($ref_seq) - $k)
+    {
+	push(@{$kmers{substr($ref_seq, $i, $k)}}, $i);
+    }
+    $self->{kmers} = \%kmers;
+
+    return bless $self, $class;
+}
+
+#
+# Call spike variants in one nucleotide sequence. Returns undef if no
+# alignment passes the filters, else a hash with the frames of the
+# alignments used (BLAST numbering), the insertions ("pos-AAS", the
+# inserted residues before reference position pos) and the variants
+# ("D614G"; reference positions with no alignment get the gap character).
+#
+
+sub call
+{
+    my($self, $id, $seq) = @_;
+
+    $seq = uc($seq);
+    $seq =~ s/\s+//g;
+
+    my @hsps;
+    if (my $locus = $self->{locus})
+    {
+	@hsps = $self->strand_hsps($seq, 1, $locus->[0] - 1 - $self->{margin}, $locus->[1] + $self->{margin});
+    }
+    if (!@hsps)
+    {
+	my $rc = reverse($seq);
+	$rc =~ tr/ACGTUMRWSYKVHDBN/TGCAAKYWSRMBDHVN/;
+	@hsps = ($self->strand_hsps($seq, 1, 0, length($seq)),
+		 $self->strand_hsps($rc, -1, 0, length($rc)));
+    }
+    return undef unless @hsps;
+
+    #
+    # Merge as sars2-get-blast-variants does: HSPs in score order, later
+    # ones overwriting the residue at a query position, insertions
+    # accumulating.
+    #
+    my(%frames, %subj, %ins);
+    for my $hsp (sort { $b->{score} <=> $a->{score} } @hsps)
+    {
+	$frames{$hsp->{frame}} = 1;
+	my $next = $hsp->{cols}->[0]->[0];
+	for my $col (@{$hsp->{cols}})
+	{
+	    my($qi, $s) = @$col;
+	    if (defined($qi))
+	    {
+		$subj{$qi + 1} = $s;
+		$next = $qi + 1;
+	    }
+	    else
+	    {
+		push(@{$ins{$next + 1}}, $s);
+	    }
+	}
+    }
+
+    my @snps;
+    my $ref = $self->{ref};
+    for my $i (0 .. $#$ref)
+    {
+	my $pos = $i + 1;
+	my $s = $subj{$pos} // $self->{gap_char};
+	push(@snps, "$ref->[$i]$pos$s") if $s ne $ref->[$i];
+    }
+
+    return {
+	id => $id,
+	frames => [sort { $a <=> $b } keys %frames],
+	insertions => [map { "$_-" . join("", @{$ins{$_}}) } sort { $a <=> $b } keys %ins],
+	snps => \@snps,
+    };
+}
+
+#
+# The sars2-get-blast-variants output line for a call.
+#
+
+sub format_call
+{
+    my($self, $call, $show_frame) = @_;
+    return join("\t", $call->{id},
+		($show_frame ? join(",", @{$call->{frames}}) : ()),
+		join(",", @{$call->{insertions}}),
+		join(",", @{$call->{snps}})) . "\n";
+}
+
+#
+# Translate $seq[$from .. $to) in the three frames of the given strand and
+# return the segments that pass the filters.
+#
+
+sub strand_hsps
+{
+    my($self, $seq, $strand, $from, $to) = @_;
+
+    $from = 0 if $from < 0;
+    $to = length($seq) if $to > length($seq);
+
+    my @hsps;
+    for my $off (0..2)
+    {
+	my $start = $from + (($off - $from) % 3);
+	my $prot = $self->translate($seq, $start, $to);
+	my $cols = $self->align($prot) or next;
+	for my $hsp ($self->segments($cols))
+	{
+	    next unless $hsp->{len} >= $self->{min_len} && $hsp->{ident} / $hsp->{len} >= $self->{min_pid};
+	    $hsp->{frame} = $strand * ($off + 1);
+	    push(@hsps, $hsp);
+	}
+    }
+    return @hsps;
+}
+
+#
+# Translate the codons of $seq starting at $start and ending by $end.
+# Codons with ambiguity codes translate to the amino acid all of their
+# expansions agree on, as BLAST does, else X.
+#
+
+sub translate
+{
+    my($self, $seq, $start, $end) = @_;
+
+    my $cache = $self->{codon_cache};
+    my $prot = "";
+    for (my $p = $start; $p + 3 <= $end; $p += 3)
+    {
+	my $codon = substr($seq, $p, 3);
+	$prot .= $Codon{$codon} // ($cache->{$codon} //= ambiguous_codon($codon));
+    }
+    return $prot;
+}
+
+sub ambiguous_codon
+{
+    my($codon) = @_;
+
+    my @alts = map { $Iupac{$_} } split(//, $codon);
+    return 'X' if grep { !defined } @alts;
+
+    my %aa;
+    for my $x (split(//, $alts[0]))
+    {
+	for my $y (split(//, $alts[1]))
+	{
+	    $aa{$Codon{"$x$y$_"}} = 1 foreach split(//, $alts[2]);
+	}
+    }
+    my @aa = keys %aa;
+    return @aa == 1 ? $aa[0] : 'X';
+}
+
+#
+# Align a translated frame to the reference. Returns the alignment as a
+# list of columns [query index, subject residue]; the query index is undef
+# for an insertion, the subject residue is '-' for a deletion and undef
+# where the query is not aligned. Returns undef if there are no seeds.
+#
+
+sub align
+{
+    my($self, $prot) = @_;
+
+    my $k = $self->{k};
+    my $kmers = $self->{kmers};
+    my $ref_seq = $self->{ref_seq};
+    my $qlen = length($ref_seq);
+
+    #
+    # Exact k-mer hits, grouped into runs on a diagonal.
+    #
+    my %open;
+    my @runs;
+    for my $j (0 .. length($prot) - $k)
+    {
+	my $hits = $kmers->{substr($prot, $j, $k)} or next;
+	for my $i (@$hits)
+	{
+	    my $diag = $j - $i;
+	    my $run = $open{$diag};
+	    if ($run && $run->[1] + $run->[2] - $k + 1 == $j)
+	    {
+		$run->[2]++;
+	    }
+	    else
+	    {
+		$run = $open{$diag} = [$i, $j, $k];
+		push(@runs, $run);
+	    }
+	}
+    }
+    return undef unless @runs;
+
+    #
+    # Best colinear chain, paying for shifts in diagonal.
+    #
+    @runs = sort { $a->[0] <=> $b->[0] || $a->[1] <=> $b->[1] } @runs;
+    my(@score, @prev);
+    my $best;
+    for my $b (0..$#runs)
+    {
+	my($bi, $bj, $blen) = @{$runs[$b]};
+	$score[$b] = $blen;
+	for my $a (0 .. $b - 1)
+	{
+	    my($ai, $aj, $alen) = @{$runs[$a]};
+	    next unless $ai < $bi && $aj < $bj && $ai + $alen <= $bi + $blen && $aj + $alen <= $bj + $blen;
+	    my $overlap = ($ai + $alen - $bi) > ($aj + $alen - $bj) ? $ai + $alen - $bi : $aj + $alen - $bj;
+	    $overlap = 0 if $overlap < 0;
+	    my $s = $score[$a] + $blen - $overlap - abs(($bj - $bi) - ($aj - $ai));
+	    if ($s > $score[$b])
+	    {
+		$score[$b] = $s;
+		$prev[$b] = $a;
+	    }
+	}
+	$best = $b if !defined($best) || $score[$b] > $score[$best];
+    }
+    my @chain;
+    for (my $b = $best; defined($b); $b = $prev[$b])
+    {
+	unshift(@chain, [@{$runs[$b]}]);
+    }
+
+    #
+    # Trim overlaps between consecutive runs.
+    #
+    my @blocks;
+    for my $run (@chain)
+    {
+	if (@blocks)
+	{
+	    my($pi, $pj, $plen) = @{$blocks[-1]};
+	    my $over = $pi + $plen - $run->[0];
+	    my $sover = $pj + $plen - $run->[1];
+	    $over = $sover if $sover > $over;
+	    if ($over > 0)
+	    {
+		$run->[$_] += $over for 0, 1;
+		$run->[2] -= $over;
+	    }
+	    next if $run->[2] <= 0;
+	}
+	push(@blocks, $run);
+    }
+
+    my @ref = @{$self->{ref}};
+    my @subj = split(//, $prot);
+    my @cols;
+
+    #
+    # Leading end: ungapped X-drop extension, the rest unaligned.
+    #
+    my($fi, $fj) = @{$blocks[0]};
+    my $ext = $self->xdrop_extend(\@ref, \@subj, $fi - 1, $fj - 1, -1);
+    push(@cols, [$_, undef]) for 0 .. $fi - $ext - 1;
+    push(@cols, [$fi - $_, $subj[$fj - $_]]) for reverse 1 .. $ext;
+
+    for my $n (0..$#blocks)
+    {
+	my($i, $j, $len) = @{$blocks[$n]};
+	push(@cols, [$i + $_, $subj[$j + $_]]) for 0 .. $len - 1;
+
+	if ($n < $#blocks)
+	{
+	    my($ni, $nj) = @{$blocks[$n + 1]};
+	    push(@cols, $self->global(\@ref, \@subj, $i + $len, $ni, $j + $len, $nj));
+	}
+    }
+
+    my($li, $lj, $llen) = @{$blocks[-1]};
+    $li += $llen;
+    $lj += $llen;
+    $ext = $self->xdrop_extend(\@ref, \@subj, $li, $lj, 1);
+    push(@cols, [$li + $_, $subj[$lj + $_]]) for 0 .. $ext - 1;
+    push(@cols, [$_, undef]) for $li + $ext .. $qlen - 1;
+
+    return \@cols;
+}
+
+#
+# Length of the best ungapped extension from ($i, $j) in direction $dir.
+#
+
+sub xdrop_extend
+{
+    my($self, $ref, $subj, $i, $j, $dir) = @_;
+
+    my($score, $best, $best_len) = (0, 0, 0);
+    for (my $n = 1; $i >= 0 && $j >= 0 && $i < @$ref && $j < @$subj; $n++, $i += $dir, $j += $dir)
+    {
+	$score += $Score{$ref->[$i]}->{$subj->[$j]} // -1;
+	if ($score > $best)
+	{
+	    ($best, $best_len) = ($score, $n);
+	}
+	last if $best - $score > $self->{xdrop};
+    }
+    return $best_len;
+}
+
+#
+# Global affine gap alignment of $ref[$i0 .. $i1) with $subj[$j0 .. $j1),
+# returned as alignment columns. The alignment is banded about the
+# diagonal joining the corners. Regions too large to align (which would
+# not chain in a real spike) are left unaligned.
+#
+
+sub global
+{
+    my($self, $ref, $subj, $i0, $i1, $j0, $j1) = @_;
+
+    my $n = $i1 - $i0;
+    my $m = $j1 - $j0;
+    return map { [$i0 + $_, '-'] } 0 .. $n - 1 if $m == 0;
+    return map { [undef, $subj->[$j0 + $_]] } 0 .. $m - 1 if $n == 0;
+    my $band = $self->{band} + int($m / $n) + 1;
+    return map { [$i0 + $_, undef] } 0 .. $n - 1 if $n * ($m < 2 * $band ? $m : 2 * $band) > $self->{max_cells};
+
+    my $ext = $self->{gap_extend};
+    my $open = $self->{gap_open} + $ext;
+    my $neg = -1e9;
+    my $w = $m + 1;
+
+    #
+    # States: 0 match, 1 reference residue against a gap (deletion),
+    # 2 subject residue against a gap (insertion).
+    #
+    my(@M, @D, @I, @tM, @tD, @tI);
+    ($M[0], $D[0], $I[0]) = (0, $neg, $neg);
+    for my $i (1..$n)
+    {
+	my $c = $i * $w;
+	($M[$c], $I[$c], $D[$c], $tD[$c]) = ($neg, $neg, -($open + ($i - 1) * $ext), $i > 1 ? 1 : 0);
+    }
+    for my $j (1..$m)
+    {
+	($M[$j], $D[$j], $I[$j], $tI[$j]) = ($neg, $neg, -($open + ($j - 1) * $ext), $j > 1 ? 2 : 0);
+    }
+
+    #
+    # Cells outside the band are never set; they read as $neg.
+    #
+    for my $i (1..$n)
+    {
+	my $row = $Score{$ref->[$i0 + $i - 1]} // $Score{X};
+	my $mid = int($i * $m / $n);
+	my $lo = $mid - $band > 1 ? $mid - $band : 1;
+	my $hi = $mid + $band < $m ? $mid + $band : $m;
+	for my $j ($lo..$hi)
+	{
+	    my $c = $i * $w + $j;
+
+	    my $d = $c - $w - 1;
+	    my($dm, $dd, $di) = ($M[$d] // $neg, $D[$d] // $neg, $I[$d] // $neg);
+	    my($s, $t) = ($dm, 0);
+	    ($s, $t) = ($dd, 1) if $dd > $s;
+	    ($s, $t) = ($di, 2) if $di > $s;
+	    $M[$c] = $s + ($row->{$subj->[$j0 + $j - 1]} // -1);
+	    $tM[$c] = $t;
+
+	    my $u = $c - $w;
+	    ($dm, $dd, $di) = ($M[$u] // $neg, $D[$u] // $neg, $I[$u] // $neg);
+	    ($s, $t) = ($dm - $open, 0);
+	    ($s, $t) = ($dd - $ext, 1) if $dd - $ext > $s;
+	    ($s, $t) = ($di - $open, 2) if $di - $open > $s;
+	    ($D[$c], $tD[$c]) = ($s, $t);
+
+	    my $l = $c - 1;
+	    ($dm, $dd, $di) = ($M[$l] // $neg, $D[$l] // $neg, $I[$l] // $neg);
+	    ($s, $t) = ($dm - $open, 0);
+	    ($s, $t) = ($di - $ext, 2) if $di - $ext > $s;
+	    ($s, $t) = ($dd - $open, 1) if $dd - $open > $s;
+	    ($I[$c], $tI[$c]) = ($s, $t);
+	}
+    }
+
+    my $c = $n * $w + $m;
+    my $state = 0;
+    $state = 1 if $D[$c] > $M[$c];
+    $state = 2 if $I[$c] > ($state ? $D[$c] : $M[$c]);
+
+    my @cols;
+    my($i, $j) = ($n, $m);
+    while ($i > 0 || $j > 0)
+    {
+	my $c = $i * $w + $j;
+	if ($state == 0)
+	{
+	    unshift(@cols, [$i0 + $i - 1, $subj->[$j0 + $j - 1]]);
+	    $state = $tM[$c];
+	    $i--;
+	    $j--;
+	}
+	elsif ($state == 1)
+	{
+	    unshift(@cols, [$i0 + $i - 1, '-']);
+	    $state = $tD[$c];
+	    $i--;
+	}
+	else
+	{
+	    unshift(@cols, [undef, $subj->[$j0 + $j - 1]]);
+	    $state = $tI[$c];
+	    $j--;
+	}
+    }
+    return @cols;
+}
+
+#
+# Split alignment columns into segments the way BLAST's X-drop ends a
+# gapped extension: a segment runs to its best scoring point, and ends
+# once the score falls more than xdrop below that. Unaligned columns also
+# end a segment.
+#
+
+sub segments
+{
+    my($self, $cols) = @_;
+
+    my $ref = $self->{ref};
+    my $xdrop = $self->{seg_xdrop};
+    my @segs;
+    my($sum, $best, $start, $end, $gap) = (0, 0, 0, 0, 0);
+
+    my $emit = sub {
+	return unless $best > 0;
+	my @seg = @$cols[$start .. $end - 1];
+	my $ident = grep { defined($_->[0]) && $_->[1] eq $ref->[$_->[0]] } @seg;
+	push(@segs, { score => $best, len => scalar @seg, ident => $ident, cols => \@seg });
+    };
+
+    for my $n (0 .. $#$cols)
+    {
+	my($qi, $s) = @{$cols->[$n]};
+	my $score;
+	if (!defined($s))
+	{
+	    &$emit;
+	    ($sum, $best, $start, $gap) = (0, 0, $n + 1, 0);
+	    next;
+	}
+	elsif (!defined($qi) || $s eq '-')
+	{
+	    my $type = defined($qi) ? 1 : 2;
+	    $score = -($gap == $type ? $self->{gap_extend} : $self->{gap_open} + $self->{gap_extend});
+	    $gap = $type;
+	}
+	else
+	{
+	    $score = $Score{$ref->[$qi]}->{$s} // -1;
+	    $gap = 0;
+	}
+
+	$sum += $score;
+	if ($sum > $best)
+	{
+	    ($best, $end) = ($sum, $n + 1);
+	}
+	elsif ($best == 0 && $sum <= 0)
+	{
+	    ($sum, $start, $gap) = (0, $n + 1, 0);
+	}
+	elsif ($best - $sum > $xdrop)
+	{
+	    &$emit;
+	    ($sum, $best, $start, $gap) = (0, 0, $n + 1, 0);
+	}
+    }
+    &$emit;
+    return @segs;
+}
+
+1;
@@ -0,0 +1,335 @@
+#
+# Reference-anchored alignment of consensus sequences.
+#
+# sars2-onecodex aligned each consensus to the reference with
+# "cat reference consensus | mafft --auto -", which starts mafft and
+# has it pick a strategy every time for what is always one ~30 kb
+# sequence against the same reference. The consensus is assembled against
+# that reference, so nearly all of it is in long exact matches. Here we
+# index the reference's unique k-mers once, chain the k-mer hits of each
+# consensus colinearly, and only run a (banded, affine gap) dynamic
+# programming alignment in the short stretches between chained runs.
+#
+# The output is written as mafft writes it: the reference and then the
+# consensus records, with their full header lines, lowercase, 60 columns a
+# line. Several consensus records in one file are merged into one
+# reference-anchored alignment, with insertions padded to the longest.
+#
+
+import argparse
+import sys
+
+K = 15
+MATCH = 2
+MISMATCH = -3
+GAP_OPEN = 5
+GAP_EXTEND = 2
+BAND = 32
+MAX_CELLS = 250_000
+NEG = -10**9
+
+ACGT = set("ACGT")
+
+def read_fasta(path):
+    """ Return the (header line, sequence) records of a FASTA file. """
+
+    records = []
+    with open(path) as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            if line.startswith(">"):
+                records.append([line[1:], []])
+            elif records:
+                records[-1][1].append("".join(line.split()))
+    return [(hdr, "".join(seq)) for hdr, seq in records]
+
+def score(a, b):
+    if a not in ACGT or b not in ACGT:
+        return 0
+    return MATCH if a == b else MISMATCH
+
+class Reference:
+    """ A reference sequence with an index of its unique k-mers. """
+
+    def __init__(self, header, seq, k=K):
+        self.header = header
+        self.seq = seq
+        self.useq = seq.upper()
+        self.k = k
+
+        pos = {}
+        for i in range(len(self.useq) - k + 1):
+            kmer = self.useq[i:i + k]
+            pos[kmer] = -1 if kmer in pos else i
+        self.kmers = {kmer: i for kmer, i in pos.items() if i >= 0}
+
+    @classmethod
+    def from_fasta(cls, path):
+        records = read_fasta(path)
+        if not records:
+            raise ValueError(f"No reference sequence in {path}")
+        return cls(*records[0])
+
+    def anchors(self, query):
+        """ Return the best colinear chain of exact matches as (ref start, query start, length). """
+
+        k = self.k
+        kmers = self.kmers
+        runs = []
+        open_runs = {}
+        for j in range(len(query) - k + 1):
+            i = kmers.get(query[j:j + k])
+            if i is None:
+                continue
+            diag = j - i
+            run = open_runs.get(diag)
+            if run and run[1] + run[2] - k + 1 == j:
+                run[2] += 1
+            else:
+                run = [i, j, k]
+                open_runs[diag] = run
+                runs.append(run)
+        if not runs:
+            return []
+
+        runs.sort()
+        best_score = []
+        prev = []
+        best = 0
+        for b, (bi, bj, blen) in enumerate(runs):
+            s_best = blen
+            p_best = None
+            for a in range(b):
+                ai, aj, alen = runs[a]
+                if not (ai < bi and aj < bj and ai + alen <= bi + blen and aj + alen <= bj + blen):
+                    continue
+                overlap = max(ai + alen - bi, aj + alen - bj, 0)
+                s = best_score[a] + blen - overlap - abs((bj - bi) - (aj - ai))
+                if s > s_best:
+                    s_best = s
+                    p_best = a
+            best_score.append(s_best)
+            prev.append(p_best)
+            if s_best > best_score[best]:
+                best = b
+
+        chain = []
+        b = best
+        while b is not None:
+            chain.append(list(runs[b]))
+            b = prev[b]
+        chain.reverse()
+
+        blocks = []
+        for run in chain:
+            if blocks:
+                pi, pj, plen = blocks[-1]
+                over = max(pi + plen - run[0], pj + plen - run[1])
+                if over > 0:
+                    run = [run[0] + over, run[1] + over, run[2] - over]
+                if run[2] <= 0:
+                    continue
+            blocks.append(run)
+        return blocks
+
+    def align(self, query):
+        """ Align query to the reference.
+
+        Returns (ins, cols): cols[i] is the query character aligned to
+        reference position i, or "-", and ins[i] the query characters
+        inserted before reference position i (ins[len] after the end).
+        """
+
+        ref = self.useq
+        uquery = query.upper()
+        blocks = self.anchors(uquery)
+
+        pairs = []
+        if not blocks:
+            #
+            # Nothing to anchor on (an all-N consensus, say): lay the
+            # query along the start of the reference.
+            #
+            pairs.extend(ends(0, len(ref), 0, len(query), leading=False))
+        else:
+            fi, fj, flen = blocks[0]
+            pairs.extend(ends(0, fi, 0, fj, leading=True))
+            for n, (i, j, length) in enumerate(blocks):
+                pairs.extend((i + x, j + x) for x in range(length))
+                if n + 1 < len(blocks):
+                    ni, nj, nlen = blocks[n + 1]
+                    pairs.extend(global_align(ref, uquery, i + length, ni, j + length, nj))
+            li, lj, llen = blocks[-1]
+            pairs.extend(ends(li + llen, len(ref), lj + llen, len(query), leading=False))
+
+        ins = [[] for i in range(len(ref) + 1)]
+        cols = ["-"] * len(ref)
+        i = 0
+        for ri, qj in pairs:
+            if ri is None:
+                ins[i].append(query[qj])
+            else:
+                i = ri + 1
+                if qj is not None:
+                    cols[ri] = query[qj]
+        return ["".join(x) for x in ins], cols
+
+def ends(i0, i1, j0, j1, leading):
+    """ Align the unanchored ends ungapped against the anchor, with the excess as terminal gaps. """
+
+    n = i1 - i0
+    m = j1 - j0
+    common = min(n, m)
+    if leading:
+        pairs = [(None, j0 + x) for x in range(m - common)]
+        pairs += [(i0 + x, None) for x in range(n - common)]
+        pairs += [(i1 - common + x, j1 - common + x) for x in range(common)]
+    else:
+        pairs = [(i0 + x, j0 + x) for x in range(common)]
+        pairs += [(i0 + common + x, None) for x in range(n - common)]
+        pairs += [(None, j0 + common + x) for x in range(m - common)]
+    return pairs
+
+def global_align(ref, query, i0, i1, j0, j1):
+    """ Banded global affine gap alignment of ref[i0:i1] with query[j0:j1].
+
+    Returns (ref index, query index) pairs, with None for a gap. A
+    stretch too long to align within MAX_CELLS cells is laid out as the
+    unanchored ends are.
+    """
+
+    n = i1 - i0
+    m = j1 - j0
+    if n == m:
+        return [(i0 + x, j0 + x) for x in range(n)]
+    if n == 0:
+        return [(None, j0 + x) for x in range(m)]
+    if m == 0:
+        return [(i0 + x, None) for x in range(n)]
+
+    half = BAND + abs(n - m)
+    if n * min(m, 2 * half + 1) > MAX_CELLS:
+        return ends(i0, i1, j0, j1, leading=False)
+    open_ = GAP_OPEN + GAP_EXTEND
+    ext = GAP_EXTEND
+
+    #
+    # States: 0 match, 1 reference against a gap, 2 query against a gap.
+    # Cells outside the band are never set.
+    #
+    M = {(0, 0): 0}
+    D = {}
+    I = {}
+    tb = {}
+    for i in range(1, n + 1):
+        D[i, 0] = -(open_ + (i - 1) * ext)
+        tb[1, i, 0] = 1 if i > 1 else 0
+    for j in range(1, m + 1):
+        I[0, j] = -(open_ + (j - 1) * ext)
+        tb[2, 0, j] = 2 if j > 1 else 0
+
+    for i in range(1, n + 1):
+        mid = (m * i) // n
+        r = ref[i0 + i - 1]
+        for j in range(max(1, mid - half), min(m, mid + half) + 1):
+            d = (i - 1, j - 1)
+            s, t = M.get(d, NEG), 0
+            v = D.get(d, NEG)
+            if v > s:
+                s, t = v, 1
+            v = I.get(d, NEG)
+            if v > s:
+                s, t = v, 2
+            M[i, j] = s + score(r, query[j0 + j - 1])
+            tb[0, i, j] = t
+
+            u = (i - 1, j)
+            s, t = M.get(u, NEG) - open_, 0
+            v = D.get(u, NEG) - ext
+            if v > s:
+                s, t = v, 1
+            v = I.get(u, NEG) - open_
+            if v > s:
+                s, t = v, 2
+            D[i, j] = s
+            tb[1, i, j] = t
+
+            l = (i, j - 1)
+            s, t = M.get(l, NEG) - open_, 0
+            v = I.get(l, NEG) - ext
+            if v > s:
+                s, t = v, 2
+            v = D.get(l, NEG) - open_
+            if v > s:
+                s, t = v, 1
+            I[i, j] = s
+            tb[2, i, j] = t
+
+    end = (n, m)
+    state = max((M.get(end, NEG), 0), (D.get(end, NEG), 1), (I.get(end, NEG), 2))[1]
+    pairs = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        t = tb.get((state, i, j), 0)
+        if state == 0:
+            pairs.append((i0 + i - 1, j0 + j - 1))
+            i -= 1
+            j -= 1
+        elif state == 1:
+            pairs.append((i0 + i - 1, None))
+            i -= 1
+        else:
+            pairs.append((None, j0 + j - 1))
+            j -= 1
+        state = t
+    pairs.reverse()
+    return pairs
+
+def align_records(reference, records):
+    """ Return the aligned (header, sequence) rows for the reference and the query records. """
+
+    aligned = [reference.align(seq) for hdr, seq in records]
+    width = [max([len(ins[i]) for ins, cols in aligned] + [0]) for i in range(len(reference.seq) + 1)]
+
+    rows = [(reference.header, "".join("-" * width[i] + reference.seq[i] for i in range(len(reference.seq)))
+             + "-" * width[-1])]
+    for (hdr, seq), (ins, cols) in zip(records, aligned):
+        rows.append((hdr, "".join(ins[i].ljust(width[i], "-") + cols[i] for i in range(len(cols)))
+                     + ins[-1].ljust(width[-1], "-")))
+    return rows
+
+def write_alignment(rows, path, line_length=60):
+    """ Write aligned rows as mafft does: lowercase, line_length columns per line. """
+
+    with open(path, "w") as fh:
+        for hdr, seq in rows:
+            print(f">{hdr}", file=fh)
+            seq = seq.lower()
+            for i in range(0, len(seq), line_length):
+                print(seq[i:i + line_length], file=fh)
+
+def main():
+    parser = argparse.ArgumentParser(description="Align consensus sequences to a reference, writing mafft-style alignments")
+    parser.add_argument("--reference", required=True, help="Reference FASTA")
+    parser.add_argument("--list", help="File of consensus FASTA and output alignment path pairs, tab separated, one pair per line")
+    parser.add_argument("pairs", nargs="*", help="Consensus FASTA and output alignment paths, alternating")
+    args = parser.parse_args()
+
+    if len(args.pairs) % 2:
+        parser.error("consensus FASTA and output paths must come in pairs")
+    pairs = list(zip(args.pairs[0::2], args.pairs[1::2]))
+    if args.list:
+        with open(args.list) as fh:
+            pairs.extend(tuple(line.rstrip("\n").split("\t")[0:2]) for line in fh if line.strip())
+
+    reference = Reference.from_fasta(args.reference)
+
+    failed = 0
+    for fasta, output in pairs:
+        try:
+            write_alignment(align_records(reference, read_fasta(fasta)), output)
+        except Exception as e:
+            print(f"Error aligning {fasta}: {e!r}", file=sys.stderr)
+            failed += 1
+
+    return 1 if failed else 0
@@ -0,0 +1,203 @@
+#
+# Depth statistics and coverage plots for a SARS2 assembly.
+#
+# This replaces the tail end of sars2-onecodex, which wrote samtools depth
+# output to a file, re-read it with PDL to compute the depth statistics, and
+# ran gnuplot three times to draw the coverage plots. Here we read the depth
+# once into a NumPy array and compute and plot everything in one process.
+#
+
+import argparse
+import subprocess
+import sys
+from array import array
+
+import numpy as np
+
+def depth_from_bam(bam, depth_output=None):
+    """ Stream samtools depth output for the given BAM into position and depth arrays.
+
+    If depth_output is given, the raw depth text is also written there
+    so that the .depth file remains available as an output.
+    """
+
+    proc = subprocess.Popen(["samtools", "depth", str(bam)], stdout=subprocess.PIPE)
+    try:
+        if depth_output:
+            with open(depth_output, "wb") as copy:
+                pos, depth = parse_depth(proc.stdout, copy)
+        else:
+            pos, depth = parse_depth(proc.stdout)
+    finally:
+        proc.stdout.close()
+        ret = proc.wait()
+    if ret != 0:
+        raise RuntimeError(f"samtools depth {bam} failed with {ret}")
+    return pos, depth
+
+def read_depth_file(path):
+    with open(path, "rb") as f:
+        return parse_depth(f)
+
+def parse_depth(lines, copy=None):
+    """ Parse samtools depth lines (contig, position, depth) into position and depth arrays.
+
+    If copy is given, each line is also written to it.
+    """
+
+    pos = array("q")
+    depth = array("q")
+    for line in lines:
+        if copy:
+            copy.write(line)
+        cols = line.split()
+        if len(cols) < 3:
+            continue
+        pos.append(int(cols[1]))
+        depth.append(int(cols[2]))
+    return np.array(pos, dtype=np.int64), np.array(depth, dtype=np.int64)
+
+def depth_statistics(depth):
+    """ Return the depth statistics as (key, formatted value) pairs.
+
+    The formatting follows what sars2-onecodex wrote from PDL: the
+    standard deviation is the population value.
+    """
+
+    return [
+        ("depth_mean", f"{depth.mean():.1f}"),
+        ("depth_median", f"{np.median(depth):.1f}"),
+        ("depth_stdv", f"{depth.std():.1f}"),
+        ("depth_min", f"{depth.min():d}"),
+        ("depth_max", f"{depth.max():d}"),
+        ]
+
+def read_first_fasta_seq(path):
+    seq = []
+    seen = False
+    with open(path) as f:
+        for line in f:
+            if line.startswith(">"):
+                if seen:
+                    break
+                seen = True
+                continue
+            seq.append(line.strip())
+    return "".join(seq)
+
+def n_statistics(seq):
+    """ Return the number of N bases and the number of N blocks in seq. """
+
+    s = np.frombuffer(seq.upper().encode(), dtype=np.uint8) == ord("N")
+    n_count = int(s.sum())
+    #
+    # A block starts wherever an N follows a non-N (or the start of the sequence).
+    #
+    n_blocks = 0
+    if len(s):
+        n_blocks = int(np.count_nonzero(s[1:] & ~s[:-1])) + int(s[0])
+    return n_count, n_blocks
+
+def count_variants(path):
+    with open(path) as f:
+        f.readline()
+        return sum(1 for _ in f)
+
+def plotting_available():
+    """ Return True if matplotlib, which only the plots need, can be imported. """
+
+    try:
+        import matplotlib
+    except ImportError:
+        return False
+    return True
+
+def plot_coverage(pos, depth, base, out_dir):
+    """ Write the linear, detail and log coverage plots. """
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    title = f"Coverage depth for {base}"
+
+    def new_plot(ylabel):
+        fig, ax = plt.subplots(figsize=(6.4, 4.8), dpi=100)
+        ax.set_xlabel("Position")
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+        return fig, ax
+
+    fig, ax = new_plot("Depth")
+    ax.vlines(pos, 0, depth, linewidth=0.5)
+    ax.set_ylim(bottom=0)
+    fig.savefig(f"{out_dir}/{base}.png")
+
+    ax.set_ylim(0, 250)
+    fig.savefig(f"{out_dir}/{base}.detail.png")
+    plt.close(fig)
+
+    fig, ax = new_plot("Log Depth")
+    nz = depth > 0
+    ax.plot(pos[nz], depth[nz], linewidth=0.5)
+    ax.set_yscale("log")
+    fig.savefig(f"{out_dir}/{base}.log.png")
+    plt.close(fig)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute depth statistics and coverage plots for a SARS2 assembly")
+    parser.add_argument("base", nargs="?", help="Output base name")
+    parser.add_argument("out_dir", nargs="?", help="Output directory")
+    parser.add_argument("--check-plots", action="store_true",
+                        help="Only check that the coverage plots can be drawn; exit nonzero if matplotlib is missing")
+    src = parser.add_mutually_exclusive_group()
+    src.add_argument("--bam", help="Compute depth from this BAM using samtools depth")
+    src.add_argument("--depth", help="Read depth from this samtools depth output file")
+    parser.add_argument("--depth-output", help="When reading from a BAM, also save the depth output here")
+    parser.add_argument("--fasta", help="Consensus FASTA for N statistics")
+    parser.add_argument("--variants", help="ivar variants TSV for the variant count")
+    parser.add_argument("--stat", nargs=2, action="append", default=[], metavar=("KEY", "VALUE"),
+                        help="Additional statistic to write to the statistics file")
+    parser.add_argument("--no-plots", action="store_true", help="Do not create coverage plots")
+    args = parser.parse_args(argv)
+
+    if args.check_plots:
+        return 0 if plotting_available() else 1
+    if not (args.base and args.out_dir and (args.bam or args.depth)):
+        parser.error("base, out_dir and one of --bam or --depth are required")
+    if not args.no_plots and not plotting_available():
+        parser.error("matplotlib is required for the coverage plots; install it or pass --no-plots")
+
+    if args.bam:
+        pos, depth = depth_from_bam(args.bam, args.depth_output)
+    else:
+        pos, depth = read_depth_file(args.depth)
+
+    if len(depth) > 0 and not args.no_plots:
+        plot_coverage(pos, depth, args.base, args.out_dir)
+
+    stats_file = f"{args.out_dir}/{args.base}.statistics.tsv"
+    with open(stats_file, "w") as out:
+        try:
+            for key, val in depth_statistics(depth):
+                print(f"{key}\t{val}", file=out)
+
+            if args.fasta:
+                seq = read_first_fasta_seq(args.fasta)
+                n_count, n_blocks = n_statistics(seq)
+                print(f"n_count\t{n_count}", file=out)
+                print(f"n_blocks\t{n_blocks}", file=out)
+                print(f"fasta_length\t{len(seq)}", file=out)
+
+            for key, val in args.stat:
+                print(f"{key}\t{val}", file=out)
+
+            if args.variants:
+                print(f"variant_count\t{count_variants(args.variants)}", file=out)
+        except (ValueError, OSError) as e:
+            print(f"Error processing statistics: {e}", file=sys.stderr)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#
+# Convert ivar variants.tsv files to GTO variant records.
+#
+# This is the Python counterpart of Bio::P3::SARS2Assembly::add_variants_to_gto,
+# for re-processing many samples at once. The reference CDS features are
+# read once into a position -> CDS array, and the variant positions of a
+# whole batch of samples are looked up in one vectorized step. The records
+# are the same as the Perl code writes: for each CDS (or Intergenic) the
+# list of SNPs, with the amino acid change and position in the protein for
+# nonsynonymous changes in a CDS.
+#
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+REFERENCE_GFF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "Bio", "P3", "SARS2Assembly", "GCF_009858895.2_ASM985889v3_genomic.gff")
+
+TOOL = "assembly pipeline"
+
+class CdsIndex:
+    """ Reference CDS features indexed by genome position.
+
+    owner[pos] is the index in cds of the first CDS, in GFF order, with
+    start <= pos < end, or -1 if there is none.
+    """
+
+    def __init__(self, gff=REFERENCE_GFF):
+        self.cds = []
+        self.genes = {}
+        with open(gff) as fh:
+            for line in fh:
+                if line.startswith("#"):
+                    continue
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) < 9 or cols[2] != "CDS":
+                    continue
+                attrs = {}
+                for att in cols[8].split(";"):
+                    key, _, val = att.partition("=")
+                    attrs[key] = val
+                self.genes[attrs.get("ID")] = attrs.get("gene")
+                self.cds.append((int(cols[3]), int(cols[4]), attrs.get("ID")))
+
+        size = max((end for start, end, id in self.cds), default=0) + 1
+        self.owner = np.full(size, -1, dtype=np.int32)
+        for i in reversed(range(len(self.cds))):
+            start, end, id = self.cds[i]
+            self.owner[start:end] = i
+        self.starts = np.array([start for start, end, id in self.cds], dtype=np.int64)
+
+    def lookup(self, pos):
+        """ Return the CDS index for each position in the array pos (-1 if intergenic). """
+
+        found = np.full(len(pos), -1, dtype=np.int32)
+        ok = (pos >= 0) & (pos < len(self.owner))
+        found[ok] = self.owner[pos[ok]]
+        return found
+
+def _number(text):
+    """ Numeric value of text as Perl's 0 + text would give it. """
+
+    try:
+        val = float(text)
+    except ValueError:
+        return 0
+    return int(val) if val.is_integer() else val
+
+def _perl_true(text):
+    return text not in (None, "", "0")
+
+def read_variants(path):
+    with open(path, newline="") as fh:
+        return list(csv.DictReader(fh, delimiter="\t"))
+
+def variant_records(index, variant_files):
+    """ Return the GTO variant list for each of the variants.tsv files. """
+
+    tables = [read_variants(path) for path in variant_files]
+    rows = [row for table in tables for row in table]
+    pos = np.array([_number(row["POS"]) for row in rows], dtype=np.int64)
+    owner = index.lookup(pos)
+    feature_pos = np.where(owner >= 0, (pos - index.starts[np.maximum(owner, 0)]) // 3 + 1, 0)
+
+    records = []
+    k = 0
+    for table in tables:
+        snplist = {}
+        for row in table:
+            snp = {
+                "pos": int(pos[k]),
+                "ref": row["REF"],
+                "alt": row["ALT"],
+                "freq": _number(row["ALT_FREQ"]),
+                }
+            if owner[k] >= 0:
+                if _perl_true(row.get("REF_AA")):
+                    snp["ref_aa"] = row["REF_AA"]
+                    snp["alt_aa"] = row.get("ALT_AA")
+                    snp["feature_pos"] = int(feature_pos[k])
+                id = index.cds[owner[k]][2]
+            else:
+                id = "Intergenic"
+            snplist.setdefault(id, []).append(snp)
+            k += 1
+
+        records.append([{"reference": id, "gene": index.genes.get(id), "snps": snplist[id]}
+                        for id in sorted(snplist)])
+    return records
+
+def add_variants(gto, variants, replace=False):
+    """ Add a variant list to a GTO dict, optionally replacing an earlier one from the assembly pipeline. """
+
+    computed = gto.setdefault("computed_variants", [])
+    if replace:
+        computed[:] = [v for v in computed if v.get("tool") != TOOL]
+    computed.append({"tool": TOOL, "variants": variants})
+
+def main():
+    parser = argparse.ArgumentParser(description="Add variants.tsv files to GTOs as computed variants")
+    parser.add_argument("--gff", default=REFERENCE_GFF, help="Reference GFF")
+    parser.add_argument("--list", help="File of variants.tsv and GTO path pairs, tab separated, one pair per line")
+    parser.add_argument("--batch", type=int, default=1000, help="Samples per vectorized lookup")
+    parser.add_argument("--replace", action="store_true", help="Replace variants from an earlier run of the assembly pipeline")
+    parser.add_argument("pairs", nargs="*", help="variants.tsv and GTO paths, alternating")
+    args = parser.parse_args()
+
+    if len(args.pairs) % 2:
+        parser.error("variants.tsv and GTO paths must come in pairs")
+    pairs = list(zip(args.pairs[0::2], args.pairs[1::2]))
+    if args.list:
+        with open(args.list) as fh:
+            pairs.extend(tuple(line.rstrip("\n").split("\t")[0:2]) for line in fh if line.strip())
+
+    index = CdsIndex(args.gff)
+
+    for i in range(0, len(pairs), args.batch):
+        batch = pairs[i:i + args.batch]
+        records = variant_records(index, [variants for variants, gto in batch])
+        for (variants, gto_path), variant_list in zip(batch, records):
+            with open(gto_path) as fh:
+                gto = json.load(fh)
+            add_variants(gto, variant_list, args.replace)
+            tmp = f"{gto_path}.tmp"
+            with open(tmp, "w") as fh:
+                json.dump(gto, fh, sort_keys=True)
+            os.rename(tmp, gto_path)
+        print(f"{i + len(batch)} of {len(pairs)} GTOs updated", file=sys.stderr)
+
+    return 0
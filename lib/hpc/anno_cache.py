@@ -0,0 +1,197 @@
+#
+# Annotation cache keyed on the consensus sequence.
+#
+# Clonal outbreaks and resequenced libraries give many runs whose consensus
+# sequences are identical, and annotating those again gives the same
+# features. The cache maps a hash of the normalized consensus (contig
+# sequences in order, uppercased, whitespace removed) plus the VIGOR
+# workflow definition (vigor.wf) to the annotation of the first sample with
+# that sequence. On a hit we build the sample's GTO from its own raw GTO,
+# which carries its metadata and accession, and the cached features.
+#
+# Entries are files in a shared directory, written to a temporary name and
+# renamed into place so readers on other nodes never see a partial entry.
+# A hit sets the entry's mtime, and when the directory grows past its size
+# bound the entries with the oldest mtime are removed; atime is not
+# reliable on our shared filesystems. Eviction racing with a reader on
+# another node only turns a hit into a miss.
+#
+
+import hashlib
+import json
+import os
+import threading
+
+WORKFLOW = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bio", "P3", "SARS2Assembly", "vigor.wf")
+
+def sequence_hash(fasta):
+    """ Return the hash of the normalized sequences in fasta, or None if it has none. """
+
+    seqs = []
+    cur = []
+    with open(fasta) as fh:
+        for line in fh:
+            if line.startswith(">"):
+                if cur:
+                    seqs.append("".join(cur))
+                cur = []
+            else:
+                cur.append("".join(line.split()).upper())
+    if cur:
+        seqs.append("".join(cur))
+    seqs = [s for s in seqs if s]
+    if not seqs:
+        return None
+    return hashlib.sha256(">".join(seqs).encode()).hexdigest()
+
+class AnnotationCache:
+    """ Shared annotation cache in directory path, bounded to about max_bytes. """
+
+    def __init__(self, path, max_bytes, workflow=WORKFLOW):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+        with open(workflow, "rb") as fh:
+            self.salt = hashlib.sha256(fh.read()).hexdigest()
+
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.stored_bytes = 0
+
+    def key(self, fasta):
+        seq = sequence_hash(fasta)
+        if seq is None:
+            return None
+        return hashlib.sha256(f"{seq}\t{self.salt}".encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[0:2], f"{key}.json")
+
+    def get(self, key):
+        """ Return the cached entry for key, or None. Counts toward the hit rate. """
+
+        entry = None
+        if key:
+            path = self._entry(key)
+            try:
+                with open(path) as fh:
+                    entry = json.load(fh)
+                os.utime(path)
+            except (OSError, ValueError):
+                entry = None
+
+        with self.lock:
+            self.lookups += 1
+            if entry:
+                self.hits += 1
+        return entry
+
+    def put(self, key, raw_gto, gto, elapsed):
+        """ Store the annotation that turned raw_gto into gto, which took elapsed seconds. """
+
+        if not key:
+            return
+        with open(raw_gto) as fh:
+            raw = json.load(fh)
+        with open(gto) as fh:
+            annotated = json.load(fh)
+
+        n_events = len(raw.get("analysis_events", []))
+        entry = {
+            "elapsed": elapsed,
+            "genome_id": annotated.get("id"),
+            "contig_ids": [c["id"] for c in annotated.get("contigs", [])],
+            "features": annotated.get("features", []),
+            "analysis_events": annotated.get("analysis_events", [])[n_events:],
+            "added": {k: v for k, v in annotated.items()
+                      if k not in raw and k not in ("features", "analysis_events")},
+            }
+
+        path = self._entry(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w") as fh:
+            json.dump(entry, fh)
+        size = os.path.getsize(tmp)
+        os.rename(tmp, path)
+
+        #
+        # Walking the whole cache is expensive on a shared filesystem, so
+        # only check the size after we have added a tenth of the bound.
+        #
+        with self.lock:
+            self.stored_bytes += size
+            check = self.stored_bytes > self.max_bytes / 10
+            if check:
+                self.stored_bytes = 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the cache is within 90% of its bound. """
+
+        entries = []
+        total = 0
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for ent in os.scandir(sub.path):
+                try:
+                    st = ent.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, ent.path))
+                total += st.st_size
+
+        if total <= self.max_bytes:
+            return 0
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+        return removed
+
+    def hit_rate(self):
+        with self.lock:
+            return self.hits / self.lookups if self.lookups else 0.0
+
+def apply(entry, raw_gto, gto):
+    """ Write gto from raw_gto and a cached annotation entry.
+
+    The raw GTO's contigs have the same sequences as the cached genome's,
+    in the same order, so features move to the corresponding contig, and
+    feature ids take the new genome's id.
+    """
+
+    with open(raw_gto) as fh:
+        genome = json.load(fh)
+
+    contig_map = dict(zip(entry["contig_ids"], [c["id"] for c in genome.get("contigs", [])]))
+    old_id = entry["genome_id"]
+    new_id = genome.get("id")
+
+    features = []
+    for feature in entry["features"]:
+        feature = dict(feature)
+        feature["location"] = [[contig_map.get(loc[0], loc[0])] + list(loc[1:]) for loc in feature.get("location", [])]
+        if old_id and new_id and old_id in feature.get("id", ""):
+            feature["id"] = feature["id"].replace(old_id, new_id, 1)
+        features.append(feature)
+
+    genome["features"] = genome.get("features", []) + features
+    genome["analysis_events"] = genome.get("analysis_events", []) + entry["analysis_events"]
+    genome.update(entry["added"])
+
+    tmp = f"{gto}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(genome, fh, sort_keys=True)
+    os.rename(tmp, gto)
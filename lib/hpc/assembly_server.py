@@ -0,0 +1,87 @@
+#
+# Client for sars2-assembly-server.
+#
+# The server holds the modules used by sars2-onecodex, p3x-create-sars-gto
+# and p3x-annotate-vigor4 already loaded and forks a process per job, so a
+# sample does not pay the perl and PDL startup for each of its three
+# commands. A job is one JSON line over a Unix socket; the reply is one
+# JSON line with the exit status once the job finishes.
+#
+
+import json
+import os
+import socket
+import subprocess
+import time
+
+class Client:
+    """ Run commands on a sars2-assembly-server listening at socket_path. """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def run(self, cmd, stdout, stderr, cwd=None, append=False, cpus=None, env=None):
+        """ Run cmd (a command name and its arguments) on the server.
+
+        stdout and stderr are the paths the command's output goes to.
+        The command runs with env as its environment, by default ours,
+        as it would if we had started it ourselves.
+        Returns the exit status, as subprocess would report it: negative
+        for a command killed by a signal. Raises OSError if the server
+        cannot be reached.
+        """
+
+        job = {
+            "command": cmd[0],
+            "args": [str(a) for a in cmd[1:]],
+            "cwd": os.path.abspath(cwd) if cwd else os.getcwd(),
+            "stdout": os.path.abspath(stdout),
+            "stderr": os.path.abspath(stderr),
+            "append": 1 if append else 0,
+            "env": dict(os.environ if env is None else env),
+            }
+        if cpus:
+            job["cpus"] = sorted(cpus)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(self.socket_path)
+            conn.sendall(json.dumps(job).encode() + b"\n")
+            reply = conn.makefile("rb").readline()
+        if not reply:
+            raise ConnectionError(f"assembly server at {self.socket_path} closed the connection running {cmd[0]}")
+
+        res = json.loads(reply)
+        if res.get("error"):
+            raise ConnectionError(f"assembly server cannot run {cmd[0]}: {res['error']}")
+        if res["signal"]:
+            return -res["signal"]
+        return res["status"]
+
+def start(socket_path, script_dirs=(), scripts=(), log_path=None, timeout=300):
+    """ Start a sars2-assembly-server at socket_path and wait until it is listening.
+
+    scripts are the commands it may run, by default the server's own
+    list. Returns the Popen for the server.
+    """
+
+    cmd = ["sars2-assembly-server", "--socket", socket_path]
+    for d in script_dirs:
+        cmd.extend(["--script-dir", d])
+    for s in scripts:
+        cmd.extend(["--script", s])
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    log = open(log_path, "w") if log_path else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, stdout=log, stderr=log)
+
+    deadline = time.time() + timeout
+    while not os.path.exists(socket_path):
+        if proc.poll() is not None:
+            raise RuntimeError(f"assembly server exited with status {proc.returncode}")
+        if time.time() > deadline:
+            proc.terminate()
+            raise RuntimeError(f"assembly server did not start listening on {socket_path}")
+        time.sleep(0.1)
+    return proc
@@ -0,0 +1,182 @@
+#
+# In-process stand-in for the small part of the redis client API the
+# bebop work queue uses, so that the feeders and the reliable queue can be
+# exercised on a workstation without a redis server:
+#
+#   from hpc.local_redis import LocalRedis
+#   conn = LocalRedis()
+#
+# It is thread-safe and keeps everything in memory. Values are stored as
+# bytes, as the real client returns them.
+#
+
+import collections
+import fnmatch
+import threading
+import time
+
+def _b(v):
+    if isinstance(v, bytes):
+        return v
+    return str(v).encode()
+
+class LocalRedis:
+
+    def __init__(self):
+        self.lists = collections.defaultdict(collections.deque)
+        self.zsets = collections.defaultdict(dict)
+        self.cond = threading.Condition()
+
+    #
+    # Keys
+    #
+
+    def delete(self, *keys):
+        n = 0
+        with self.cond:
+            for key in keys:
+                n += bool(self.lists.pop(key, None)) + bool(self.zsets.pop(key, None))
+        return n
+
+    def scan_iter(self, match="*"):
+        with self.cond:
+            keys = [k for k, v in self.lists.items() if v] + [k for k, v in self.zsets.items() if v]
+        return iter([_b(k) for k in keys if fnmatch.fnmatchcase(k, match)])
+
+    #
+    # Lists
+    #
+
+    def lpush(self, key, *values):
+        with self.cond:
+            for v in values:
+                self.lists[key].appendleft(_b(v))
+            self.cond.notify_all()
+            return len(self.lists[key])
+
+    def rpush(self, key, *values):
+        with self.cond:
+            self.lists[key].extend(_b(v) for v in values)
+            self.cond.notify_all()
+            return len(self.lists[key])
+
+    def _pop(self, key, end, count):
+        lst = self.lists.get(key)
+        if not lst:
+            return None
+        take = lst.popleft if end == "LEFT" else lst.pop
+        if count is None:
+            return take()
+        return [take() for _ in range(min(count, len(lst)))]
+
+    def lpop(self, key, count=None):
+        with self.cond:
+            return self._pop(key, "LEFT", count)
+
+    def rpop(self, key, count=None):
+        with self.cond:
+            return self._pop(key, "RIGHT", count)
+
+    def llen(self, key):
+        with self.cond:
+            return len(self.lists.get(key, ()))
+
+    def lrange(self, key, start, end):
+        with self.cond:
+            lst = list(self.lists.get(key, ()))
+        if end == -1:
+            return lst[start:]
+        return lst[start:end + 1]
+
+    def lrem(self, key, count, value):
+        value = _b(value)
+        with self.cond:
+            lst = self.lists.get(key)
+            if not lst:
+                return 0
+            n = 0
+            while (count == 0 or n < abs(count)) and value in lst:
+                lst.remove(value)
+                n += 1
+            return n
+
+    def lmove(self, src, dest, src_end="LEFT", dest_end="RIGHT"):
+        with self.cond:
+            v = self._pop(src, src_end.upper(), None)
+            if v is None:
+                return None
+            if dest_end.upper() == "LEFT":
+                self.lists[dest].appendleft(v)
+            else:
+                self.lists[dest].append(v)
+            self.cond.notify_all()
+            return v
+
+    def blmove(self, src, dest, timeout, src_end="LEFT", dest_end="RIGHT"):
+        deadline = time.time() + timeout if timeout else None
+        with self.cond:
+            while not self.lists.get(src):
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return self.lmove(src, dest, src_end, dest_end)
+
+    #
+    # Sorted sets
+    #
+
+    def zadd(self, key, mapping):
+        with self.cond:
+            z = self.zsets[key]
+            n = sum(1 for m in mapping if _b(m) not in z)
+            for m, score in mapping.items():
+                z[_b(m)] = float(score)
+            return n
+
+    def zrem(self, key, *members):
+        with self.cond:
+            z = self.zsets.get(key, {})
+            return sum(1 for m in members if z.pop(_b(m), None) is not None)
+
+    def zscore(self, key, member):
+        with self.cond:
+            return self.zsets.get(key, {}).get(_b(member))
+
+    def zrangebyscore(self, key, lo, hi):
+        with self.cond:
+            z = self.zsets.get(key, {})
+            return [m for m, s in sorted(z.items(), key=lambda x: x[1]) if lo <= s <= hi]
+
+    #
+    # Pipelines run their commands immediately; execute returns the results.
+    #
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+class _Pipeline:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.conn, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.conn.cond:
+            results = [m(*a, **kw) for m, a, kw in self.calls]
+        self.calls = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.calls = []
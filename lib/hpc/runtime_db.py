@@ -0,0 +1,241 @@
+#
+# Runtime history database.
+#
+# Every sample directory under an output tree (<base>/<prefix7>/<SRA>/, the
+# layout bebop-check-status walks) gets RUNTIME, ANNO_RUNTIME and meta.json
+# files from the compute workers. This module gathers those into a single
+# SQLite table so that we can answer throughput, per-host, per-stage and
+# size-versus-time questions without walking millions of small files each time.
+#
+# Scans are incremental. A prefix directory is skipped when its mtime has not
+# changed since the last scan and every sample in it had a meta.json then
+# (meta.json is written last, so such a prefix holds nothing new); a sample is
+# only re-read when its meta.json is newer than what we recorded.
+#
+
+import concurrent.futures
+import json
+import os
+import sqlite3
+import statistics
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    sra TEXT,
+    prefix TEXT,
+    base TEXT,
+    run_index INTEGER,
+    host TEXT,
+    slurm_job TEXT,
+    slurm_task TEXT,
+    slurm_cluster TEXT,
+    asm_start REAL,
+    asm_end REAL,
+    asm_elapsed REAL,
+    anno_start REAL,
+    anno_end REAL,
+    anno_elapsed REAL,
+    threads INTEGER,
+    input_bytes INTEGER,
+    meta_mtime REAL,
+    PRIMARY KEY (base, sra)
+);
+CREATE INDEX IF NOT EXISTS runs_base_prefix ON runs(base, prefix);
+CREATE INDEX IF NOT EXISTS runs_host ON runs(host);
+CREATE TABLE IF NOT EXISTS prefixes (
+    base TEXT,
+    prefix TEXT,
+    mtime REAL,
+    incomplete INTEGER,
+    scanned REAL,
+    PRIMARY KEY (base, prefix)
+);
+"""
+
+COLUMNS = ["sra", "prefix", "base", "run_index", "host", "slurm_job", "slurm_task", "slurm_cluster",
+           "asm_start", "asm_end", "asm_elapsed", "anno_start", "anno_end", "anno_elapsed",
+           "threads", "input_bytes", "meta_mtime"]
+
+def open_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+def _read_runtime(path):
+    try:
+        with open(path) as f:
+            cols = f.readline().split()
+        return [float(x) for x in cols[0:3]]
+    except (OSError, ValueError):
+        return None
+
+def read_sample_dir(base, prefix, sra, path):
+    """ Build a runs row from the runtime files in one sample directory, or None if there are none. """
+
+    row = dict.fromkeys(COLUMNS)
+    row.update(sra=sra, prefix=prefix, base=base)
+
+    meta_file = os.path.join(path, "meta.json")
+    try:
+        row["meta_mtime"] = os.stat(meta_file).st_mtime
+        with open(meta_file) as f:
+            md = json.load(f)
+        for key in ("run_index", "host", "slurm_job", "slurm_task", "slurm_cluster", "threads", "input_bytes"):
+            row[key] = md.get(key)
+        row["asm_elapsed"] = md.get("elapsed")
+        row["anno_elapsed"] = md.get("annotation_elapsed")
+    except (OSError, ValueError):
+        pass
+
+    rt = _read_runtime(os.path.join(path, "RUNTIME"))
+    if rt:
+        row["asm_start"], row["asm_end"], row["asm_elapsed"] = rt
+
+    #
+    # bebop-pipelined writes RUNTIME_ANNO; compute_all writes ANNO_RUNTIME.
+    #
+    rt = _read_runtime(os.path.join(path, "ANNO_RUNTIME")) or _read_runtime(os.path.join(path, "RUNTIME_ANNO"))
+    if rt:
+        row["anno_start"], row["anno_end"], row["anno_elapsed"] = rt
+
+    if row["asm_elapsed"] is None and row["anno_elapsed"] is None:
+        return None
+    return row
+
+def _scan_prefix(base, prefix, known):
+    """ Scan one prefix directory.
+
+    Returns the rows for samples that are new or changed, and the number
+    of samples that do not yet have a meta.json.
+    """
+
+    rows = []
+    incomplete = 0
+    pdir = os.path.join(base, prefix)
+    with os.scandir(pdir) as it:
+        for ent in it:
+            if not ent.is_dir():
+                continue
+            sra = ent.name
+            try:
+                mtime = os.stat(os.path.join(ent.path, "meta.json")).st_mtime
+            except OSError:
+                mtime = None
+                incomplete += 1
+            if sra in known and known[sra] is not None and (mtime is None or mtime <= known[sra]):
+                continue
+            row = read_sample_dir(base, prefix, sra, ent.path)
+            if row:
+                rows.append(row)
+    return rows, incomplete
+
+def scan(conn, bases, full=False, workers=16, log=None):
+    """ Incrementally load the runtime files from the given output trees.
+
+    Prefix directories are scanned in parallel with os.scandir; database
+    updates are made from this thread so the connection is not shared.
+    Returns the number of rows written.
+    """
+
+    prefix_state = {(b, p): (m, inc) for b, p, m, inc in
+                    conn.execute("SELECT base, prefix, mtime, incomplete FROM prefixes")}
+
+    todo = []
+    for base in bases:
+        with os.scandir(base) as it:
+            for ent in it:
+                if not ent.is_dir():
+                    continue
+                mtime = ent.stat().st_mtime
+                old = prefix_state.get((base, ent.name))
+                if full or old is None or mtime > old[0] or old[1]:
+                    todo.append((base, ent.name, mtime))
+
+    if log:
+        print(f"scanning {len(todo)} changed prefix directories", file=log)
+
+    written = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for base, prefix, mtime in todo:
+            known = {}
+            if not full:
+                known = dict(conn.execute("SELECT sra, meta_mtime FROM runs WHERE base = ? AND prefix = ?",
+                                          (base, prefix)))
+            futures[pool.submit(_scan_prefix, base, prefix, known)] = (base, prefix, mtime)
+
+        for fut in concurrent.futures.as_completed(futures):
+            base, prefix, mtime = futures[fut]
+            rows, incomplete = fut.result()
+            conn.executemany(f"INSERT OR REPLACE INTO runs ({', '.join(COLUMNS)}) "
+                             f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                             [[r[c] for c in COLUMNS] for r in rows])
+            conn.execute("INSERT OR REPLACE INTO prefixes (base, prefix, mtime, incomplete, scanned) "
+                         "VALUES (?, ?, ?, ?, ?)", (base, prefix, mtime, incomplete, time.time()))
+            written += len(rows)
+    conn.commit()
+    return written
+
+def _percentile(vals, pct):
+    if not vals:
+        return None
+    vals = sorted(vals)
+    k = min(len(vals) - 1, int(round(pct / 100 * (len(vals) - 1))))
+    return vals[k]
+
+def throughput(conn, bucket=3600):
+    """ Samples finished (assembly end) per time bucket: (bucket start, count, mean elapsed). """
+
+    return conn.execute("SELECT CAST(asm_end / ? AS INTEGER) * ? AS b, COUNT(*), AVG(asm_elapsed) "
+                        "FROM runs WHERE asm_end IS NOT NULL GROUP BY b ORDER BY b",
+                        (bucket, bucket)).fetchall()
+
+def hosts(conn):
+    """ Per-host sample count, mean assembly and annotation time, and samples per hour. """
+
+    out = []
+    for host, n, asm, anno, first, last in conn.execute(
+            "SELECT host, COUNT(*), AVG(asm_elapsed), AVG(anno_elapsed), MIN(asm_start), MAX(asm_end) "
+            "FROM runs GROUP BY host ORDER BY host"):
+        rate = None
+        if first is not None and last is not None and last > first:
+            rate = n / (last - first) * 3600
+        out.append((host, n, asm, anno, rate))
+    return out
+
+def stages(conn):
+    """ Count, mean, median and 95th percentile time for the assembly and annotation stages. """
+
+    out = []
+    for stage, col in (("assembly", "asm_elapsed"), ("annotation", "anno_elapsed")):
+        vals = [v for (v,) in conn.execute(f"SELECT {col} FROM runs WHERE {col} IS NOT NULL")]
+        if vals:
+            out.append((stage, len(vals), statistics.mean(vals), statistics.median(vals), _percentile(vals, 95)))
+        else:
+            out.append((stage, 0, None, None, None))
+    return out
+
+def size_vs_time(conn):
+    """ Assembly time against input size, in power-of-two size bins: (bin low bytes, count, mean elapsed, mean threads). """
+
+    bins = {}
+    for size, elapsed, threads in conn.execute("SELECT input_bytes, asm_elapsed, threads FROM runs "
+                                               "WHERE input_bytes > 0 AND asm_elapsed IS NOT NULL"):
+        b = 1 << (int(size).bit_length() - 1)
+        bins.setdefault(b, []).append((elapsed, threads))
+    out = []
+    for b in sorted(bins):
+        vals = bins[b]
+        thr = [t for _, t in vals if t is not None]
+        out.append((b, len(vals), statistics.mean(e for e, _ in vals), statistics.mean(thr) if thr else None))
+    return out
+
+def export_history(conn, fh):
+    """ Write a runtime history file (SRA id, total elapsed seconds) as read by sra_sample.read_runtime_history. """
+
+    n = 0
+    for sra, asm, anno in conn.execute("SELECT sra, asm_elapsed, anno_elapsed FROM runs WHERE asm_elapsed IS NOT NULL"):
+        print(f"{sra}\t{asm + (anno or 0)}", file=fh)
+        n += 1
+    return n
@@ -0,0 +1,73 @@
+#
+# Dynamic core scheduler for the compute workers.
+#
+# Rather than give every sample the same --n-app-threads, we size a
+# thread budget for each sample from the size of its input and admit it
+# against a node-wide pool of CPUs. Small samples get few cores, so several
+# of them can run in the space of one fixed slot; large samples get more
+# cores so they don't straggle at the end of an allocation.
+#
+
+import collections
+import math
+import os
+import threading
+
+def fastq_bytes(fq_files):
+    total = 0
+    for fq in fq_files:
+        try:
+            total += os.path.getsize(fq)
+        except OSError:
+            pass
+    return total
+
+class CoreScheduler:
+    """ Hand out CPUs from a fixed pool, sized by input bytes.
+
+    The budget for a sample is one thread per bytes_per_thread of input,
+    clamped to [min_threads, max_threads]. Admission is first come, first
+    served: a large sample waiting for cores is not starved by a stream
+    of small ones arriving after it.
+    """
+
+    def __init__(self, cpus, bytes_per_thread, min_threads=1, max_threads=None):
+        self.cpus = sorted(cpus)
+        self.free = list(self.cpus)
+        self.bytes_per_thread = bytes_per_thread
+        #
+        # Neither bound may exceed the pool, or acquire would wait forever.
+        #
+        self.max_threads = min(max_threads or len(self.cpus), len(self.cpus))
+        self.min_threads = max(1, min(min_threads, self.max_threads))
+        self.cond = threading.Condition()
+        self.waiting = collections.deque()
+
+    def threads_for(self, nbytes):
+        n = math.ceil(nbytes / self.bytes_per_thread) if nbytes > 0 else self.min_threads
+        return max(self.min_threads, min(self.max_threads, n))
+
+    def acquire(self, nbytes):
+        """ Block until the budget for a sample of nbytes is available; return the CPUs assigned. """
+
+        n = self.threads_for(nbytes)
+        ticket = object()
+        with self.cond:
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or len(self.free) < n:
+                self.cond.wait()
+            self.waiting.popleft()
+            cpus = self.free[:n]
+            del self.free[:n]
+            self.cond.notify_all()
+            return cpus
+
+    def release(self, cpus):
+        with self.cond:
+            self.free.extend(cpus)
+            self.free.sort()
+            self.cond.notify_all()
+
+    def in_use(self):
+        with self.cond:
+            return len(self.cpus) - len(self.free)
@@ -0,0 +1,87 @@
+#
+# Scratch space admission control.
+#
+# Each sample we extract with fasterq-dump needs room for the fasterq-dump
+# temporaries and the extracted fastq, and then for the sars2-onecodex
+# intermediates. With many samples in flight on a node nothing kept these
+# from filling /scratch (or the fastq temp directory) and failing every
+# sample on the node. A ScratchBudget holds a byte budget for that space;
+# a sample reserves its estimated footprint before extraction and releases
+# it when its fastq is deleted.
+#
+
+import re
+import shutil
+import threading
+
+def parse_size(text, path=None):
+    """ Parse a byte count such as 500G or 1.5T.
+
+    "auto" means 90% of the space free at path right now.
+    """
+
+    text = str(text).strip()
+    if text == "auto":
+        return int(shutil.disk_usage(path).free * 0.9)
+    m = re.match(r"^([\d.]+)\s*([KMGT]?)i?B?$", text, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Invalid size {text}")
+    mult = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}[m.group(2).upper()]
+    return int(float(m.group(1)) * mult)
+
+class ScratchBudget:
+    """ Byte budget for scratch space, shared by the threads of one process.
+
+    Reservations are admitted in arrival order. With backfill, a request
+    that fits is admitted even while an earlier, larger one is waiting, so
+    small samples keep the node busy while space for a big one frees up;
+    a waiting request stops further backfill once it has been passed over
+    max_bypass times, so it cannot be starved. A request larger than the
+    whole budget is admitted only when nothing else holds space.
+    """
+
+    def __init__(self, budget, backfill=True, max_bypass=8):
+        self.budget = budget
+        self.backfill = backfill
+        self.max_bypass = max_bypass
+        self.used = 0
+        self.held = {}
+        self.waiting = []
+        self.cond = threading.Condition()
+
+    def _fits(self, nbytes):
+        return self.used + nbytes <= self.budget or self.used == 0
+
+    def reserve(self, owner, nbytes):
+        """ Block until nbytes of scratch can be reserved for owner. """
+
+        req = [nbytes, 0]
+        with self.cond:
+            self.waiting.append(req)
+            while True:
+                if self._fits(nbytes):
+                    ahead = self.waiting[:self.waiting.index(req)]
+                    if not ahead:
+                        break
+                    if self.backfill and all(r[1] < self.max_bypass for r in ahead):
+                        for r in ahead:
+                            r[1] += 1
+                        break
+                self.cond.wait()
+            self.waiting.remove(req)
+            self.used += nbytes
+            self.held[owner] = self.held.get(owner, 0) + nbytes
+            self.cond.notify_all()
+
+    def release(self, owner):
+        """ Release everything reserved for owner. """
+
+        with self.cond:
+            nbytes = self.held.pop(owner, 0)
+            self.used -= nbytes
+            self.cond.notify_all()
+        return nbytes
+
+    def status(self):
+        with self.cond:
+            return self.used, self.budget, len(self.waiting)
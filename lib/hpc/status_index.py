@@ -0,0 +1,223 @@
+#
+# Status index for bebop output trees.
+#
+# Finding out which samples are done used to mean a stat of
+# <base>/<prefix7>/<SRA>/<SRA>.<suffix> for every sample. On a parallel
+# filesystem with millions of samples that takes tens of minutes.
+#
+# Instead each prefix directory holds a manifest, .status, to which workers
+# append one line per output when a sample finishes:
+#
+#   SRA <tab> suffix <tab> time
+#
+# Lines are short and written with a single O_APPEND write, so concurrent
+# writers on different nodes do not interleave. Reading the status of a tree
+# is then one open per prefix. Prefix directories without a manifest (trees
+# written before the index existed) are scanned with os.scandir, in
+# parallel; `bebop-status-index rebuild` writes their manifests so the next
+# read is fast. When a worker records the first entry in a prefix that has
+# no manifest, it creates the manifest from a scan of the prefix, so samples
+# finished before the index existed are not lost from it.
+#
+# Workers that create a sample directory append an entry for it too (with
+# suffix "-"), so the manifest stays at least as new as its prefix
+# directory while samples are in flight. A prefix directory that is newer
+# than its manifest has had a sample directory created by something that
+# does not record (bebop-run-chunk, the app scripts, reruns by hand) and is
+# scanned instead. Otherwise the manifest is trusted: outputs are recorded
+# only once they exist, so reading a prefix costs two stats and one open
+# however many samples it holds. Pass verify to check the entries against
+# the outputs themselves.
+#
+
+import concurrent.futures
+import os
+import socket
+import threading
+import time
+
+MANIFEST = ".status"
+
+#
+# Outputs looked for when a manifest is created from a scan.
+#
+SUFFIXES = ("fasta", "gto")
+
+#
+# Suffix of the entry recorded when a sample directory is created.
+#
+DIR_ENTRY = "-"
+
+def record(base, sra, suffixes):
+    """ Record in the prefix manifest that sample sra has outputs with the given suffixes. """
+
+    if not suffixes:
+        return
+    prefix = sra[0:7]
+    path = os.path.join(base, prefix, MANIFEST)
+    if not os.path.exists(path):
+        write_manifest(base, prefix, sorted((set(SUFFIXES) | set(suffixes)) - {DIR_ENTRY}), replace=False)
+
+    data = "".join(f"{sra}\t{suffix}\t{time.time():.0f}\n" for suffix in suffixes)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, data.encode())
+    finally:
+        os.close(fd)
+
+def create_sample_dir(base, sra):
+    """ Create the output directory for sample sra, recording it in the prefix manifest. """
+
+    path = os.path.join(base, sra[0:7], sra)
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+        record(base, sra, [DIR_ENTRY])
+    return path
+
+def record_outputs(base, sra, suffixes):
+    """ Record whichever of the given outputs exist and are non-empty for sample sra. """
+
+    sample_dir = os.path.join(base, sra[0:7], sra)
+    present = []
+    for suffix in suffixes:
+        try:
+            if os.stat(os.path.join(sample_dir, f"{sra}.{suffix}")).st_size > 0:
+                present.append(suffix)
+        except OSError:
+            pass
+    record(base, sra, present)
+    return present
+
+def read_manifest(base, prefix):
+    """ Return {sra: set(suffixes)} from a prefix manifest, or None if there is no manifest. """
+
+    status = {}
+    try:
+        with open(os.path.join(base, prefix, MANIFEST)) as fh:
+            for line in fh:
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) >= 2:
+                    status.setdefault(cols[0], set()).add(cols[1])
+    except FileNotFoundError:
+        return None
+    return status
+
+def scan_prefix(base, prefix, suffixes):
+    """ Find the outputs present in a prefix directory by walking it. """
+
+    status = {}
+    try:
+        it = os.scandir(os.path.join(base, prefix))
+    except FileNotFoundError:
+        return status
+    with it:
+        for ent in it:
+            if not ent.is_dir():
+                continue
+            for suffix in suffixes:
+                try:
+                    if os.stat(os.path.join(ent.path, f"{ent.name}.{suffix}")).st_size > 0:
+                        status.setdefault(ent.name, set()).add(suffix)
+                except OSError:
+                    pass
+    return status
+
+def _present(pdir, sra, suffix):
+    try:
+        return os.stat(os.path.join(pdir, sra, f"{sra}.{suffix}")).st_size > 0
+    except OSError:
+        return False
+
+def prefix_status(base, prefix, suffixes, ids=None, verify=False):
+    """ Return {sra: set(suffixes)} for the given outputs present in a prefix directory.
+
+    The manifest is used if it is at least as new as the directory. If
+    ids is given only those samples are returned; with verify their
+    manifest entries are checked against the outputs themselves.
+    """
+
+    pdir = os.path.join(base, prefix)
+    try:
+        dir_mtime = os.stat(pdir).st_mtime
+        manifest_mtime = os.stat(os.path.join(pdir, MANIFEST)).st_mtime
+    except OSError:
+        dir_mtime = manifest_mtime = None
+    status = None
+    if manifest_mtime is not None and dir_mtime <= manifest_mtime:
+        status = read_manifest(base, prefix)
+    if status is None:
+        status = scan_prefix(base, prefix, suffixes)
+        verify = False
+
+    wanted = set(suffixes)
+    result = {}
+    for sra, have in status.items():
+        if ids is not None and sra not in ids:
+            continue
+        have = have & wanted
+        if verify:
+            have = {suffix for suffix in have if _present(pdir, sra, suffix)}
+        if have:
+            result[sra] = have
+    return result
+
+def completed(bases, prefixes, suffix, workers=16, ids=None, verify=False):
+    """ Return the set of SRA ids under any of bases that have an output with the given suffix.
+
+    Only the given prefixes, and if given only the given ids, are examined.
+    Each (base, prefix) is read in a separate thread, from its manifest if
+    it has an up to date one. See prefix_status for verify.
+    """
+
+    if isinstance(bases, (str, os.PathLike)):
+        bases = [bases]
+    done = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(prefix_status, str(base), prefix, [suffix], ids, verify)
+                   for base in bases for prefix in prefixes]
+        for fut in concurrent.futures.as_completed(futures):
+            for sra, have in fut.result().items():
+                if suffix in have:
+                    done.add(sra)
+    return done
+
+def write_manifest(base, prefix, suffixes, replace=True):
+    """ Write the manifest for a prefix directory from a scan of its samples.
+
+    The manifest is written to a temporary file and moved into place. With
+    replace=False an existing manifest is left alone; the link either
+    creates the manifest complete or fails, so concurrent creators are safe.
+    """
+
+    status = scan_prefix(base, prefix, suffixes)
+    now = f"{time.time():.0f}"
+    path = os.path.join(base, prefix, MANIFEST)
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "w") as fh:
+        for sra in sorted(status):
+            for suffix in sorted(status[sra]):
+                print(f"{sra}\t{suffix}\t{now}", file=fh)
+    if replace:
+        os.rename(tmp, path)
+    else:
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        os.unlink(tmp)
+
+def rebuild(base, suffixes=SUFFIXES, workers=16, prefixes=None):
+    """ Rewrite the manifest of each prefix directory under base from a scan of its samples.
+
+    Lines appended by a worker while this runs may be lost, so rebuild
+    trees that are not being written to. Returns the number of prefixes rewritten.
+    """
+
+    if prefixes is None:
+        with os.scandir(base) as it:
+            prefixes = [ent.name for ent in it if ent.is_dir()]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for fut in [pool.submit(write_manifest, base, p, suffixes) for p in prefixes]:
+            fut.result()
+    return len(prefixes)
@@ -0,0 +1,64 @@
+#
+# Wire format for work items on the redis list.
+#
+# An item is a short tab-separated ASCII record with a leading schema
+# version:
+#
+#   1 <tab> SRA id <tab> run index <tab> size hint <tab> priority
+#
+# The size hint (estimated input bytes) and priority (estimated cost) may
+# be empty. Nothing about the consumer's output tree or the SraSample class
+# goes on the wire; the consumer builds its SraSample from the fields and
+# its own base directory. Other tools can enqueue work with e.g.
+#
+#   redis-cli lpush sra "$(printf '1\tSRR12345678\t1\t\t')"
+#
+# Items of any other version, including those pickled by older feeders,
+# are rejected; node 0 clears the list before it seeds, so none are left
+# from an earlier run.
+#
+
+import sra_sample
+
+VERSION = b"1"
+
+def encode(sra):
+    """ Encode an SraSample as a version 1 work item. """
+
+    size = getattr(sra, "size_hint", None)
+    cost = getattr(sra, "cost", None)
+    fields = [VERSION,
+              sra.id.encode(),
+              str(sra.idx).encode(),
+              b"" if size is None else str(int(size)).encode(),
+              b"" if cost is None else repr(float(cost)).encode()]
+    return b"\t".join(fields)
+
+def decode(data, base_dir):
+    """ Build an SraSample under base_dir from a work item. """
+
+    fields = data.split(b"\t")
+    if fields[0] != VERSION:
+        raise ValueError(f"work item {data[:40]!r} is not a version {VERSION.decode()} record "
+                         f"(pickled or newer items are not supported)")
+    if len(fields) < 3:
+        raise ValueError(f"short work item {data!r}")
+
+    sra = sra_sample.SraSample(fields[1].decode(), int(fields[2]), base_dir)
+    if len(fields) > 3 and fields[3]:
+        sra.size_hint = int(fields[3])
+    if len(fields) > 4 and fields[4]:
+        sra.cost = float(fields[4])
+    return sra
+
+class Codec:
+    """ dumps/loads pair for work_queue, decoding into a fixed output tree. """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def dumps(self, sra):
+        return encode(sra)
+
+    def loads(self, data):
+        return decode(data, self.base_dir)
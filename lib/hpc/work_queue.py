@@ -0,0 +1,253 @@
+#
+# Reliable redis work queue.
+#
+# The plain feeder pops samples off the "sra" list with RPOP; if the node
+# dies or hits its time limit after the pop, the sample is gone. Here a pop
+# atomically moves the sample to a processing list owned by this worker
+# (BLMOVE, redis 6.2 or later) and the worker holds a lease on that list,
+# renewed by a heartbeat thread. A sample leaves the processing list only
+# when it is acknowledged. Any worker's heartbeat also reaps the processing
+# lists of workers whose lease has expired, moving their samples back to the
+# dequeue end of the work list. At startup a worker also reaps processing
+# lists that have no lease at all, left by workers of an earlier run.
+#
+# Keys used, for a queue named sra:
+#
+#   sra                      the work list (seeded with LPUSH, popped from the right)
+#   sra:processing:<worker>  samples taken by <worker> and not yet acknowledged
+#   sra:leases               sorted set of worker -> lease expiry time
+#
+# A worker that stalls for longer than its lease without heartbeating has
+# its samples given to someone else; if it later finishes them they will
+# have been processed twice. Processing a sample is idempotent, so we
+# prefer that to losing it.
+#
+
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+
+def seed(conn, items, name="sra", chunk=1000, chunks_per_round_trip=10, codec=pickle):
+    """ Push items onto the work list so that they are dequeued in order.
+
+    Items go in chunk at a time with a multi-value LPUSH, and several
+    chunks are sent per round trip on a pipeline, rather than one LPUSH
+    round trip per item. Items are serialized with codec.dumps (see
+    work_item.Codec). Returns the number of items pushed.
+    """
+
+    n = 0
+    pipe = conn.pipeline(transaction=False)
+    pending = 0
+    for i in range(0, len(items), chunk):
+        batch = [codec.dumps(d) for d in items[i:i + chunk]]
+        pipe.lpush(name, *batch)
+        n += len(batch)
+        pending += 1
+        if pending >= chunks_per_round_trip:
+            pipe.execute()
+            pending = 0
+    if pending:
+        pipe.execute()
+    return n
+
+class ListSource:
+    """ The original behavior: pop with RPOP, no acknowledgement. """
+
+    def __init__(self, conn, name="sra", codec=pickle):
+        self.conn = conn
+        self.name = name
+        self.codec = codec
+
+    def pop(self):
+        pitem = self.conn.rpop(self.name)
+        if pitem is None:
+            return None
+        return self.codec.loads(pitem)
+
+    def pop_many(self, count):
+        """ Pop up to count items in one round trip (RPOP with a count, redis 6.2). """
+
+        if count <= 1:
+            item = self.pop()
+            return [item] if item is not None else []
+        pitems = self.conn.rpop(self.name, count)
+        return [self.codec.loads(p) for p in pitems or []]
+
+    def ack(self, item):
+        pass
+
+    def requeue(self, item):
+        self.conn.rpush(self.name, self.codec.dumps(item))
+
+    def close(self):
+        pass
+
+class ReliableQueue:
+    """ Work list consumer with a per-worker processing list and lease. """
+
+    def __init__(self, conn, name="sra", worker_id=None, lease_time=600, wait=0, codec=pickle):
+        self.conn = conn
+        self.name = name
+        self.codec = codec
+        self.worker_id = worker_id or f"{socket.gethostname()}.{os.getpid()}"
+        self.processing = f"{name}:processing:{self.worker_id}"
+        self.leases = f"{name}:leases"
+        self.lease_time = lease_time
+        self.wait = wait
+        #
+        # Raw payloads of the samples we hold, for LREM on ack. They are
+        # keyed by SRA id and run index, with a list per key, since a
+        # definition file may list an id more than once.
+        #
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.heartbeat_thread = None
+
+    def renew(self):
+        self.conn.zadd(self.leases, {self.worker_id: time.time() + self.lease_time})
+
+    def pop(self):
+        """ Take the next sample, or return None if the work list is empty.
+
+        If wait is set, block up to that many seconds for work to appear
+        (e.g. samples requeued by the reaper) before giving up.
+        """
+
+        self.renew()
+        if self.wait:
+            pitem = self.conn.blmove(self.name, self.processing, self.wait, "RIGHT", "LEFT")
+        else:
+            pitem = self.conn.lmove(self.name, self.processing, "RIGHT", "LEFT")
+        if pitem is None:
+            return None
+        item = self.codec.loads(pitem)
+        self._hold(item, pitem)
+        return item
+
+    def pop_many(self, count):
+        """ Take up to count samples, with the moves pipelined into one round trip. """
+
+        if count <= 1:
+            item = self.pop()
+            return [item] if item is not None else []
+
+        self.renew()
+        pipe = self.conn.pipeline(transaction=False)
+        for i in range(count):
+            pipe.lmove(self.name, self.processing, "RIGHT", "LEFT")
+        items = []
+        for pitem in pipe.execute():
+            if pitem is None:
+                continue
+            item = self.codec.loads(pitem)
+            self._hold(item, pitem)
+            items.append(item)
+        if not items and self.wait:
+            item = self.pop()
+            if item is not None:
+                items.append(item)
+        return items
+
+    def _hold(self, item, pitem):
+        with self.lock:
+            self.held.setdefault((item.id, getattr(item, "idx", None)), []).append(pitem)
+
+    def _release(self, item):
+        """ Return the payload we hold for item, or None. """
+
+        key = (item.id, getattr(item, "idx", None))
+        with self.lock:
+            payloads = self.held.get(key)
+            if not payloads:
+                return None
+            pitem = payloads.pop(0)
+            if not payloads:
+                del self.held[key]
+            return pitem
+
+    def ack(self, item):
+        """ Mark a sample as finished, removing it from our processing list. """
+
+        pitem = self._release(item)
+        if pitem is not None:
+            self.conn.lrem(self.processing, 1, pitem)
+
+    def requeue(self, item):
+        """ Return a sample we will not process to the dequeue end of the work list. """
+
+        pitem = self._release(item)
+        if pitem is None:
+            pitem = self.codec.dumps(item)
+        pipe = self.conn.pipeline()
+        pipe.lrem(self.processing, 1, pitem)
+        pipe.rpush(self.name, pitem)
+        pipe.execute()
+
+    def reap(self):
+        """ Requeue the samples of every worker whose lease has expired. Returns the number requeued. """
+
+        total = 0
+        for worker in self.conn.zrangebyscore(self.leases, 0, time.time()):
+            if isinstance(worker, bytes):
+                worker = worker.decode()
+            processing = f"{self.name}:processing:{worker}"
+            n = 0
+            while self.conn.lmove(processing, self.name, "RIGHT", "RIGHT") is not None:
+                n += 1
+            self.conn.zrem(self.leases, worker)
+            if n:
+                print(f"requeued {n} samples from expired worker {worker}", file=sys.stderr)
+            total += n
+        return total
+
+    def reap_orphans(self):
+        """ Requeue the samples on processing lists whose worker holds no lease. Returns the number requeued. """
+
+        total = 0
+        for key in self.conn.scan_iter(match=f"{self.name}:processing:*"):
+            if isinstance(key, bytes):
+                key = key.decode()
+            worker = key[len(self.name) + len(":processing:"):]
+            if worker == self.worker_id or self.conn.zscore(self.leases, worker) is not None:
+                continue
+            n = 0
+            while self.conn.lmove(key, self.name, "RIGHT", "RIGHT") is not None:
+                n += 1
+            if n:
+                print(f"requeued {n} samples from orphaned processing list of {worker}", file=sys.stderr)
+            total += n
+        return total
+
+    def start_heartbeat(self, interval=None):
+        """ Renew our lease and reap expired workers every interval seconds in a background thread. """
+
+        if interval is None:
+            interval = self.lease_time / 3
+
+        def beat():
+            while not self.stop.wait(interval):
+                try:
+                    self.renew()
+                    self.reap()
+                except Exception as e:
+                    print(f"heartbeat failed: {e!r}", file=sys.stderr)
+
+        self.reap()
+        self.reap_orphans()
+        self.heartbeat_thread = threading.Thread(target=beat, name="heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def close(self):
+        """ Stop the heartbeat, requeue anything still held, and drop our lease. """
+
+        self.stop.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join()
+        while self.conn.lmove(self.processing, self.name, "RIGHT", "RIGHT") is not None:
+            pass
+        self.conn.zrem(self.leases, self.worker_id)
@@ -0,0 +1,189 @@
+#
+# Batched annotation for compute_all.
+#
+# Annotating each sample with its own p3x-annotate-vigor4 run pays the
+# VIGOR4 startup and reference database load every time, which after the
+# assembly itself is the largest per-sample cost. Compute threads hand
+# assembled samples to an AnnotationBatcher, which collects up to
+# batch_size of them (or whatever has arrived max_wait seconds after the
+# first) and annotates them in one sars2-annotate-batch run, which splits
+# the result back into per-sample GTOs.
+#
+# If the batch run fails, its samples are annotated one at a time as
+# before, so one bad genome does not cost the rest of the batch. Samples
+# found in the annotation cache skip the batch.
+#
+
+import os
+import shutil
+import sys
+import threading
+import time
+
+import threadlog
+from hpc.worker import compute_all
+
+class AnnotationBatcher:
+    """ Collect assembled samples and annotate them in batches.
+
+    Samples are acknowledged to source once their annotation and meta.json
+    are written.
+    """
+
+    def __init__(self, batch_size, max_wait, work_dir, source=None, server=None, output_path=None, cache=None):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.work_dir = work_dir
+        self.source = source
+        self.server = server
+        self.output_path = output_path
+        self.cache = cache
+
+        self.pending = []
+        self.first_time = None
+        self.closing = False
+        self.cond = threading.Condition()
+        self.threads = []
+        self.n_batches = 0
+
+    def start(self, n_threads=1):
+        os.makedirs(self.work_dir, exist_ok=True)
+        for i in range(n_threads):
+            t = threading.Thread(target=self.worker, name=f"annotate-{i}")
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, item, md):
+        with self.cond:
+            if not self.pending:
+                self.first_time = time.time()
+            self.pending.append((item, md))
+            self.cond.notify_all()
+
+    def close(self):
+        """ Annotate whatever is still pending and wait for the annotation threads. """
+
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+
+    def _next_batch(self):
+        """ Wait for a full batch, or a partial one that has waited max_wait. Returns [] when closed. """
+
+        with self.cond:
+            while True:
+                if len(self.pending) >= self.batch_size:
+                    break
+                if self.pending and (self.closing or time.time() - self.first_time >= self.max_wait):
+                    break
+                if self.closing:
+                    return []
+                if self.pending:
+                    self.cond.wait(self.first_time + self.max_wait - time.time())
+                else:
+                    self.cond.wait()
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            self.first_time = time.time() if self.pending else None
+            self.n_batches += 1
+            return batch
+
+    def worker(self):
+        me = threading.current_thread().name
+
+        out_fh = sys.stdout
+        if self.output_path:
+            out_fh = threadlog.open_logger(self.output_path)
+
+        n = 0
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                print(f"{me} done", file=out_fh)
+                break
+            n += 1
+            self.annotate_batch(batch, f"{self.work_dir}/{me}-{os.getpid()}-{n}", out_fh)
+
+    def annotate_batch(self, batch, work_dir, out_fh):
+        me = threading.current_thread().name
+        print(f"{me} annotating {[item.id for item, md in batch]}", file=out_fh)
+
+        start = time.time()
+
+        #
+        # Samples whose raw GTO cannot be built fail on their own; the rest
+        # go in the batch unless the cache has them. Only the first of
+        # several samples with the same consensus goes in; the others are
+        # filled from the cache once it is annotated.
+        #
+        ready = []
+        cached = {}
+        keys = {}
+        duplicates = []
+        batch_keys = set()
+        cmd = ["sars2-annotate-batch", work_dir]
+        for item, md in batch:
+            rc = compute_all.create_raw_gto(item, out_fh, self.server)
+            if rc != 0:
+                print(f"Nonzero returncode {rc} creating GTO for {item.id}", file=out_fh)
+                continue
+            if self.cache:
+                keys[item.id], entry = compute_all.annotate_from_cache(item, self.cache, out_fh)
+                if entry:
+                    cached[item.id] = entry
+                    continue
+                if keys[item.id] in batch_keys:
+                    duplicates.append(item)
+                    continue
+                batch_keys.add(keys[item.id])
+            ready.append((item, md))
+            cmd.extend([f"{item.path}/{item.id}.raw.gto", f"{item.path}/{item.id}.gto"])
+
+        rc = 0
+        if ready:
+            print(cmd, file=out_fh)
+            rc = compute_all.run_command(cmd, f"{work_dir}.stdout", f"{work_dir}.stderr", out_fh)
+        end = time.time()
+
+        if rc == 0:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            for path in (f"{work_dir}.stdout", f"{work_dir}.stderr"):
+                if os.path.exists(path):
+                    os.unlink(path)
+        else:
+            print(f"Nonzero returncode {rc} from batch annotation in {work_dir}; annotating singly", file=out_fh)
+
+        batched = {item.id for item, md in ready} if rc == 0 else set()
+        if rc == 0:
+            for item, md in ready:
+                if keys.get(item.id):
+                    compute_all.cache_annotation(item, self.cache, keys[item.id], (end - start) / len(ready), out_fh)
+            for item in duplicates:
+                key, entry = compute_all.annotate_from_cache(item, self.cache, out_fh)
+                if entry:
+                    cached[item.id] = entry
+        for item, md in batch:
+            try:
+                if item.id in batched or item.id in cached:
+                    md["start"] = start
+                    md["end"] = end
+                    md["annotation_elapsed"] = end - start
+                    md["annotation_batch"] = len(ready)
+                    with open(f"{item.path}/ANNO_RUNTIME", "w") as f:
+                        print(f"{start}\t{end}\t{end - start}", file=f)
+                    if item.id in cached:
+                        item.annotation_cache_hit = True
+                        item.annotation_saved = cached[item.id]["elapsed"]
+                else:
+                    md["start"], md["end"] = compute_all.annotate(item, out_fh, self.server, self.cache)
+                    md["annotation_elapsed"] = md["end"] - md["start"]
+                compute_all.write_metadata(item, md, self.cache)
+            except Exception as e:
+                print(f"Annotation of {item.id} failed: {e!r}", file=out_fh)
+
+            if self.source:
+                self.source.ack(item)
+
+        print(f"{me} annotated {len(batch)} samples in {end - start:.1f}s", file=out_fh)
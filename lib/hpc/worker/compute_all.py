@@ -7,8 +7,12 @@ import sys
 import json
 import shutil
 import threadlog
+from hpc import scheduler as core_scheduler
+from hpc import status_index
+from hpc import anno_cache
 
-def worker(aff, threads, input_queue, output_path):
+def worker(aff, threads, input_queue, output_path, scheduler=None, source=None, server=None, annotator=None,
+           cache=None):
     """ Worker that runs both assembly and annotation
 
     The items we receive from the input_queue are SraSample instances.
@@ -16,6 +20,23 @@ def worker(aff, threads, input_queue, output_path):
     use fasterq-dump or fastq-dump to produce fastq from a .sra file, or
     download from SRA. We prefer not to download from SRA so that we can
     have more consistent runtimes and not risk throttling from SRA.
+
+    If a scheduler is given, the assembly thread count for each sample
+    comes from its input size and the cores are taken from the
+    scheduler's pool instead of using the fixed threads value.
+
+    If source is given, each sample is acknowledged to it once processed.
+    Samples may arrive already downloaded by a prefetch.Prefetcher.
+
+    If server is an assembly_server.Client, the assembly and annotation
+    commands run on that server instead of as new processes.
+
+    If annotator is an annotate_batch.AnnotationBatcher, assembled samples
+    are handed to it for batched annotation, and it acknowledges them to
+    the source once annotated.
+
+    cache is an anno_cache.AnnotationCache to reuse the annotation of
+    samples with identical consensus sequences.
     """
 
     me = threading.current_thread().name
@@ -30,132 +51,307 @@ def worker(aff, threads, input_queue, output_path):
 
     while True:
         print(f"{me} waiting", file=out_fh)
+        wait_start = time.time()
         item = input_queue.get()
         if item is None:
             print(me, " got none", file=out_fh)
             break
+        item.compute_wait = time.time() - wait_start
         print(f"{me} got {item.id}", file=out_fh)
 
-        sra = item.id
-        out_dir = item.path
-
         #
-        # Download
+        # A sample that raises is recorded as failed and acknowledged like
+        # any other; the queue must see task_done for it or join() hangs.
         #
+        try:
+            process_sample(item, threads, out_fh, scheduler, server, annotator, cache)
+        except Exception as e:
+            print(f"{me} processing of {item.id} failed: {e!r}", file=out_fh)
+            record_failure(item, e)
+        finally:
+            try:
+                if source and not getattr(item, "annotation_pending", False):
+                    source.ack(item)
+            finally:
+                input_queue.task_done()
+
+def record_failure(item, exc):
+    """ Record a sample whose processing raised, as we do for a failed assembly. """
+
+    try:
+        with open(f"{item.path}/assembly.failure", "w") as fh:
+            print(f"Processing of {item.id} raised {exc!r}", file=fh)
+    except OSError as e:
+        print(f"Cannot record failure of {item.id}: {e!r}", file=sys.stderr)
+
+def run_command(cmd, stdout, stderr, out_fh, server=None, cwd=None, append=False):
+    """ Run cmd with its output going to the stdout and stderr paths, returning its exit status.
+
+    With a server the command runs there, pinned to this thread's current
+    CPU affinity; if the server cannot be reached we run it directly.
+    """
+
+    if server:
+        try:
+            return server.run(cmd, stdout, stderr, cwd=cwd, append=append, cpus=os.sched_getaffinity(0))
+        except OSError as e:
+            print(f"Assembly server failed ({e}); running {cmd[0]} directly", file=out_fh)
+
+    mode = "a" if append else "w"
+    with open(stdout, mode) as out, open(stderr, mode) as err:
+        return subprocess.run(cmd, cwd=cwd, stdout=out, stderr=err).returncode
+
+def process_sample(item, threads, out_fh, scheduler=None, server=None, annotator=None, cache=None):
+    """ Download, assemble and annotate a single SraSample.
+
+    threads is the thread count passed to the assembly, unless a
+    CoreScheduler is given to size and place it. Commands run on server
+    if one is given. With an annotator, annotation is left to it and
+    meta.json is written once the sample is annotated. Returns the
+    metadata for meta.json, or None if the download failed.
+    """
 
+    me = threading.current_thread().name
+
+    sra = item.id
+    out_dir = item.path
+
+    #
+    # Download, unless a prefetch thread already has.
+    #
+
+    if getattr(item, "prefetched", False):
+        dl_output = item.download_result
+        download_elapsed = item.download_elapsed
+        item.ready_wait = time.time() - item.ready_time
+    else:
+        start = time.time()
         dl_output = item.download()
-        if dl_output is None:
-            print(f"{me} has failed download for {sra}", file=out_fh)
-            input_queue.task_done()
-            continue
+        download_elapsed = time.time() - start
+    if dl_output is None:
+        print(f"{me} has failed download for {sra}", file=out_fh)
+        return None
 
-        fq_files, delete_reads = dl_output
+    fq_files, delete_reads = dl_output
 
-        print(f"{me} has {fq_files} delete={delete_reads}", file=out_fh)
+    print(f"{me} has {fq_files} delete={delete_reads}", file=out_fh)
 
-        #
-        # Assemble
-        #
-        
+    streamed = getattr(item, "streamed", False)
+    if streamed:
+        input_bytes = item.input_bytes()
+    else:
+        input_bytes = core_scheduler.fastq_bytes(fq_files)
+
+    #
+    # Assemble
+    #
+
+    cpus = None
+    if scheduler:
+        cpus = scheduler.acquire(input_bytes)
+        threads = len(cpus)
+        print(f"{me} assigned {threads} cpus {cpus} for {input_bytes} input bytes", file=out_fh)
+        os.sched_setaffinity(0, cpus)
+
+    #
+    # Always give the cores back, or every other thread waits on them,
+    # and the fasterq-dump slot of a streamed sample.
+    #
+    try:
         start = time.time()
         cmd = ["sars2-onecodex", "--max-depth", "8000"]
-        cmd.extend(fq_files)
+        if streamed:
+            cmd.extend(["--sra", fq_files[0], "--sra-temp-dir", item.fastq_tmp])
+        else:
+            cmd.extend(fq_files)
         cmd.extend([sra, out_dir, "--threads", str(threads)])
         if delete_reads:
             cmd.append("--delete-reads")
 
         print(cmd, file=out_fh)
-        ret = subprocess.run(cmd,
-                             stdout=open(f"{out_dir}/assemble.stdout", "w"),
-                             stderr=open(f"{out_dir}/assemble.stderr", "w"))
+        rc = run_command(cmd, f"{out_dir}/assemble.stdout", f"{out_dir}/assemble.stderr", out_fh, server)
         end = time.time()
 
         asm_elapsed = end - start
         with open(f"{out_dir}/RUNTIME", "w") as f:
             print(f"{start}\t{end}\t{asm_elapsed}", file=f)
+    finally:
+        if streamed:
+            item.release_stream()
+        if cpus:
+            scheduler.release(cpus)
+            os.sched_setaffinity(0, scheduler.cpus)
 
-        anno_elapsed = 0
+    anno_elapsed = 0
+    deferred = False
 
-        if ret.returncode != 0:
-            print(f"Nonzero returncode {ret.returncode} from assembly of {sra}", file=out_fh)
-            with open(f"{out_dir}/assembly.failure", "w") as fh:
-                print(f"Nonzero returncode {ret.returncode} from assembly of {sra}", file=fh)
-        else:
+    if rc != 0:
+        print(f"Nonzero returncode {rc} from assembly of {sra}", file=out_fh)
+        with open(f"{out_dir}/assembly.failure", "w") as fh:
+            print(f"Nonzero returncode {rc} from assembly of {sra}", file=fh)
+    elif annotator:
+        deferred = True
+    else:
+        start, end = annotate(item, out_fh, server, cache)
+        anno_elapsed = end - start
 
-            #
-            # Annotate
-            # 
+    #
+    # Create metadata to save based on this run and on the
+    # container information if we are running in a container.
+    #
 
-            start = time.time()
+    md = {
+        "sra": sra,
+        "run_index": item.idx,
+        "start": start,
+        "end": end,
+        "elapsed": asm_elapsed,
+        "annotation_elapsed": anno_elapsed,
+        "threads": threads,
+        "cpus": cpus,
+        "input_bytes": input_bytes,
+        "download_elapsed": download_elapsed,
+        "prefetched": getattr(item, "prefetched", False),
+        "streamed": streamed,
+        "host": socket.gethostname(),
+        "slurm_task": os.getenv("SLURM_ARRAY_TASK_ID"),
+        "slurm_job": os.getenv("SLURM_JOB_ID"),
+        "slurm_cluster": os.getenv("SLURM_CLUSTER_NAME")
+        }
 
-            md_file = item.metadata_file()
-            if not md_file.exists():
-                md_file = "/dev/null"
+    print(md, file=out_fh)
 
-            cmd = ["p3x-create-sars-gto",
-                   "--accession", sra,
-                   f"{out_dir}/{sra}.fasta",
-                   md_file,
-                   f"{out_dir}/{sra}.raw.gto"];
+    if not streamed:
+        for fq in fq_files:
+            if os.path.exists(fq):
+                os.unlink(fq)
+    item.release_scratch()
 
-            print(cmd, file=out_fh)
-            subprocess.run(cmd,
-                           stdout=open(f"{out_dir}/annotate.stdout", "w"),
-                           stderr=open(f"{out_dir}/annotate.stderr", "w"))
+    if deferred:
+        item.annotation_pending = True
+        annotator.submit(item, md)
+    else:
+        write_metadata(item, md, cache)
 
-            cmd = ["p3x-annotate-vigor4",
-                   "-i", f"{out_dir}/{sra}.raw.gto",
-                   "-o", f"{out_dir}/{sra}.gto"];
+    return md
 
-            print(cmd, file=out_fh)
-            ret = subprocess.run(cmd,
-                                 cwd=out_dir,
-                                 stdout=open(f"{out_dir}/annotate.stdout", "a"),
-                                 stderr=open(f"{out_dir}/annotate.stderr", "a"))
-            end = time.time()
 
-            anno_elapsed = end - start
+def create_raw_gto(item, out_fh, server=None):
+    """ Build {sra}.raw.gto from the assembled contigs and the SRA metadata. """
+
+    sra = item.id
+    out_dir = item.path
+
+    md_file = item.metadata_file()
+    if not md_file.exists():
+        md_file = "/dev/null"
+
+    cmd = ["p3x-create-sars-gto",
+           "--accession", sra,
+           f"{out_dir}/{sra}.fasta",
+           md_file,
+           f"{out_dir}/{sra}.raw.gto"];
+
+    print(cmd, file=out_fh)
+    return run_command(cmd, f"{out_dir}/annotate.stdout", f"{out_dir}/annotate.stderr", out_fh, server)
+
+def annotation_failed(item, rc, out_fh):
+    sra = item.id
+    out_dir = item.path
+
+    print(f"Nonzero returncode {rc} from annotation of {sra}", file=out_fh)
+    with open(f"{out_dir}/annotation.failure", "w") as fh:
+        print(f"Nonzero returncode {rc} from annotation of {sra}", file=fh)
+    #
+    # Copy the raw GTO to the output gto. Best we can dow.
+    #
+    shutil.copyfile(f"{out_dir}/{sra}.raw.gto", f"{out_dir}/{sra}.gto")
+
+def annotate_from_cache(item, cache, out_fh):
+    """ Write the sample's GTO from the annotation cache if its consensus is there.
+
+    Returns the sample's cache key and the cache entry, or None on a miss.
+    """
+
+    sra = item.id
+    out_dir = item.path
+
+    try:
+        key = cache.key(f"{out_dir}/{sra}.fasta")
+        entry = cache.get(key)
+        if entry:
+            anno_cache.apply(entry, f"{out_dir}/{sra}.raw.gto", f"{out_dir}/{sra}.gto")
+            print(f"annotation cache hit for {sra}", file=out_fh)
+        return key, entry
+    except (OSError, ValueError) as e:
+        print(f"annotation cache lookup for {sra} failed: {e!r}", file=out_fh)
+        return None, None
+
+def annotate(item, out_fh, server=None, cache=None):
+    """ Annotate a single assembled sample, returning the start and end times.
+
+    With an anno_cache.AnnotationCache, a sample whose consensus has been
+    annotated before takes the cached annotation, and new annotations are
+    added to the cache.
+    """
+
+    sra = item.id
+    out_dir = item.path
+
+    start = time.time()
 
+    create_raw_gto(item, out_fh, server)
+
+    key = None
+    if cache:
+        key, entry = annotate_from_cache(item, cache, out_fh)
+        if entry:
+            end = time.time()
+            item.annotation_cache_hit = True
+            item.annotation_saved = max(0.0, entry["elapsed"] - (end - start))
             with open(f"{out_dir}/ANNO_RUNTIME", "w") as f:
-                print(f"{start}\t{end}\t{anno_elapsed}", file=f)
+                print(f"{start}\t{end}\t{end - start}", file=f)
+            return start, end
 
-            if ret.returncode != 0:
-                print(f"Nonzero returncode {ret.returncode} from annotation of {sra}", file=out_fh)
-                with open(f"{out_dir}/annotation.failure", "w") as fh:
-                    print(f"Nonzero returncode {ret.returncode} from annotation of {sra}", file=fh)
-                #
-                # Copy the raw GTO to the output gto. Best we can dow.
-                #
-                shutil.copyfile(f"{out_dir}/{sra}.raw.gto", f"{out_dir}/{sra}.gto")
+    cmd = ["p3x-annotate-vigor4",
+           "-i", f"{out_dir}/{sra}.raw.gto",
+           "-o", f"{out_dir}/{sra}.gto"];
 
-        #
-        # Create metadata to save based on this run and on the
-        # container information if we are running in a container.
-        #
+    print(cmd, file=out_fh)
+    rc = run_command(cmd, f"{out_dir}/annotate.stdout", f"{out_dir}/annotate.stderr", out_fh, server,
+                     cwd=out_dir, append=True)
+    end = time.time()
 
-        md = {
-            "sra": sra,
-            "run_index": item.idx,
-            "start": start,
-            "end": end,
-            "elapsed": asm_elapsed,
-            "annotation_elapsed": anno_elapsed,
-            "host": socket.gethostname(),
-            "slurm_task": os.getenv("SLURM_ARRAY_TASK_ID"),
-            "slurm_job": os.getenv("SLURM_JOB_ID"),
-            "slurm_cluster": os.getenv("SLURM_CLUSTER_NAME")
-            }
-
-        print(md, file=out_fh)
-        labels = "/.singularity.d/labels.json"
-        if os.path.exists(labels):
-            with open(labels) as f:
-                label = json.load(f)
-                md["container_metadata"] = label
-        with open(f"{out_dir}/meta.json", "w") as f:
-            json.dump(md, f, indent=2)
-        for fq in fq_files:
-            if os.path.exists(fq):
-                os.unlink(fq)
-        input_queue.task_done()
+    with open(f"{out_dir}/ANNO_RUNTIME", "w") as f:
+        print(f"{start}\t{end}\t{end - start}", file=f)
+
+    if rc != 0:
+        annotation_failed(item, rc, out_fh)
+    elif key:
+        cache_annotation(item, cache, key, end - start, out_fh)
+
+    return start, end
+
+def cache_annotation(item, cache, key, elapsed, out_fh):
+    try:
+        cache.put(key, f"{item.path}/{item.id}.raw.gto", f"{item.path}/{item.id}.gto", elapsed)
+    except (OSError, ValueError) as e:
+        print(f"annotation cache store for {item.id} failed: {e!r}", file=out_fh)
+
+def write_metadata(item, md, cache=None):
+    """ Write meta.json for a finished sample and record its outputs in the status index. """
+
+    if cache:
+        md["annotation_cache_hit"] = getattr(item, "annotation_cache_hit", False)
+        md["annotation_time_saved"] = getattr(item, "annotation_saved", 0.0)
+        md["annotation_cache_hit_rate"] = cache.hit_rate()
+
+    labels = "/.singularity.d/labels.json"
+    if os.path.exists(labels):
+        with open(labels) as f:
+            label = json.load(f)
+            md["container_metadata"] = label
+    with open(f"{item.path}/meta.json", "w") as f:
+        json.dump(md, f, indent=2)
 
+    status_index.record_outputs(item.base_dir, item.id, status_index.SUFFIXES)
@@ -0,0 +1,175 @@
+#
+# Process-pool executor for compute_all.
+#
+# The thread-based runner starts one OS thread per compute slot and pins it
+# with os.sched_setaffinity(0, ...), which on Linux applies only to the calling
+# thread. Here each slot is a separate worker process that owns a fixed CPU set
+# for its lifetime; the assembly for a sample running in that slot is given
+# exactly that many threads.
+#
+# Samples are pulled from redis by the parent process and submitted as
+# futures, and acknowledged to the work queue as they finish. On SIGTERM
+# (e.g. Slurm reaching the time limit) samples that have not started are
+# cancelled and returned to the redis list.
+#
+
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+import threadlog
+from hpc import work_queue
+from hpc.worker import compute_all
+
+#
+# Per-process slot state, set by the pool initializer.
+#
+_slot = {}
+
+def slot_cpus(n_slots, cores_per_slot, knl=False, first_cpu=0):
+    """ Compute the CPU set for each slot.
+
+    Slots get consecutive ranges of cores_per_slot cores starting at
+    first_cpu. On KNL each core has four hardware threads numbered
+    cpu + n * 64; a slot owns all four threads of each of its cores.
+    We refuse to hand out CPUs outside our own affinity mask so that
+    we never oversubscribe the allocation.
+    """
+
+    slots = []
+    cpu = first_cpu
+    for i in range(n_slots):
+        cores = range(cpu, cpu + cores_per_slot)
+        if knl:
+            cpus = [c + x * 64 for x in range(4) for c in cores]
+        else:
+            cpus = list(cores)
+        slots.append(sorted(cpus))
+        cpu += cores_per_slot
+
+    avail = os.sched_getaffinity(0)
+    for cpus in slots:
+        missing = set(cpus) - avail
+        if missing:
+            raise ValueError(f"slot CPUs {sorted(missing)} are not available (have {sorted(avail)})")
+    return slots
+
+def _init_slot(slot_queue, output_path, server=None, cache=None):
+    #
+    # The parent's SIGTERM handler only sets its own stop event; a slot
+    # process must keep the default action so that it exits on SIGTERM.
+    #
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    idx, cpus = slot_queue.get()
+    name = f"slot-{idx}"
+    threading.current_thread().name = name
+
+    out_fh = sys.stdout
+    if output_path:
+        out_fh = threadlog.open_logger(output_path)
+
+    os.sched_setaffinity(0, cpus)
+    print(f"{name} pid {os.getpid()} starting with affinity {cpus}", file=out_fh)
+
+    _slot["cpus"] = cpus
+    _slot["out_fh"] = out_fh
+    _slot["server"] = server
+    _slot["cache"] = cache
+
+def _run_sample(item):
+    cpus = _slot["cpus"]
+    out_fh = _slot["out_fh"]
+    print(f"{threading.current_thread().name} got {item.id}", file=out_fh)
+    return compute_all.process_sample(item, len(cpus), out_fh, server=_slot["server"], cache=_slot["cache"])
+
+def run(redis_conn, slots, output_path, max_pending, source=None, batch=1, server=None, cache=None):
+    """ Run samples from redis through a process pool with one process per slot.
+
+    max_pending bounds the number of samples pulled from redis but not
+    yet finished, so that we don't drain the shared list to this node.
+    source is the work_queue consumer to pop from; by default a plain
+    RPOP of the sra list. Up to batch samples are popped per round trip.
+    Commands run on server, an assembly_server.Client, if one is given,
+    and annotation is reused from cache, an anno_cache.AnnotationCache.
+    """
+
+    if source is None:
+        source = work_queue.ListSource(redis_conn)
+
+    ctx = multiprocessing.get_context("fork")
+    slot_queue = ctx.Queue()
+    for idx, cpus in enumerate(slots):
+        slot_queue.put((idx, cpus))
+
+    stop = threading.Event()
+
+    def on_term(signum, frame):
+        print(f"Received signal {signum}; cancelling samples that have not started", file=sys.stderr)
+        stop.set()
+
+    old_handler = signal.signal(signal.SIGTERM, on_term)
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=len(slots),
+                                                      mp_context=ctx,
+                                                      initializer=_init_slot,
+                                                      initargs=(slot_queue, output_path, server, cache))
+    pending = {}
+    exhausted = False
+    try:
+        while not stop.is_set():
+            while not exhausted and len(pending) < max_pending:
+                items = source.pop_many(min(batch, max_pending - len(pending)))
+                if not items:
+                    exhausted = True
+                    break
+                for item in items:
+                    print(f"submit {item.id}")
+                    pending[executor.submit(_run_sample, item)] = item
+
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, timeout=5,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                item = pending.pop(fut)
+                try:
+                    md = fut.result()
+                    if md is None:
+                        print(f"{item.id} failed download")
+                    else:
+                        print(f"{item.id} done elapsed={md['elapsed']}")
+                except BrokenProcessPool as e:
+                    #
+                    # The slot process died under the sample (killed,
+                    # out of memory); the pool can take no more work.
+                    #
+                    print(f"{item.id} lost with its slot process: {e!r}", file=sys.stderr)
+                    print(f"requeue {item.id}")
+                    source.requeue(item)
+                    stop.set()
+                    continue
+                except Exception as e:
+                    print(f"{item.id} failed: {e!r}", file=sys.stderr)
+                    compute_all.record_failure(item, e)
+                source.ack(item)
+
+        #
+        # If we were stopped, anything that hasn't started, or was lost
+        # with a broken pool, goes back on the list.
+        #
+        for fut, item in list(pending.items()):
+            if fut.cancel() or (fut.done() and isinstance(fut.exception(), BrokenProcessPool)):
+                print(f"requeue {item.id}")
+                source.requeue(item)
+                del pending[fut]
+
+    finally:
+        executor.shutdown(wait=True)
+        signal.signal(signal.SIGTERM, old_handler)
@@ -0,0 +1,145 @@
+#
+# Prefetch stage for compute_all.
+#
+# Without it, SraSample.download runs fasterq-dump inside the compute
+# thread and the assembly cores sit idle during extraction. Prefetch
+# threads sit between the redis feeder and the compute queue and extract
+# the fastq for upcoming samples while the current ones assemble; a sample
+# only reaches the compute queue once its fastq is ready.
+#
+# Extraction still goes through SraSample.download, so --max-fasterq
+# (fasterq_semaphore) still bounds concurrent fasterq-dumps. Prefetched
+# fastq waiting for a compute thread is bounded by a byte quota: a sample's
+# bytes count against it from the start of its extraction until a compute
+# thread takes it from the ready queue.
+#
+
+import queue
+import sys
+import threading
+import time
+
+import threadlog
+from hpc import scheduler as core_scheduler
+
+class ReadyQueue(queue.Queue):
+    """ The compute queue fed by a Prefetcher; taking a sample from it releases the sample's quota. """
+
+    def __init__(self, prefetcher, maxsize=0):
+        super().__init__(maxsize)
+        self.prefetcher = prefetcher
+
+    def get(self, block=True, timeout=None):
+        item = super().get(block, timeout)
+        if item is not None:
+            self.prefetcher.release(item)
+        return item
+
+class Prefetcher:
+    """ Extract fastq ahead of the compute threads, within a scratch quota.
+
+    The prefetch workers put ready samples on a ReadyQueue from
+    ready_queue(). Compute threads acknowledge finished samples to the
+    Prefetcher in place of the work queue source; we record the overlap
+    statistics and pass the acknowledgement on.
+    """
+
+    def __init__(self, source, quota=0):
+        self.source = source
+        self.quota = quota
+        self.used = 0
+        self.cond = threading.Condition()
+
+        self.n_samples = 0
+        self.extract_seconds = 0.0
+        self.hidden_seconds = 0.0
+        self.ready_wait_seconds = 0.0
+
+    def _reserve(self, nbytes):
+        """ Wait until nbytes fits in the quota. A sample larger than the whole quota runs alone. """
+
+        with self.cond:
+            while self.quota and self.used > 0 and self.used + nbytes > self.quota:
+                self.cond.wait()
+            self.used += nbytes
+
+    def _adjust(self, old, new):
+        with self.cond:
+            self.used += new - old
+            self.cond.notify_all()
+
+    def ready_queue(self, maxsize=0):
+        return ReadyQueue(self, maxsize)
+
+    def release(self, item):
+        """ Release the quota held by a prefetched sample, once. """
+
+        if getattr(item, "prefetched", False) and not getattr(item, "prefetch_released", False):
+            item.prefetch_released = True
+            self._adjust(item.prefetch_bytes, 0)
+
+    def worker(self, input_queue, output_queue, output_path):
+        me = threading.current_thread().name
+
+        out_fh = sys.stdout
+        if output_path:
+            out_fh = threadlog.open_logger(output_path)
+
+        while True:
+            item = input_queue.get()
+            if item is None:
+                print(f"{me} got none", file=out_fh)
+                input_queue.task_done()
+                break
+
+            estimate = item.input_bytes()
+            self._reserve(estimate)
+
+            print(f"{me} prefetching {item.id} ({estimate} bytes estimated, {self.used} in use)", file=out_fh)
+            start = time.time()
+            result = item.download()
+            end = time.time()
+
+            item.prefetched = True
+            item.download_result = result
+            item.download_elapsed = end - start
+            item.ready_time = end
+
+            item.prefetch_bytes = estimate
+            if result is not None:
+                item.prefetch_bytes = core_scheduler.fastq_bytes(result[0])
+            self._adjust(estimate, item.prefetch_bytes)
+
+            print(f"{me} prefetched {item.id} in {end - start:.1f}s", file=out_fh)
+            output_queue.put(item)
+            input_queue.task_done()
+
+    def ack(self, item):
+        """ Record overlap statistics for a finished sample. """
+
+        if getattr(item, "prefetched", False):
+            wait = getattr(item, "compute_wait", 0.0)
+            with self.cond:
+                self.n_samples += 1
+                self.extract_seconds += item.download_elapsed
+                self.hidden_seconds += max(0.0, item.download_elapsed - wait)
+                self.ready_wait_seconds += getattr(item, "ready_wait", 0.0)
+        self.source.ack(item)
+
+    def requeue(self, item):
+        self.release(item)
+        self.source.requeue(item)
+
+    def report(self, fh=sys.stdout):
+        """ Print how much of the extraction time was overlapped with compute.
+
+        Extraction time is hidden except where a compute thread sat idle
+        waiting for the sample; time fastq sat ready before a compute
+        thread took it shows the prefetch depth is more than enough.
+        """
+
+        with self.cond:
+            pct = 100 * self.hidden_seconds / self.extract_seconds if self.extract_seconds else 0
+            print(f"prefetch: {self.n_samples} samples, extraction {self.extract_seconds:.1f}s, "
+                  f"hidden {self.hidden_seconds:.1f}s ({pct:.0f}%), "
+                  f"ready fastq waited {self.ready_wait_seconds:.1f}s for compute", file=fh)
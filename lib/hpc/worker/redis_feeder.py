@@ -2,37 +2,56 @@
 import os
 import sys
 import threading
-import pickle
+import time
 import threadlog
+from hpc import work_queue
 
-def worker(aff, redis_conn, output_queue, output_path):
+def worker(aff, redis_conn, output_queue, output_path, source=None, batch=1):
     """Redis feeder worker
 
     Block on a pop from the redis service. If it ever returns empty, exit the thread.
 
-    For each data item received, unpickle to generate a SraSample.
+    For each data item received, decode it to generate a SraSample.
     Push the sample onto our output queue.
+
+    source is the work_queue consumer to pop from; by default a plain
+    RPOP of the sra list.
+
+    With batch > 1 we pop up to that many items per round trip, but
+    never more than the free space in output_queue, so that a bounded
+    queue still bounds what this node takes from the shared list.
     """
     me = threading.current_thread().name
     out_fh = sys.stdout
 
+    if source is None:
+        source = work_queue.ListSource(redis_conn)
+
     if output_path:
         out_fh = threadlog.open_logger(output_path)
 
     if aff:
         print(f"{me} starting with affinity {aff}", file=out_fh)
         os.sched_setaffinity(0, aff)
+    n_items = 0
+    pop_time = 0.0
     while True:
 
-        pitem = redis_conn.rpop("sra")
-        if pitem is None:
-            break
-        item = pickle.loads(pitem)
-            
-        if item is None:
+        count = batch
+        if output_queue.maxsize > 0:
+            count = max(1, min(batch, output_queue.maxsize - output_queue.qsize()))
+
+        start = time.time()
+        items = source.pop_many(count)
+        pop_time += time.time() - start
+        if not items:
             break
 
-        print(f"{me}: got item {item.id}", file=out_fh)
+        for item in items:
+            print(f"{me}: got item {item.id}", file=out_fh)
+            output_queue.put(item)
+        n_items += len(items)
 
-        output_queue.put(item)
+    if n_items:
+        print(f"{me}: dequeued {n_items} items, mean dequeue latency {pop_time / n_items * 1000:.3f} ms/item", file=out_fh)
 
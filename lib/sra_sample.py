@@ -5,36 +5,120 @@
 from pathlib import Path
 import glob
 import os
+import statistics
 import sys
 import subprocess
 import threading
 import threadlog
+from hpc import status_index
 
-def read_defs_from_file(def_file, base_dir):
+def read_defs_from_file(def_file, base_dir, order="file", history_file=None):
+    """ Read the SRA defs file and return SraSamples for those without output.
+
+    With order="file" the samples are returned in file order. With
+    order="size" or order="history" they are returned most expensive first
+    (longest-processing-time-first), so that the biggest samples are not
+    left for the tail of the run. See estimate_costs for the cost model.
+    """
     #
     # Read our SRA defs to find the inputs needed. Stuff them into input queue.
     #
-    defs = []
+    ids = []
     with open(def_file) as fh:
-        idx = 1
         for line in fh:
             cols = line.rstrip().split("\t")
-            id = cols[0]
+            ids.append(cols[0])
 
-            sra = SraSample(id, idx, base_dir)
+    #
+    # Find the samples already done from the status index, one read per prefix.
+    #
+    done = status_index.completed(base_dir, {id[0:7] for id in ids}, "fasta", ids=set(ids))
 
-            if not sra.has_output_with_suffix("fasta"):
-                defs.append(sra)
+    defs = []
+    for idx, id in enumerate(ids, 1):
+        if id not in done:
+            defs.append(SraSample(id, idx, base_dir))
 
-            idx += 1
+    if order != "file":
+        history = None
+        if order == "history":
+            history = read_runtime_history(history_file)
+        estimate_costs(defs, history)
+        defs.sort(key=lambda s: s.cost, reverse=True)
 
     return defs
 
+def read_runtime_history(path):
+    """ Read a runtime history file of (SRA id, elapsed seconds) lines. """
+
+    history = {}
+    with open(path) as fh:
+        for line in fh:
+            cols = line.rstrip().split("\t")
+            if len(cols) < 2:
+                continue
+            try:
+                history[cols[0]] = float(cols[1])
+            except ValueError:
+                pass
+    return history
+
+def estimate_costs(defs, history=None):
+    """ Set the cost attribute of each sample to an estimate of its processing time.
+
+    Without history the cost is the estimated input size in bytes. With
+    history, samples that have a recorded runtime use it; the others are
+    scaled from their size by the median seconds-per-byte of the samples
+    that have both.
+    """
+
+    for sra in defs:
+        sra.size_hint = sra.input_bytes()
+        sra.cost = sra.size_hint
+
+    if not history:
+        return
+
+    rates = [history[sra.id] / sra.size_hint for sra in defs
+             if sra.id in history and sra.size_hint > 0]
+    rate = statistics.median(rates) if rates else None
+    default = statistics.median(history.values()) if history else 0
+
+    for sra in defs:
+        if sra.id in history:
+            sra.cost = history[sra.id]
+        elif rate is not None and sra.size_hint > 0:
+            sra.cost = sra.size_hint * rate
+        else:
+            sra.cost = default
+
 
 class SraSample:
 
     fastq_tmp = "/tmp"
 
+    #
+    # Approximate ratio of fastq size to .sra size, used to estimate
+    # the input size of a sample before it has been extracted.
+    #
+    sra_fastq_ratio = 4.0
+
+    #
+    # Scratch admission control (see hpc.scratch). When scratch_budget is
+    # set, a sample reserves scratch_ratio times its estimated fastq size
+    # before extraction, covering the fasterq-dump temporaries, the fastq
+    # and the assembly intermediates, and releases it on cleanup.
+    #
+    scratch_budget = None
+    scratch_ratio = 2.0
+
+    #
+    # When stream_sra is set and only the .sra is present, download()
+    # does not extract it; sars2-onecodex --sra streams the reads from
+    # fasterq-dump straight into minimap2.
+    #
+    stream_sra = False
+
     def __init__(self, id, idx, base_dir):
         self.base_dir = base_dir
         
@@ -46,11 +130,28 @@ class SraSample:
 
     def create_out_dir(self):
 
-        os.makedirs(self.path, exist_ok=True)
+        status_index.create_sample_dir(self.base_dir, self.id)
 
     def has_output_with_suffix(self, suffix):
         path = self.path / f"{self.id}.{suffix}"
         return path.exists()
+
+    def input_bytes(self):
+        """ Estimate the size in bytes of the fastq input for this sample.
+
+        We use the fastq files if they are present, otherwise the .sra
+        size scaled by sra_fastq_ratio. Returns 0 if neither is found.
+        """
+
+        fq_files = self.find_fq_files(quiet=True)
+        if fq_files is not None:
+            return sum(os.path.getsize(fq) for fq in fq_files)
+
+        sra = self.path / f"{self.id}.sra"
+        try:
+            return int(sra.stat().st_size * self.sra_fastq_ratio)
+        except OSError:
+            return 0
         
     def metadata_file(self):
         return self.md_cache / f"{self.id}.json"
@@ -59,7 +160,11 @@ class SraSample:
         """ Download data if necessary.
 
         If the path contains .fastq files, just return those, along with False for the delete fastq flag.
-        If the path contains a .sra file, use fasterq-dump to pull fastq files and place in TMPDIR.
+        If the path contains a .sra file and stream_sra is set, return the .sra file itself
+        (with False for the delete flag) and set the streamed attribute; the fasterq-dump
+        then runs inside the assembly, so with max_fasterq we hold a fasterq_semaphore
+        slot until release_stream is called once the assembly is done.
+        Otherwise if the path contains a .sra file, use fasterq-dump to pull fastq files and place in TMPDIR.
         We return True for the delete fastq flag here.
         For now we don't actually do the SRA download.
         """
@@ -78,9 +183,28 @@ class SraSample:
             
         sra = self.path / f"{self.id}.sra"
 
+        if sra.exists() and self.stream_sra:
+            print(f"stream from {sra}", file=out_fh)
+            if self.scratch_budget:
+                #
+                # No fastq on disk, but fasterq-dump temporaries and assembly intermediates.
+                #
+                self.scratch_budget.reserve(self.id, int(self.input_bytes() * max(self.scratch_ratio - 1, 0)))
+            if self.max_fasterq > 0:
+                self.fasterq_semaphore.acquire()
+                self.fasterq_held = True
+            self.streamed = True
+            return [str(sra)], False
+
         if sra.exists():
             print(f"load from {sra}", file=out_fh)
 
+            if self.scratch_budget:
+                need = int(self.input_bytes() * self.scratch_ratio)
+                used, budget, waiting = self.scratch_budget.status()
+                print(f"reserve {need} scratch bytes ({used} of {budget} in use, {waiting} waiting)", file=out_fh)
+                self.scratch_budget.reserve(self.id, need)
+
             if self.max_fasterq > 0:
                 self.fasterq_semaphore.acquire()
 
@@ -101,18 +225,35 @@ class SraSample:
 
             if ret.returncode != 0:
                 print(f"fasterqdump of {sra} failed with {ret.returncode} {cmd}", file=out_fh)
+                self.release_scratch()
                 return None
         fq_files = self.find_fq_files()
         if fq_files is not None:
             return fq_files, True
+        self.release_scratch()
         return None
+
+    def release_stream(self):
+        """ Release the fasterq_semaphore slot held by a streamed sample, once its assembly is done. """
+
+        if getattr(self, "fasterq_held", False):
+            self.fasterq_held = False
+            self.fasterq_semaphore.release()
+
+    def release_scratch(self):
+        """ Release this sample's scratch reservation, once its fastq and intermediates are gone. """
+
+        if self.scratch_budget:
+            self.scratch_budget.release(self.id)
     
-    def find_fq_files(self):
+    def find_fq_files(self, quiet=False):
 
         for suffix in ('fastq', 'fastq.gz', 'fq.gz'):
-            print(f"check {suffix}")
+            if not quiet:
+                print(f"check {suffix}")
             fq_files = glob.glob(f"{self.path}/*.{suffix}")
-            print(f"files: {self.path} {fq_files}")
+            if not quiet:
+                print(f"files: {self.path} {fq_files}")
             if len(fq_files) == 1 or len(fq_files) == 2:
                 fq_files.sort();
                 return fq_files
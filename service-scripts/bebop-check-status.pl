@@ -3,6 +3,10 @@
 # Given a file with a list of SRA IDs and a set of base directories for output,
 # search for status.
 #
+# A prefix directory with a .status manifest (see lib/hpc/status_index.py)
+# at least as new as the directory is read from the manifest alone;
+# otherwise we stat each sample's GTO.
+#
 
 use strict;
 use Getopt::Long::Descriptive;
@@ -49,6 +53,19 @@ for my $base (@base_dirs)
     {
 	next unless $prefixes{$p};
 	my $prefix_dir = "$base/$p";
+	my $dir_mtime = (stat($prefix_dir))[9];
+	my $manifest_mtime = (stat("$prefix_dir/.status"))[9];
+	if (defined($manifest_mtime) && $manifest_mtime >= $dir_mtime && open(M, "<", "$prefix_dir/.status"))
+	{
+	    while (<M>)
+	    {
+		chomp;
+		my($sra, $suffix) = split(/\t/);
+		delete $to_process{$sra} if $suffix eq 'gto';
+	    }
+	    close(M);
+	    next;
+	}
 	if (!opendir(P, $prefix_dir))
 	{
 	    warn "Failure opening dir $prefix_dir: $!";
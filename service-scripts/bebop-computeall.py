@@ -8,6 +8,7 @@ import sys
 import os
 import queue
 import threading
+import multiprocessing
 import subprocess
 import glob
 import time
@@ -17,11 +18,13 @@ import json
 import argparse
 import redis
 import re
-import pickle
 from pathlib import Path
 
 import sra_sample
-from hpc.worker import redis_feeder, compute_all
+from hpc.worker import redis_feeder, compute_all, compute_pool, prefetch, annotate_batch
+from hpc.scheduler import CoreScheduler
+from hpc.scratch import ScratchBudget, parse_size
+from hpc import work_queue, work_item, assembly_server, anno_cache
 
 #
 # Set up for redis.
@@ -42,9 +45,15 @@ def redis_setup(args, sra_defs):
     conn = redis.Redis(host=redis_host)
 
     if nodeid == 0:
-        conn.delete("sra")
-        for d in sra_defs:
-            conn.lpush("sra", pickle.dumps(d))
+        #
+        # Drop the leases and processing lists of any earlier run too; its
+        # unfinished samples are in the fresh seed, so requeueing them
+        # would only process them twice.
+        #
+        conn.delete("sra", "sra:leases", *conn.scan_iter(match="sra:processing:*"))
+        start = time.time()
+        n = work_queue.seed(conn, sra_defs, chunk=args.seed_chunk, codec=work_item.Codec(args.output_dir))
+        print(f"Seeded {n} samples in {time.time() - start:.2f} seconds")
 
     return conn
         
@@ -78,17 +87,69 @@ def main():
     parser.add_argument('--log-output', type=str, help='Directory to write per-thread outputs')
     parser.add_argument('--fastq-temp', type=str, help='fastq temp dir')
     parser.add_argument('--max-fasterq', type=int, help='Max number of threads allowed to run fasterq-dump at once', default=0)
+    parser.add_argument('--order', choices=['file', 'size', 'history'], default='file',
+                        help='Order in which samples are queued: file order, or largest first by input size or by runtime history')
+    parser.add_argument('--runtime-history', type=str, help='Runtime history file (SRA id and elapsed seconds) for --order history')
+    parser.add_argument('--executor', choices=['threads', 'process'], default='threads',
+                        help='Run compute slots as threads in this process or as a pool of pinned worker processes')
+    parser.add_argument('--cores-per-slot', type=int, help='Cores owned by each process-pool slot. Defaults to --n-app-threads')
+    parser.add_argument('--first-cpu', type=int, help='First CPU assigned to process-pool slots or the core pool', default=0)
+    parser.add_argument('--core-pool', type=int, help='Size assembly threads per sample from its input size, drawing from a pool of this many cores')
+    parser.add_argument('--bytes-per-thread', type=float, help='Input fastq bytes per assembly thread for --core-pool', default=250e6)
+    parser.add_argument('--min-threads', type=int, help='Minimum assembly threads per sample for --core-pool', default=1)
+    parser.add_argument('--max-threads', type=int, help='Maximum assembly threads per sample for --core-pool', default=8)
+    parser.add_argument('--stream-sra', action='store_true',
+                        help='Stream reads from .sra files through fasterq-dump into the assembly instead of extracting fastq to disk')
+    parser.add_argument('--scratch-budget', type=str,
+                        help='Bytes of scratch (e.g. 800G, or auto for 90%% of free space in the fastq temp dir) that samples being extracted and assembled may hold; a byte-based alternative to --max-fasterq')
+    parser.add_argument('--scratch-ratio', type=float, help='Scratch reserved per sample as a multiple of its estimated fastq size', default=2.0)
+    parser.add_argument('--prefetch', type=int, help='Number of threads extracting fastq for upcoming samples ahead of the compute threads', default=0)
+    parser.add_argument('--prefetch-quota', type=float, help='Bytes of prefetched fastq allowed to wait for compute (0 for no limit)', default=0)
+    parser.add_argument('--reliable-queue', action='store_true',
+                        help='Hold popped samples on a leased per-worker processing list until done, so samples of dead workers are requeued (needs redis 6.2)')
+    parser.add_argument('--lease-time', type=int, help='Seconds without a heartbeat before a worker\'s samples are requeued', default=600)
+    parser.add_argument('--seed-chunk', type=int, help='Samples per LPUSH when seeding the redis list', default=1000)
+    parser.add_argument('--pop-batch', type=int, help='Samples to pop from redis per round trip (bounded by --compute-queue-size)', default=1)
+    parser.add_argument('--assembly-server', type=str,
+                        help='Run assembly and annotation commands on the sars2-assembly-server listening at this socket')
+    parser.add_argument('--start-assembly-server', action='store_true',
+                        help='Start a sars2-assembly-server at the --assembly-server socket for the length of this run')
+    parser.add_argument('--annotate-batch', type=int, default=0,
+                        help='Annotate assembled samples in batches of this many with one VIGOR4 run (0 to annotate each sample as it is assembled)')
+    parser.add_argument('--annotate-wait', type=float, default=60,
+                        help='Seconds a partial annotation batch waits for more samples')
+    parser.add_argument('--annotate-threads', type=int, default=1, help='Number of batch annotation threads')
+    parser.add_argument('--annotation-cache', type=str,
+                        help='Shared directory caching annotations by consensus sequence, to skip annotating identical genomes')
+    parser.add_argument('--annotation-cache-size', type=str, default='20G', help='Size bound for --annotation-cache')
+    parser.add_argument('--queue-wait', type=int, help='With --reliable-queue, seconds to wait for requeued work when the list is empty', default=0)
 
     args = parser.parse_args()
 
     sra_sample.SraSample.max_fasterq = args.max_fasterq
     if args.max_fasterq > 0:
-        sra_sample.SraSample.fasterq_semaphore = threading.Semaphore(args.max_fasterq)
+        if args.executor == 'process':
+            #
+            # Pool processes are forked from us, so this must be created before the pool.
+            #
+            sra_sample.SraSample.fasterq_semaphore = multiprocessing.get_context("fork").Semaphore(args.max_fasterq)
+        else:
+            sra_sample.SraSample.fasterq_semaphore = threading.Semaphore(args.max_fasterq)
         
     sra_sample.SraSample.md_cache = Path(args.metadata_cache)
     if args.fastq_temp:
         sra_sample.SraSample.fastq_tmp = args.fastq_temp
 
+    sra_sample.SraSample.stream_sra = args.stream_sra
+
+    if args.scratch_budget:
+        if args.executor == 'process':
+            parser.error("--scratch-budget is not supported with --executor process")
+        budget = parse_size(args.scratch_budget, sra_sample.SraSample.fastq_tmp)
+        sra_sample.SraSample.scratch_budget = ScratchBudget(budget)
+        sra_sample.SraSample.scratch_ratio = args.scratch_ratio
+        print(f"scratch budget {budget} bytes")
+
     output_path = None
     slurm_job = os.getenv("SLURM_JOB_ID")
     if args.log_output and slurm_job:
@@ -97,7 +158,9 @@ def main():
         print(f"logging thread output to {output_path}")
 
     output = args.output_dir
-    sra_defs = sra_sample.read_defs_from_file(args.sra_def_file, output)
+    if args.order == 'history' and not args.runtime_history:
+        parser.error("--order history requires --runtime-history")
+    sra_defs = sra_sample.read_defs_from_file(args.sra_def_file, output, args.order, args.runtime_history)
 
     #
     # Find our NCBI config file and from there the SRA scratch folder. We
@@ -128,6 +191,46 @@ def main():
 
     redis_conn = redis_setup(args, sra_defs)
 
+    codec = work_item.Codec(output)
+    if args.reliable_queue:
+        source = work_queue.ReliableQueue(redis_conn, lease_time=args.lease_time, wait=args.queue_wait, codec=codec)
+        source.start_heartbeat()
+        print(f"reliable queue worker {source.worker_id}")
+    else:
+        source = work_queue.ListSource(redis_conn, codec=codec)
+
+    server = None
+    server_proc = None
+    if args.assembly_server:
+        if args.start_assembly_server:
+            log = output_path / "assembly-server.log" if output_path else None
+            server_proc = assembly_server.start(args.assembly_server, log_path=log)
+            print(f"started assembly server pid {server_proc.pid} at {args.assembly_server}")
+        server = assembly_server.Client(args.assembly_server)
+    elif args.start_assembly_server:
+        parser.error("--start-assembly-server requires --assembly-server")
+
+    cache = None
+    if args.annotation_cache:
+        cache = anno_cache.AnnotationCache(args.annotation_cache, parse_size(args.annotation_cache_size))
+
+    if args.executor == 'process':
+        if args.annotate_batch:
+            parser.error("--annotate-batch is not supported with --executor process")
+        if args.prefetch or args.prefetch_quota:
+            parser.error("--prefetch and --prefetch-quota are not supported with --executor process")
+        if args.core_pool:
+            parser.error("--core-pool is not supported with --executor process")
+        cores = args.cores_per_slot or args.n_app_threads
+        slots = compute_pool.slot_cpus(args.n_computes, cores, args.knl, args.first_cpu)
+        compute_pool.run(redis_conn, slots, output_path, args.n_computes + args.compute_queue_size, source,
+                         args.pop_batch, server, cache)
+        source.close()
+        print("computes done")
+        if server_proc:
+            server_proc.terminate()
+        return
+
     #
     # Our queues. This app just needs one, from the downloader to compute.
     # We limit its size so we don't pull down the entire redis queue to this host.
@@ -135,6 +238,26 @@ def main():
 
     compute_queue = queue.Queue(args.compute_queue_size)
 
+    #
+    # With prefetch, the feeder fills the prefetch queue and the prefetch
+    # threads move samples to the compute queue once their fastq is ready;
+    # a sample's prefetch quota is released when a compute thread takes it.
+    # Compute threads then acknowledge samples through the prefetcher.
+    #
+    feed_queue = compute_queue
+    compute_source = source
+    prefetcher = None
+    prefetch_threads = []
+    if args.prefetch > 0:
+        feed_queue = queue.Queue(args.prefetch)
+        prefetcher = prefetch.Prefetcher(source, args.prefetch_quota)
+        compute_queue = prefetcher.ready_queue(args.compute_queue_size)
+        compute_source = prefetcher
+        for i in range(args.prefetch):
+            t = threading.Thread(target=prefetcher.worker, name=f"prefetch-{i}", args=[feed_queue, compute_queue, output_path])
+            t.start()
+            prefetch_threads.append(t)
+
     N_compute = args.n_computes
     app_threads = args.n_app_threads
 
@@ -143,26 +266,52 @@ def main():
         compute_affinity = compute_affinity_knl
     else:
         compute_affinity = compute_affinity_bdw
-        
+
+    #
+    # With a core pool, compute threads are not pinned; each sample is
+    # placed on the cores the scheduler assigns it. There may then be more
+    # compute threads than would fit on fixed slots.
+    #
+    scheduler = None
+    if args.core_pool:
+        pool_cpus = compute_pool.slot_cpus(1, args.core_pool, args.knl, args.first_cpu)[0]
+        scheduler = CoreScheduler(pool_cpus, args.bytes_per_thread, args.min_threads, args.max_threads)
+        print(f"core pool {pool_cpus}")
+
+    annotator = None
+    if args.annotate_batch:
+        annotator = annotate_batch.AnnotationBatcher(args.annotate_batch, args.annotate_wait,
+                                                     f"{scratch}/annotate-batch", compute_source, server, output_path,
+                                                     cache)
+        annotator.start(args.annotate_threads)
+
     compute_threads = []
 
     for i in range(N_compute):
         
         aff = compute_affinity(cpu)
         cpu += 1
+        if scheduler:
+            aff = scheduler.cpus
             
-        t = threading.Thread(target = compute_all.worker, name=f"compute-{i}", args=[aff, app_threads, compute_queue, output_path])
+        t = threading.Thread(target = compute_all.worker, name=f"compute-{i}", args=[aff, app_threads, compute_queue, output_path, scheduler, compute_source, server, annotator, cache])
         t.start()
         compute_threads.append(t)
 
     #
     # We run the downloader in this thread.
     #
-    redis_feeder.worker([0], redis_conn, compute_queue, output_path)
+    redis_feeder.worker([0], redis_conn, feed_queue, output_path, source, args.pop_batch)
 
     #
     # Clean up and wait.
     #
+    if prefetch_threads:
+        feed_queue.join()
+        for t in prefetch_threads:
+            feed_queue.put(None)
+        for t in prefetch_threads:
+            t.join()
     compute_queue.join()
     print("computes done")
     for i in range(N_compute):
@@ -170,6 +319,14 @@ def main():
     for t in compute_threads:
         t.join()
     print("computes joined")
+    if annotator:
+        annotator.close()
+        print(f"annotation done in {annotator.n_batches} batches")
+    if prefetcher:
+        prefetcher.report()
+    source.close()
+    if server_proc:
+        server_proc.terminate()
 
 if __name__ == "__main__":
     main()
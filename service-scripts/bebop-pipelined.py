@@ -21,14 +21,14 @@ import re
 import pickle
 from pathlib import Path
 
+from hpc import status_index
+
 def compute_out_dir(out_dir_base, sra):
     path = f"{out_dir_base}/{sra[0:7]}/{sra}"
     return path
     
 def create_out_dir(out_dir_base, sra):
-    path = compute_out_dir(out_dir_base, sra)
-    os.makedirs(path, exist_ok=True)
-    return path
+    return status_index.create_sample_dir(out_dir_base, sra)
 
 def create_fq_dir(scratch, task):
     path = f"{scratch}/task-{task}"
@@ -217,23 +217,26 @@ def annotate_worker(aff, input_queue):
         with open(f"{out_dir}/RUNTIME_ANNO", "w") as f:
             print(f"{start}\t{end}\t{elapsed}", file=f)
 
+        status_index.record_outputs(os.path.dirname(os.path.dirname(out_dir)), sra, status_index.SUFFIXES)
+
         input_queue.task_done()
 
 def read_sra_defs(sra_defs, output_dir):
     #
     # Read our SRA defs to find the inputs needed. Stuff them into input queue.
     #
-    defs = []
+    ids = []
     with open(sra_defs) as fh:
-        idx = 1
         for line in fh:
             cols = line.rstrip().split("\t")
-            sra = cols[0]
+            ids.append(cols[0])
+
+    done = status_index.completed(output_dir, {sra[0:7] for sra in ids}, "gto")
 
-            dir = compute_out_dir(output_dir, sra)
-            if not os.path.exists(f"{dir}/{sra}.gto"):
-                defs.append([idx, sra])
-            idx += 1
+    defs = []
+    for idx, sra in enumerate(ids, 1):
+        if sra not in done:
+            defs.append([idx, sra])
 
     return defs
 
@@ -0,0 +1,57 @@
+#
+# Measure work-list seeding time and per-item dequeue latency against a
+# redis server, one item per round trip versus batched.
+#
+#   bebop-redis-bench --host localhost --count 100000
+#
+
+import argparse
+import time
+
+import redis
+
+import sra_sample
+from hpc import work_queue, work_item
+from hpc.local_redis import LocalRedis
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark redis work-list seeding and dequeue")
+    parser.add_argument("--host", default="localhost", help="Redis host")
+    parser.add_argument("--local", action="store_true", help="Use the in-process redis stand-in instead of a server")
+    parser.add_argument("--count", type=int, default=100000, help="Number of items")
+    parser.add_argument("--chunk", type=int, default=1000, help="Items per LPUSH for batched seeding")
+    parser.add_argument("--batch", type=int, default=16, help="Items per pop for batched dequeue")
+    parser.add_argument("--list", default="sra-bench", help="Redis list to use")
+    args = parser.parse_args()
+
+    conn = LocalRedis() if args.local else redis.Redis(host=args.host)
+    items = [sra_sample.SraSample(f"SRR{i:07d}", i, "/tmp") for i in range(args.count)]
+    codec = work_item.Codec("/tmp")
+
+    def run(label, seed_chunk, pop_batch):
+        conn.delete(args.list)
+
+        start = time.time()
+        work_queue.seed(conn, items, args.list, chunk=seed_chunk, chunks_per_round_trip=1 if seed_chunk == 1 else 10,
+                        codec=codec)
+        seed_time = time.time() - start
+
+        source = work_queue.ListSource(conn, args.list, codec)
+        n = 0
+        start = time.time()
+        while True:
+            got = source.pop_many(pop_batch)
+            if not got:
+                break
+            n += len(got)
+        pop_time = time.time() - start
+
+        print(f"{label}\tseed {seed_time:.3f} s ({args.count / seed_time:.0f}/s)\t"
+              f"dequeue {pop_time / max(n, 1) * 1e6:.1f} us/item ({n} items)")
+
+    run("per-item", 1, 1)
+    run("batched", args.chunk, args.batch)
+    conn.delete(args.list)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#
+# Maintain and query the runtime history database for bebop output trees.
+#
+#   bebop-runtime-db runtime.db scan /path/to/output [/path/to/output2 ...]
+#   bebop-runtime-db runtime.db hosts
+#   bebop-runtime-db runtime.db export-history history.tsv
+#
+
+import argparse
+import sys
+import time
+
+from hpc import runtime_db
+
+def fmt(v, spec=".1f"):
+    if v is None:
+        return ""
+    return format(v, spec)
+
+def main():
+    parser = argparse.ArgumentParser(description="Runtime history database for bebop output trees")
+    parser.add_argument("db", help="SQLite database file")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("scan", help="Load new and changed samples from output trees")
+    p.add_argument("base", nargs="+", help="Output tree base directory")
+    p.add_argument("--full", action="store_true", help="Rescan every prefix directory and sample")
+    p.add_argument("--workers", type=int, default=16, help="Number of directories to scan in parallel")
+
+    p = sub.add_parser("throughput", help="Samples completed per time bucket")
+    p.add_argument("--bucket", type=int, default=3600, help="Bucket size in seconds")
+
+    sub.add_parser("hosts", help="Per-host sample counts and times")
+    sub.add_parser("stages", help="Assembly and annotation time distribution")
+    sub.add_parser("size", help="Assembly time against input size")
+
+    p = sub.add_parser("export-history", help="Write a runtime history file for bebop-computeall --runtime-history")
+    p.add_argument("output", help="Output file")
+
+    args = parser.parse_args()
+
+    conn = runtime_db.open_db(args.db)
+
+    if args.command == "scan":
+        start = time.time()
+        n = runtime_db.scan(conn, args.base, full=args.full, workers=args.workers, log=sys.stderr)
+        print(f"Loaded {n} samples in {time.time() - start:.1f} seconds", file=sys.stderr)
+
+    elif args.command == "throughput":
+        print("bucket_start\tcount\tmean_elapsed")
+        for b, n, elapsed in runtime_db.throughput(conn, args.bucket):
+            ts = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(b))
+            print(f"{ts}\t{n}\t{fmt(elapsed)}")
+
+    elif args.command == "hosts":
+        print("host\tcount\tmean_assembly\tmean_annotation\tsamples_per_hour")
+        for host, n, asm, anno, rate in runtime_db.hosts(conn):
+            print(f"{host}\t{n}\t{fmt(asm)}\t{fmt(anno)}\t{fmt(rate)}")
+
+    elif args.command == "stages":
+        print("stage\tcount\tmean\tmedian\tp95")
+        for stage, n, mean, median, p95 in runtime_db.stages(conn):
+            print(f"{stage}\t{n}\t{fmt(mean)}\t{fmt(median)}\t{fmt(p95)}")
+
+    elif args.command == "size":
+        print("input_bytes_min\tcount\tmean_elapsed\tmean_threads")
+        for b, n, elapsed, threads in runtime_db.size_vs_time(conn):
+            print(f"{b}\t{n}\t{fmt(elapsed)}\t{fmt(threads)}")
+
+    elif args.command == "export-history":
+        with open(args.output, "w") as fh:
+            n = runtime_db.export_history(conn, fh)
+        print(f"Wrote {n} samples to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
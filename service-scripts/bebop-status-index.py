@@ -0,0 +1,55 @@
+#
+# Status report and index maintenance for bebop output trees.
+#
+#   bebop-status-index pending sra-ids base-dir [base-dir...]
+#       Print the ids that do not yet have a GTO, as bebop-check-status does.
+#
+#   bebop-status-index rebuild base-dir [base-dir...]
+#       Rewrite the per-prefix status manifests from a scan of the samples.
+#
+
+import argparse
+import re
+import sys
+import time
+
+from hpc import status_index
+
+def main():
+    parser = argparse.ArgumentParser(description="Status report and index maintenance for bebop output trees")
+    parser.add_argument("--workers", type=int, default=16, help="Number of prefix directories to read in parallel")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("pending", help="Print the SRA ids that do not have the given output")
+    p.add_argument("sra_ids", help="File of SRA ids")
+    p.add_argument("base", nargs="+", help="Output tree base directory")
+    p.add_argument("--suffix", default="gto", help="Output suffix that marks a sample as done")
+    p.add_argument("--verify", action="store_true", help="Check manifest entries against the outputs themselves")
+
+    p = sub.add_parser("rebuild", help="Rewrite the status manifests from a scan of the samples")
+    p.add_argument("base", nargs="+", help="Output tree base directory")
+
+    args = parser.parse_args()
+
+    if args.command == "pending":
+        ids = []
+        with open(args.sra_ids) as fh:
+            for line in fh:
+                id = line.rstrip("\n").split("\t")[0]
+                if re.match(r"[A-Z]{3}\d{7}", id):
+                    ids.append(id)
+
+        done = status_index.completed(args.base, {id[0:7] for id in ids}, args.suffix, args.workers,
+                                      ids=set(ids), verify=args.verify)
+        for id in ids:
+            if id not in done:
+                print(id)
+
+    elif args.command == "rebuild":
+        for base in args.base:
+            start = time.time()
+            n = status_index.rebuild(base, workers=args.workers)
+            print(f"Rebuilt {n} manifests in {base} in {time.time() - start:.1f} seconds", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+#
+# Align consensus sequences to the reference, writing mafft-style
+# .align files, many samples at a time.
+#
+
+import sys
+import consensus_align
+
+if __name__ == "__main__":
+    sys.exit(consensus_align.main())
@@ -0,0 +1,138 @@
+=head1 NAME
+
+    sars2-annotate-batch - annotate several SARS2 genomes in one p3x-annotate-vigor4 run
+
+=head1 SYNOPSIS
+
+    sars2-annotate-batch work-dir raw-1.gto out-1.gto [raw-2.gto out-2.gto ...]
+
+=head1 DESCRIPTION
+
+Running p3x-annotate-vigor4 once per genome pays the VIGOR4 startup and
+reference database load for every sample. Here we merge the contigs of
+the given raw GTOs into one GTO, annotate that in a single run in
+work-dir, and split the resulting features back into one annotated GTO
+per input.
+
+Contigs are renamed in the merged GTO so that each one maps back to its
+genome. Feature ids are renumbered per genome and type, so each output
+has the ids it would get from annotating it alone. A new analysis event
+goes to the genomes whose features it created; an event that created no
+features describes the run as a whole and goes to every genome.
+
+Any other top-level section that the annotation adds or changes was
+computed on the merged genome and cannot be split between the genomes,
+so we treat it as a failure and the caller annotates the genomes singly.
+
+Exits nonzero, writing no outputs, if the annotation fails or cannot be
+split.
+
+=cut
+
+use strict;
+use Getopt::Long::Descriptive;
+use IPC::Run 'run';
+use File::Path 'make_path';
+use File::Spec;
+use JSON::XS;
+use GenomeTypeObject;
+
+my($opt, $usage) = describe_options("%c %o work-dir raw.gto out.gto [raw.gto out.gto ...]",
+				    ["annotate-command=s" => "Annotation command", { default => "p3x-annotate-vigor4" }],
+				    ["help|h" => "Show this help message"],
+				   );
+print($usage->text), exit 0 if $opt->help;
+die($usage->text) if @ARGV < 3 || @ARGV % 2 != 1;
+
+my $work_dir = File::Spec->rel2abs(shift);
+my @pairs;
+push(@pairs, [splice(@ARGV, 0, 2)]) while @ARGV;
+
+make_path($work_dir);
+
+#
+# Merge the raw genomes. The merged genome takes its top-level data from
+# the first one; all of ours are SARS-CoV-2 so the annotation settings
+# are the same.
+#
+
+my @genomes = map { GenomeTypeObject->new({ file => $_->[0] }) } @pairs;
+
+my $merged = GenomeTypeObject->new;
+for my $k (keys %{$genomes[0]})
+{
+    next if $k =~ /^_/ || $k eq 'contigs' || $k eq 'features';
+    $merged->{$k} = $genomes[0]->{$k};
+}
+my $merged_id = $merged->{id};
+
+my %contig_owner;
+my @contigs;
+for my $i (0 .. $#genomes)
+{
+    my $j = 0;
+    for my $ctg (@{$genomes[$i]->{contigs}})
+    {
+	my $id = "g${i}_" . $j++;
+	$contig_owner{$id} = [$i, $ctg->{id}];
+	push(@contigs, { %$ctg, id => $id });
+    }
+}
+$merged->add_contigs(\@contigs);
+my $n_raw_events = @{$merged->{analysis_events} // []};
+
+my $json = JSON::XS->new->canonical;
+my %raw_value = map { $_ => $json->encode([$merged->{$_}]) } grep { !/^_/ } keys %$merged;
+
+$merged->destroy_to_file("$work_dir/batch.raw.gto", { canonical => 1 });
+
+my @cmd = ($opt->annotate_command, "-i", "$work_dir/batch.raw.gto", "-o", "$work_dir/batch.gto");
+print STDERR "Annotate @{[scalar @genomes]} genomes: @cmd\n";
+my $ok = run(\@cmd, init => sub { chdir($work_dir) or die "Cannot chdir $work_dir: $!" });
+$ok or die "Annotation failed with status $?: @cmd\n";
+
+my $annotated = GenomeTypeObject->new({ file => "$work_dir/batch.gto" });
+
+my @unsplit = grep { !/^_/ && $_ ne 'features' && $_ ne 'analysis_events' &&
+			 (!exists($raw_value{$_}) || $json->encode([$annotated->{$_}]) ne $raw_value{$_}) }
+    sort keys %$annotated;
+@unsplit and die "Annotation added or changed genome-level data that cannot be split: @unsplit\n";
+
+#
+# Split the features back out, noting which genomes each creation event
+# made features for.
+#
+
+my %event_owners;
+my @counters = map { {} } @genomes;
+for my $feature (@{$annotated->{features}})
+{
+    my $owner;
+    for my $loc (@{$feature->{location}})
+    {
+	my $map = $contig_owner{$loc->[0]} or die "Feature $feature->{id} on unknown contig $loc->[0]\n";
+	!defined($owner) || $owner == $map->[0] or die "Feature $feature->{id} spans genomes\n";
+	$owner = $map->[0];
+	$loc->[0] = $map->[1];
+    }
+    defined($owner) or die "Feature $feature->{id} has no location\n";
+
+    my $gid = $genomes[$owner]->{id};
+    if ($feature->{id} =~ /^(.*)\Q$merged_id\E\.([^.]+)\.\d+$/)
+    {
+	my $n = ++$counters[$owner]->{$2};
+	$feature->{id} = "$1$gid.$2.$n";
+    }
+    $event_owners{$feature->{feature_creation_event}}->{$owner} = 1 if $feature->{feature_creation_event};
+    push(@{$genomes[$owner]->{features}}, $feature);
+}
+
+my @events = @{$annotated->{analysis_events} // []};
+splice(@events, 0, $n_raw_events);
+
+for my $i (0 .. $#genomes)
+{
+    my $gto = $genomes[$i];
+    push(@{$gto->{analysis_events}}, grep { my $o = $event_owners{$_->{id} // ''}; !$o || $o->{$i} } @events);
+    $gto->destroy_to_file($pairs[$i]->[1], { canonical => 1 });
+}
@@ -0,0 +1,64 @@
+#
+# Compare per-command latency of running a command as a new process versus
+# on a sars2-assembly-server, for small inputs where startup dominates.
+#
+#   sars2-assembly-bench --socket /tmp/asm.sock --start-server --count 20 \
+#       -- sars2-onecodex small_1.fq small_2.fq SRR1 /tmp/bench-out --threads 1
+#
+# With no command given we time sars2-onecodex --help, which is the
+# interpreter and module startup alone.
+#
+
+import argparse
+import os
+import statistics
+import subprocess
+import time
+
+from hpc import assembly_server
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark exec-per-command against sars2-assembly-server")
+    parser.add_argument("--socket", required=True, help="Assembly server socket")
+    parser.add_argument("--start-server", action="store_true", help="Start a server at --socket for the benchmark")
+    parser.add_argument("--script-dir", action="append", default=[], help="Script directory for a started server")
+    parser.add_argument("--count", type=int, default=10, help="Runs per mode")
+    parser.add_argument("--output", default="/tmp", help="Directory for the commands' stdout and stderr")
+    parser.add_argument("command", nargs="*", help="Command to run")
+    args = parser.parse_args()
+
+    cmd = args.command or ["sars2-onecodex", "--help"]
+    stdout = os.path.join(args.output, "bench.stdout")
+    stderr = os.path.join(args.output, "bench.stderr")
+
+    proc = None
+    if args.start_server:
+        start = time.time()
+        proc = assembly_server.start(args.socket, args.script_dir, [cmd[0]])
+        print(f"server startup {time.time() - start:.3f} s")
+    client = assembly_server.Client(args.socket)
+
+    def direct():
+        with open(stdout, "w") as out, open(stderr, "w") as err:
+            return subprocess.run(cmd, stdout=out, stderr=err).returncode
+
+    def served():
+        return client.run(cmd, stdout, stderr)
+
+    try:
+        for label, fn in (("exec", direct), ("server", served)):
+            times = []
+            for i in range(args.count):
+                start = time.time()
+                rc = fn()
+                times.append(time.time() - start)
+            print(f"{label}\tmean {statistics.mean(times) * 1000:.1f} ms\t"
+                  f"median {statistics.median(times) * 1000:.1f} ms\t"
+                  f"min {min(times) * 1000:.1f} ms\tlast status {rc}")
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+if __name__ == "__main__":
+    main()
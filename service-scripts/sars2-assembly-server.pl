@@ -0,0 +1,207 @@
+=head1 NAME
+
+    sars2-assembly-server - run assembly and annotation scripts from a preloaded server
+
+=head1 SYNOPSIS
+
+    sars2-assembly-server --socket /scratch/asm.sock [--script name ...]
+
+=head1 DESCRIPTION
+
+Starting sars2-onecodex, p3x-create-sars-gto and p3x-annotate-vigor4 as
+fresh processes costs the perl startup plus the loading of PDL, JSON::XS,
+IPC::Run, Getopt::Long::Descriptive and friends for every sample, which on
+small samples is a noticeable fraction of the runtime.
+
+This server loads the modules used by the scripts it serves once, then
+listens on a Unix socket. Each job is one JSON line naming the script, its
+arguments, working directory and output files:
+
+    {"command": "sars2-onecodex", "args": [...], "cwd": "/out/SRR1",
+     "stdout": "/out/SRR1/assemble.stdout", "stderr": "/out/SRR1/assemble.stderr",
+     "append": 0, "cpus": [4, 5, 6, 7], "env": {"TMPDIR": "/scratch/SRR1", ...}}
+
+If env is given the script runs with exactly that environment (the
+client sends its own, so P3_ALLOCATED_CPU, TMPDIR and the SLURM_
+variables are the job's rather than the server's).
+
+For each job we fork, and the child runs the script with C<do> in the
+already-loaded interpreter, so the script keeps its usual exit, die and
+global-variable behavior. When it exits the server replies with one JSON
+line:
+
+    {"status": 0, "signal": 0, "elapsed": 12.3}
+
+where status is the exit code as a process exit would give it. Jobs run
+concurrently, one process each.
+
+Scripts are found as NAME.pl in the --script-dir directories, then in
+$KB_TOP/plbin. Only the scripts given with --script may be run.
+
+=cut
+
+use strict;
+use Getopt::Long::Descriptive;
+use IO::Socket::UNIX;
+use POSIX ':sys_wait_h';
+use JSON::XS;
+use Time::HiRes 'gettimeofday';
+use Cwd 'abs_path';
+
+my($opt, $usage) = describe_options("%c %o",
+				    ["socket=s" => "Listen on this Unix socket path", { required => 1 }],
+				    ["script=s@" => "Script that may be run (repeatable)",
+				     { default => [qw(sars2-onecodex p3x-create-sars-gto p3x-annotate-vigor4)] }],
+				    ["script-dir=s@" => "Directory holding the scripts as NAME.pl (repeatable)", { default => [] }],
+				    ["preload=s@" => "Additional module to load at startup (repeatable)", { default => [] }],
+				    ["help|h" => "Show this help message"],
+				   );
+print($usage->text), exit 0 if $opt->help;
+die($usage->text) if @ARGV != 0;
+
+my @script_dirs = @{$opt->script_dir};
+push(@script_dirs, "$ENV{KB_TOP}/plbin") if $ENV{KB_TOP};
+
+my %scripts;
+for my $name (@{$opt->script})
+{
+    my($path) = grep { -f $_ } map { "$_/$name.pl" } @script_dirs;
+    $path or die "Cannot find $name.pl in @script_dirs\n";
+    $scripts{$name} = abs_path($path);
+}
+
+#
+# Load the modules the scripts use. We only require them here; the
+# scripts' own use statements do the imports when they run.
+#
+
+my $start = gettimeofday;
+my %preload = map { $_ => 1 } @{$opt->preload};
+for my $path (values %scripts)
+{
+    open(S, "<", $path) or die "Cannot read $path: $!";
+    while (<S>)
+    {
+	last if /^__(END|DATA)__/;
+	$preload{$1} = 1 if /^use\s+([A-Za-z][\w:]*).*;\s*$/ && $1 !~ /^(strict|warnings|base|parent|lib|constant|vars)$/;
+    }
+    close(S);
+}
+for my $mod (sort keys %preload)
+{
+    eval "require $mod; 1" or warn "Cannot preload $mod: $@";
+}
+printf STDERR "Loaded %d modules in %.2f seconds\n", scalar keys %preload, gettimeofday - $start;
+
+unlink($opt->socket);
+my $listen = IO::Socket::UNIX->new(Type => SOCK_STREAM, Local => $opt->socket, Listen => 128)
+    or die "Cannot listen on " . $opt->socket . ": $!";
+
+my $running = 1;
+$SIG{TERM} = $SIG{INT} = sub { $running = 0 };
+$SIG{CHLD} = 'IGNORE';
+
+print STDERR "Listening on " . $opt->socket . " for @{[sort keys %scripts]}\n";
+while ($running)
+{
+    my $conn = $listen->accept();
+    next unless $conn;
+
+    my $pid = fork;
+    if (!defined($pid))
+    {
+	warn "Cannot fork: $!";
+	close($conn);
+	next;
+    }
+    if ($pid == 0)
+    {
+	close($listen);
+	$SIG{CHLD} = 'DEFAULT';
+	$SIG{TERM} = $SIG{INT} = 'DEFAULT';
+	handle_job($conn);
+	exit 0;
+    }
+    close($conn);
+}
+unlink($opt->socket);
+
+sub handle_job
+{
+    my($conn) = @_;
+
+    my $line = <$conn>;
+    return unless defined($line);
+    my $job = eval { decode_json($line) };
+    my $path = $job && $scripts{$job->{command}};
+    if (!$path)
+    {
+	print $conn encode_json({ status => 127, signal => 0, elapsed => 0,
+				  error => $@ || "Unknown command $job->{command}" }), "\n";
+	return;
+    }
+
+    my $start = gettimeofday;
+    my $pid = fork;
+    if (!defined($pid))
+    {
+	print $conn encode_json({ status => 127, signal => 0, elapsed => 0, error => "Cannot fork: $!" }), "\n";
+	return;
+    }
+    if ($pid == 0)
+    {
+	close($conn);
+	run_script($path, $job);
+    }
+    waitpid($pid, 0);
+    my $rc = $?;
+    my $end = gettimeofday;
+
+    print $conn encode_json({ status => $rc >> 8, signal => $rc & 127, elapsed => $end - $start }), "\n";
+}
+
+#
+# In the job's child process: set up the job's files and run the script.
+# Does not return.
+#
+
+sub run_script
+{
+    my($path, $job) = @_;
+
+    if (ref($job->{env}) eq 'HASH')
+    {
+	%ENV = %{$job->{env}};
+    }
+
+    my $mode = $job->{append} ? ">>" : ">";
+    open(STDIN, "<", "/dev/null");
+    if ($job->{stdout})
+    {
+	open(STDOUT, $mode, $job->{stdout}) or die "Cannot open $job->{stdout}: $!";
+    }
+    if ($job->{stderr})
+    {
+	open(STDERR, $mode, $job->{stderr}) or die "Cannot open $job->{stderr}: $!";
+    }
+    if ($job->{cwd})
+    {
+	chdir($job->{cwd}) or die "Cannot chdir $job->{cwd}: $!";
+    }
+    if (ref($job->{cpus}) && @{$job->{cpus}})
+    {
+	system("taskset -pc " . join(",", map { int } @{$job->{cpus}}) . " $$ > /dev/null") == 0
+	    or warn "Cannot set affinity to @{$job->{cpus}}\n";
+    }
+
+    $0 = $path;
+    @ARGV = @{$job->{args} // []};
+
+    do $path;
+    if ($@)
+    {
+	print STDERR $@;
+	exit 255;
+    }
+    exit 0;
+}
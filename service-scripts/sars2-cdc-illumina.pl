@@ -21,6 +21,7 @@ use strict;
 use Getopt::Long::Descriptive;
 use Bio::P3::SARS2Assembly;
 use Bio::P3::CmdRunner;
+use Bio::P3::ReferenceCache;
 use File::Basename;
 use File::Temp;
 use JSON::XS;
@@ -34,6 +35,7 @@ my($opt, $usage) = describe_options("%c %o output-base output-dir",
 				    ["min-depth|d=i" => "Minimum depth required to call bases in consensus", { default => 100 }],
 				    ["minimum-read-length=i" => "Set a minimum read length to use for assembly"],
 				    ["keep-intermediates|k" => "Save all intermediate files"],
+				    ["reference-cache=s" => "Directory of prepared references and bowtie2 indexes shared between runs", { default => $ENV{SARS2_REFERENCE_CACHE} }],
 				    ["help|h"      => "Show this help message"],
 				    );
 
@@ -129,6 +131,40 @@ open(ROUT, ">", $reference) or die "Cannot open reference $reference: $!";
     }
     close(RIN);
     close(ROUT);
+}
+
+#
+# The bowtie2 index is built from $reference, whose contig is named for this
+# sample. With a reference cache we instead use a shared index built with the
+# reference's own contig name, and rename the contig in the BAM header
+# after mapping so the outputs are the same.
+#
+my $bowtie_index = $reference;
+my $cached_contig;
+if ($opt->reference_cache)
+{
+    my $cache = Bio::P3::ReferenceCache->new($opt->reference_cache);
+    my $entry = $cache->get($reference_base, ["cdc-illumina", "bowtie2"], sub {
+	my($dir) = @_;
+	open(RIN, "<", $reference_base) or die "Cannot open reference $reference_base: $!";
+	open(ROUT, ">", "$dir/reference.fasta") or die "Cannot open $dir/reference.fasta: $!";
+	while (<RIN>)
+	{
+	    s/^(>\S+).*$/$1/;
+	    print ROUT $_;
+	}
+	close(RIN);
+	close(ROUT);
+	$runner->run(["bowtie2-build", "$dir/reference.fasta", "$dir/reference.fasta"]);
+    });
+    $bowtie_index = "$entry/reference.fasta";
+
+    open(RIN, "<", $bowtie_index) or die "Cannot open $bowtie_index: $!";
+    ($cached_contig) = <RIN> =~ /^>(\S+)/;
+    close(RIN);
+}
+else
+{
     $runner->run(["bowtie2-build", $reference, $reference]);
 }
 
@@ -193,7 +229,7 @@ if ($mode eq 'PE')
     my @bowtie = ("bowtie2",
 		  "--sensitive-local",
 		  "-p", $threads,
-		  "-x", $reference,
+		  "-x", $bowtie_index,
 		  "-1", $trim1,
 		  "-2", $trim2,
 		  "-S", $samfile);
@@ -229,7 +265,7 @@ elsif ($mode eq 'SE')
     my @bowtie = ("bowtie2",
 	      "--sensitive-local",
 	      "-p", $threads,
-	      "-x", $reference,
+	      "-x", $bowtie_index,
 	      "-U", $trim,
 	      "-S", $samfile);
     $runner->run(\@bowtie, '2>', "$out_dir/bowtie2.err");
@@ -243,6 +279,19 @@ $runner->run(["samtools", "view", "-b", $samfile],
 	 "|",
 	 ["samtools", "sort", "-", "--threads", $threads, "-o", $bamfile]);
 
+if ($cached_contig)
+{
+    my $hdr;
+    $runner->run(["samtools", "view", "-H", $bamfile], '>', \$hdr);
+    $hdr =~ s/^(\@SQ\t.*SN:)\Q$cached_contig\E(\t|$)/$1$output_name$2/m;
+    my $hdr_file = "$int_dir/$base.header.sam";
+    open(H, ">", $hdr_file) or die "Cannot write $hdr_file: $!";
+    print H $hdr;
+    close(H);
+    $runner->run(["samtools", "reheader", $hdr_file, $bamfile], '>', "$bamfile.tmp");
+    rename("$bamfile.tmp", $bamfile) or die "Cannot rename $bamfile.tmp to $bamfile: $!";
+}
+
 $runner->run(["samtools", "index", $bamfile]);
 
 #
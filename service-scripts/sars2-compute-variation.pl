@@ -2,36 +2,67 @@
 # Given a GTO, compute variation using
 #
 # Pangolin
-# Jim's sars2-get-blast-variants
+# Jim's sars2-get-blast-variants (computed in-process by Bio::P3::SpikeVariants
+# unless --blast-variants is given)
 # (When ready) Maulik's alignment-based tool
 #
 
 use gjoseqlib;
 use strict;
 use Data::Dumper;
-use GenomeTypeObject;
-use Bio::P3::SARS2Assembly qw(reference_spike_aa_path mpath add_variants_to_gto add_quality_estimate_to_gto);
+use Bio::P3::LazyGTO;
+use Bio::P3::SpikeVariants;
+use Bio::P3::SARS2Assembly qw(reference_spike_aa_path reference_fasta_path mpath add_variants_to_gto add_quality_estimate_to_gto);
 use Getopt::Long::Descriptive;
 use IPC::Run qw(run);
 use Text::CSV qw(csv);
+use JSON::XS;
+use Digest::SHA 'sha256_hex';
 
 my($opt, $usage) = describe_options("%c %o",
 				    ["variants=s" => "Add variants.tsv from assembly"],
+				    ["blast-variants" => "Compute spike variants with sars2-get-blast-variants instead of in-process"],
 				    ["input|i=s" => "Input file"],
 				    ["output|o=s" => "Output file"],
+				    [],
+				    ["batch-list=s" => "Batch mode: file of input GTO paths, each optionally followed by output GTO and variants.tsv paths, tab separated"],
+				    ["batch-dir=s" => "Batch mode: compute variation for each .gto file in this directory"],
+				    ["output-dir=s" => "Batch mode: directory for output GTOs not given in the batch list"],
+				    ["batch-size=i" => "Batch mode: genomes per pangolin run", { default => 500 }],
+				    ["relineage" => "Batch mode: only replace pangolin lineages made with other pangolin versions, in place unless outputs are given"],
+				    ["lineage-index=s" => "Relineage: index of lineages by consensus sequence, reused across runs"],
+				    [],
 				    ["debug|d" => "Enable debugging"],
 				    ["help|h" => "Show this help message"]);
 print($usage->text), exit 0 if $opt->help;
 die($usage->text) if @ARGV != 0;
 
-my $genome_in = GenomeTypeObject->create_from_file($opt->input);
-$genome_in or die "Error reading and parsing input";
-
-my $contigs = $genome_in->extract_contig_sequences_to_temp_file();
-
 my $sequence_features = load_sequence_features(mpath . "/spike.sf");
 my $loc = load_loc(mpath . "/spike.loc");
 
+#
+# We only read the contigs (and the spike features, in maulik_mafft),
+# and only write back the computed variants and quality blocks.
+#
+our @ReadKeys = qw(contigs);
+our @UpdateKeys = qw(computed_variants quality);
+
+if ($opt->relineage)
+{
+    die "--relineage requires --batch-list or --batch-dir\n" unless $opt->batch_list || $opt->batch_dir;
+    relineage_batch();
+    exit 0;
+}
+elsif ($opt->batch_list || $opt->batch_dir)
+{
+    compute_batch();
+    exit 0;
+}
+
+my $genome_in = Bio::P3::LazyGTO->new($opt->input, read => \@ReadKeys, update => \@UpdateKeys);
+
+my $contigs = $genome_in->extract_contig_sequences_to_temp_file();
+
 eval {
     if ($opt->variants)
     {
@@ -50,12 +81,364 @@ if ($@)
 
 unlink($contigs);
 
-$genome_in->destroy_to_file($opt->output, { canonical => 1 });
+$genome_in->write($opt->output, { canonical => 1 });
+
+#
+# Batch mode. Pangolin loads its models on every start, which dominates the
+# time to assign a lineage to one genome, so we pull the contigs of a
+# batch of genomes into one FASTA file, run pangolin once, and hand each
+# genome the lineage row for its first contig, as the single genome code
+# does. The spike caller and the sequence feature tables are loaded once
+# for the whole run; mafft still runs per genome.
+#
+
+sub compute_batch
+{
+    my @jobs = batch_jobs();
+
+    my $n = 0;
+    while (my @batch = splice(@jobs, 0, $opt->batch_size))
+    {
+	my @genomes;
+	my $fasta = File::Temp->new(SUFFIX => ".fa");
+	for my $job (@batch)
+	{
+	    my $gto = eval { Bio::P3::LazyGTO->new($job->[0], read => \@ReadKeys, update => \@UpdateKeys) };
+	    if (!$gto)
+	    {
+		warn "Error reading and parsing $job->[0]: $@";
+		next;
+	    }
+
+	    #
+	    # Sequence names are our own so pangolin sees nothing it might
+	    # rewrite; we put the contig ID back in the lineage row.
+	    #
+	    my $i = @genomes;
+	    my @names;
+	    for my $ctg (@{$gto->{contigs}})
+	    {
+		my $name = "g${i}_" . scalar(@names);
+		push(@names, [$name, $ctg->{id}]);
+		print $fasta ">$name\n$ctg->{dna}\n";
+	    }
+	    push(@genomes, [$job, $gto, \@names]);
+	}
+	close($fasta);
+	next unless @genomes;
+
+	my $rows = run_pangolin("$fasta");
+	my %lineage;
+	for my $row (@{$rows // []})
+	{
+	    $lineage{$row->{taxon}} = $row;
+	}
+
+	for my $g (@genomes)
+	{
+	    my($job, $gto, $names) = @$g;
+	    eval {
+		if ($job->[2])
+		{
+		    add_variants_to_gto($job->[2], $gto);
+		}
+		if ($rows)
+		{
+		    my($first) = grep { $lineage{$_->[0]} } @$names;
+		    if ($first)
+		    {
+			my $lin = { %{$lineage{$first->[0]}}, taxon => $first->[1] };
+			push(@{$gto->{computed_variants}}, pangolin_variant($lin));
+		    }
+		    else
+		    {
+			warn "No pangolin lineage for $job->[0]\n";
+		    }
+		}
+		my $contigs;
+		$contigs = $gto->extract_contig_sequences_to_temp_file() if $opt->blast_variants;
+		get_blast_variants($gto, $contigs);
+		unlink($contigs) if $contigs;
+		maulik_mafft($gto, $sequence_features, $loc);
+		add_quality_estimate_to_gto($gto);
+	    };
+	    if ($@)
+	    {
+		warn "Evaluation failure for $job->[0]: $@";
+	    }
+	    $gto->write($job->[1], { canonical => 1 });
+	}
+	$n += @genomes;
+	print STDERR "Computed variation for $n genomes\n";
+    }
+}
+
+#
+# The jobs for batch mode: input GTO, output GTO and variants.tsv paths.
+# Outputs not given in the batch list go to --output-dir, or with
+# $in_place replace the input if there is no --output-dir.
+#
+
+sub batch_jobs
+{
+    my($in_place) = @_;
+
+    my @jobs;
+    if ($opt->batch_list)
+    {
+	open(L, "<", $opt->batch_list) or die "Cannot open batch list " . $opt->batch_list . ": $!";
+	while (<L>)
+	{
+	    chomp;
+	    next unless /\S/;
+	    my($in, $out, $variants) = split(/\t/);
+	    push(@jobs, [$in, $out, $variants]);
+	}
+	close(L);
+    }
+    if ($opt->batch_dir)
+    {
+	my $dir = $opt->batch_dir;
+	opendir(D, $dir) or die "Cannot open batch directory $dir: $!";
+	push(@jobs, map { ["$dir/$_"] } sort grep { /\.gto$/ && -f "$dir/$_" } readdir(D));
+	closedir(D);
+    }
+
+    for my $job (@jobs)
+    {
+	next if $job->[1];
+	if (!$opt->output_dir)
+	{
+	    $in_place or die "No output GTO for $job->[0] and no --output-dir given\n";
+	    $job->[1] = $job->[0];
+	    next;
+	}
+	my $base = $job->[0];
+	$base =~ s,.*/,,;
+	$job->[1] = $opt->output_dir . "/$base";
+    }
+    if ($opt->output_dir && ! -d $opt->output_dir)
+    {
+	mkdir($opt->output_dir) or die "Cannot mkdir " . $opt->output_dir . ": $!";
+    }
+    return @jobs;
+}
+
+#
+# Incremental lineage assignment. After a pangolin or pangolin-data
+# release we only need new lineages, so here we run pangolin once on the
+# reference to learn the current versions, and for each GTO whose pangolin
+# entry was made with other versions, replace that entry in place with a
+# current one; the other computed variants are left alone, and GTOs that
+# are current are not rewritten.
+#
+# The versions compared are those of the tools and data only. Pangolin's
+# per-sequence version column names the assignment method too (PANGO-,
+# PUSHER-, PLEARN-), which differs between the reference and most genomes,
+# so only its data release is compared.
+#
+# The lineage index (--lineage-index) maps a hash of the consensus
+# sequence to its lineage row under the versions it was computed with.
+# Genomes with the same consensus, in this run or an earlier one with the
+# same versions, share one pangolin assignment. Entries for other versions
+# are dropped from the index when it is loaded.
+#
+
+sub relineage_batch
+{
+    my @jobs = batch_jobs(1);
+
+    my $probe = run_pangolin(reference_fasta_path);
+    $probe && @$probe or die "Cannot determine current pangolin versions\n";
+    my @vkeys = sort grep { /version/ } keys %{$probe->[0]};
+    my $current = version_signature($probe->[0], \@vkeys);
+    print STDERR "Current pangolin versions: $current\n";
+
+    my %index;
+    my $index_fh;
+    if (my $path = $opt->lineage_index)
+    {
+	my $stale = 0;
+	if (open(my $fh, "<", $path))
+	{
+	    while (<$fh>)
+	    {
+		chomp;
+		my($hash, $sig, $json) = split(/\t/, $_, 3);
+		if ($sig eq $current && !$index{$hash})
+		{
+		    $index{$hash} = decode_json($json);
+		}
+		else
+		{
+		    $stale++;
+		}
+	    }
+	    close($fh);
+	}
+	if ($stale)
+	{
+	    print STDERR "Compacting lineage index $path: dropping $stale stale entries\n";
+	    open(my $fh, ">", "$path.tmp.$$") or die "Cannot write $path.tmp.$$: $!";
+	    print $fh join("\t", $_, $current, encode_json($index{$_})), "\n" foreach sort keys %index;
+	    close($fh) or die "Error writing $path.tmp.$$: $!";
+	    rename("$path.tmp.$$", $path) or die "Cannot rename $path.tmp.$$ to $path: $!";
+	}
+	open($index_fh, ">>", $path) or die "Cannot append to lineage index $path: $!";
+	$index_fh->autoflush(1);
+    }
+
+    my($n_current, $n_indexed, $n_run, $n_failed) = (0, 0, 0, 0);
+    while (my @batch = splice(@jobs, 0, $opt->batch_size))
+    {
+	my @pending;
+	my %queued;
+	my $fasta = File::Temp->new(SUFFIX => ".fa");
+	for my $job (@batch)
+	{
+	    my $gto = eval { Bio::P3::LazyGTO->new($job->[0], read => ['contigs'], update => ['computed_variants']) };
+	    if (!$gto)
+	    {
+		warn "Error reading and parsing $job->[0]: $@";
+		$n_failed++;
+		next;
+	    }
+
+	    my($old) = grep { $_->{tool} eq 'pangolin' } @{$gto->{computed_variants}};
+	    if ($old && version_signature($old->{tool_metadata}, \@vkeys) eq $current)
+	    {
+		$n_current++;
+		$gto->write($job->[1], { canonical => 1 }) if $job->[1] ne $job->[0];
+		next;
+	    }
+
+	    my $hash = consensus_hash($gto);
+	    if ($index{$hash})
+	    {
+		$n_indexed++;
+		patch_lineage($gto, $index{$hash});
+		$gto->write($job->[1], { canonical => 1 });
+		next;
+	    }
+
+	    if (!$queued{$hash})
+	    {
+		my $j = 0;
+		for my $ctg (@{$gto->{contigs}})
+		{
+		    print $fasta ">h" . scalar(keys %queued) . "_" . $j++ . "\n$ctg->{dna}\n";
+		}
+		$queued{$hash} = "h" . scalar(keys %queued);
+	    }
+	    push(@pending, [$job, $gto, $hash]);
+	}
+	close($fasta);
+
+	my $rows = @pending ? run_pangolin("$fasta") : [];
+	my %by_name;
+	for my $row (@{$rows // []})
+	{
+	    my($name, $j) = $row->{taxon} =~ /^(h\d+)_(\d+)$/ or next;
+	    $by_name{$name} //= { contig => int($j), row => $row };
+	}
+	for my $hash (keys %queued)
+	{
+	    my $ent = $by_name{$queued{$hash}} or next;
+	    $index{$hash} = $ent;
+	    print $index_fh join("\t", $hash, $current, encode_json($ent)), "\n" if $index_fh;
+	}
+
+	for my $p (@pending)
+	{
+	    my($job, $gto, $hash) = @$p;
+	    if ($index{$hash})
+	    {
+		$n_run++;
+		patch_lineage($gto, $index{$hash});
+		$gto->write($job->[1], { canonical => 1 });
+	    }
+	    else
+	    {
+		warn "No pangolin lineage for $job->[0]\n";
+		$n_failed++;
+	    }
+	}
+	print STDERR "Relineage: $n_current current, $n_indexed from index, $n_run from pangolin, $n_failed failed\n";
+    }
+    close($index_fh) if $index_fh;
+}
+
+sub version_signature
+{
+    my($md, $vkeys) = @_;
+
+    my @sig;
+    for my $key (@$vkeys)
+    {
+	my $val = $md->{$key} // "";
+	#
+	# The version column is the assignment method and the data release,
+	# e.g. PUSHER-v1.21; only the release is the same for every genome.
+	#
+	$val =~ s/^[A-Za-z]+-// if $key eq 'version';
+	push(@sig, "$key=$val");
+    }
+    return join(";", @sig);
+}
+
+#
+# Hash of the consensus sequence: contig sequences in order, uppercased.
+#
+
+sub consensus_hash
+{
+    my($gto) = @_;
+    return sha256_hex(join(">", map { uc($_->{dna}) } @{$gto->{contigs}}));
+}
+
+#
+# Replace the GTO's pangolin entry, keeping its place among the computed
+# variants, with one for a lineage index entry.
+#
+
+sub patch_lineage
+{
+    my($gto, $ent) = @_;
+
+    my $ctg = $gto->{contigs}->[$ent->{contig}];
+    my $var = pangolin_variant({ %{$ent->{row}}, taxon => $ctg->{id} });
+
+    my $cv = $gto->{computed_variants} //= [];
+    my($i) = grep { $cv->[$_]->{tool} eq 'pangolin' } 0..$#$cv;
+    if (defined($i))
+    {
+	$cv->[$i] = $var;
+    }
+    else
+    {
+	push(@$cv, $var);
+    }
+}
 
 sub pangolin
 {
     my($gto, $contigs_file) = @_;
 
+    my $res = run_pangolin($contigs_file);
+    return unless $res;
+
+    push(@{$gto->{computed_variants}}, pangolin_variant($res->[0]));
+}
+
+#
+# Run pangolin on a contigs file. Returns the lineage rows, or nothing on
+# failure.
+#
+
+sub run_pangolin
+{
+    my($contigs_file) = @_;
+
     my $out = File::Temp->new();
     close($out);
     my $threads = $ENV{P3_ALLOCATED_CPU} // 1;
@@ -81,13 +464,11 @@ sub pangolin
 	return;
     }
 
-    my $lin = $res->[0];
-
     #
     # look up pangolin version
     #
     my $p_vers;
-    if (!$lin->{pangolin_version})
+    if (!$res->[0]->{pangolin_version})
     {
 	my $ok = run(["pangolin", "-v"], ">", \$p_vers);
 	if ($ok)
@@ -97,6 +478,13 @@ sub pangolin
 	}
     }
 
+    return $res;
+}
+
+sub pangolin_variant
+{
+    my($lin) = @_;
+
     my $tool_md = {};
     for my $vkey (grep { /version/ } keys %$lin)
     {
@@ -115,9 +503,11 @@ sub pangolin
 	notes => $lin->{note},
     };
 
-    push(@{$gto->{computed_variants}}, $var);
+    return $var;
 }
 
+our $SpikeCaller;
+
 sub get_blast_variants
 {
     my($gto, $contigs_file) = @_;
@@ -129,33 +519,50 @@ sub get_blast_variants
     close(R);
 
     my($out, $err);
+    my $engine;
     
-    my @cmd = ("sars2-get-blast-variants",
-	       "-b", "tblastn",
-	       "-r",
-	       "-q", $spike,
-	       "-s", $contigs_file);
-    print STDERR "@cmd\n";
-    my $ok = run(\@cmd, ">", \$out, '2>', \$err);
-    my $nohits;
-    if (!$ok)
+    if ($opt->blast_variants)
     {
-	my $rc = ($? >> 8);
-	if ($rc == 2)
+	my @cmd = ("sars2-get-blast-variants",
+		   "-b", "tblastn",
+		   "-r",
+		   "-q", $spike,
+		   "-s", $contigs_file);
+	print STDERR "@cmd\n";
+	my $ok = run(\@cmd, ">", \$out, '2>', \$err);
+	my $nohits;
+	if (!$ok)
 	{
-	    warn "No hits found\n";
-	    $nohits = 1;
+	    my $rc = ($? >> 8);
+	    if ($rc == 2)
+	    {
+		warn "No hits found\n";
+		$nohits = 1;
+	    }
+	    else
+	    {
+		warn "Error $? running @cmd\n$err\n";
+		return;
+	    }
 	}
-	else
+	$engine = "tblastn";
+    }
+    else
+    {
+	my $caller = $SpikeCaller //= Bio::P3::SpikeVariants->new(reference => $spike);
+	for my $ctg (@{$gto->{contigs}})
 	{
-	    warn "Error $? running @cmd\n$err\n";
-	    return;
+	    my $call = $caller->call($ctg->{id}, $ctg->{dna}) or next;
+	    $out .= $caller->format_call($call, 1);
 	}
+	warn "No hits found\n" unless $out;
+	$engine = "Bio::P3::SpikeVariants";
     }
 
     my $vlist = [];
     my $tv = {
 	tool => 'sars2-get-blast-variants',
+	tool_metadata => { engine => $engine },
 	variants => $vlist,
     };
 
@@ -198,11 +605,7 @@ sub maulik_mafft
     open(R, "<", reference_spike_aa_path) or die "Cannot open spike reference: $!";
     my($ref_id, $ref_def, $ref_seq) = read_next_fasta_seq(\*R);
 
-    my @spike_prots;
-    for my $feat ($gto->features)
-    {
-	push @spike_prots, $feat if $feat->{function} =~ /^(putative\s+)?surface\s+glycoprotein/;
-    }
+    my @spike_prots = $gto->features(sub { $_[0]->{function} =~ /^(putative\s+)?surface\s+glycoprotein/ });
 
     if (@spike_prots != 1)
     {
@@ -0,0 +1,10 @@
+#
+# Compute depth statistics and the coverage plots for a SARS2 assembly
+# in a single pass over the samtools depth output.
+#
+
+import sys
+import coverage_stats
+
+if __name__ == "__main__":
+    sys.exit(coverage_stats.main())
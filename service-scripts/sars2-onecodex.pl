@@ -22,7 +22,7 @@ The generated FASTA consensus sequence is written to output-dir/output-base.fast
 use strict;
 use Getopt::Long::Descriptive;
 use IPC::Run qw(run timeout start);
-use Bio::P3::SARS2Assembly qw(manifest artic_reference artic_bed run_cmds reference_gff_path artic_primer_schemes_path);
+use Bio::P3::SARS2Assembly qw(manifest primer_catalog artic_reference artic_bed run_cmds reference_gff_path artic_primer_schemes_path);
 use JSON::XS;
 use Data::Dumper;
 use File::Basename;
@@ -31,6 +31,7 @@ use File::Slurp;
 use Time::HiRes 'gettimeofday';
 use gjoseqlib;
 use Bio::P3::CmdRunner;
+use Bio::P3::ReferenceCache;
 use PDL;
 use PDL::Stats::Basic;
 use PDL::Ufunc;
@@ -38,14 +39,25 @@ use PDL::Ufunc;
 $ENV{PATH} = "$ENV{KB_RUNTIME}/samtools-1.11/bin:$ENV{KB_RUNTIME}/bcftools-1.9/bin:$ENV{PATH}";
 
 #
-# The manifest file holds the definitions of the available organisms and primer sets. Use it to
-# validate the primer chosen by the user (and to list the available primer sets).
+# The primer catalog, compiled from the manifest at build time, holds the available primer
+# sets with their references and ready-to-use ivar BED files. Use it to validate the primer
+# chosen by the user (and to list the available primer sets). Without a catalog we fall
+# back to the manifest file and rewrite the primer BED on each run.
 #
 
-my $manifest = decode_json(scalar read_file(manifest));
-my($primer_info) = grep { $_->{name} = "SARS-CoV-2" } @{$manifest->{organisms}};
-my $primers = $primer_info->{primers};
-my @primer_names = sort keys %$primers;
+my $catalog = primer_catalog();
+my($primers, @primer_names);
+if ($catalog)
+{
+    @primer_names = sort keys %$catalog;
+}
+else
+{
+    my $manifest = decode_json(scalar read_file(manifest));
+    my($primer_info) = grep { $_->{name} = "SARS-CoV-2" } @{$manifest->{organisms}};
+    $primers = $primer_info->{primers};
+    @primer_names = sort keys %$primers;
+}
 
 my($opt, $usage) = describe_options("%c %o output-base output-dir",
 				    ['pe-read-1|1=s@' => "Paired-end mate 1 file", { default => [] }],
@@ -65,6 +77,13 @@ my($opt, $usage) = describe_options("%c %o output-base output-dir",
 				    ["keep-intermediates|k" => "Save all intermediate files"],
 				    ["delete-reads" => "Delete reads when they have been processed"],
 				    ["samtools-sort-timeout=i" => "Timeout for samtools sort", { default => 960 }],
+				    ["stream-mapping" => "Stream minimap2 output directly into the filter and sort instead of writing the SAM file to disk"],
+				    ["stream-pileup" => "Stream a single mpileup run to gzip, ivar variants and ivar consensus instead of writing the pileup to disk"],
+				    ["sra=s" => "Stream the reads from this .sra file with fasterq-dump --stdout into minimap2 instead of reading fastq files"],
+				    ["sra-temp-dir=s" => "Temporary directory for fasterq-dump when using --sra"],
+				    ["reference-cache=s" => "Directory of prepared references and minimap2 indexes shared between runs", { default => $ENV{SARS2_REFERENCE_CACHE} }],
+				    ["python-stats" => "Compute depth statistics and coverage plots in a single sars2-coverage-stats run instead of PDL and gnuplot"],
+				    ["anchored-align" => "Align the consensus to the reference with sars2-align-consensus instead of mafft"],
 				    ["help|h"      => "Show this help message"],
 				    );
 
@@ -74,7 +93,8 @@ die($usage->text) unless @ARGV == 2;
 
 $opt->primers or die "Primers must be defined using the --primers flag. Available primers are @primer_names\n";
 
-my($reference, $bed_file);
+my($reference, $bed_file, $ivar_bed);
+my $scheme_version = "custom";
 if ($opt->bed_file || $opt->reference)
 {
     if (!$opt->bed_file || !$opt->reference)
@@ -89,6 +109,23 @@ if ($opt->bed_file || $opt->reference)
     $reference = $opt->reference;
     $bed_file = $opt->bed_file;
 }
+elsif ($catalog)
+{
+    my $primer = $catalog->{$opt->primers};
+    $primer or die "Chosen primers " . $opt->primers . " not available\n";
+
+    my $vers = $opt->primer_version // $primer->{latest};
+    my $scheme = $primer->{schemes}->{$vers};
+    if (!$scheme)
+    {
+	die "Version $vers not available for primers " . $opt->primers . ". Available versions: @{$primer->{versions}}\n";
+    }
+
+    $scheme_version = "$primer->{path}/$vers";
+    $reference = $scheme->{reference};
+    $bed_file = $scheme->{source_bed};
+    $ivar_bed = $scheme->{bed};
+}
 else
 {
     #
@@ -113,6 +150,7 @@ else
 	$scheme = $schemes->[-1];
     }
     
+    $scheme_version = "$primer->{path}/$scheme->{version}";
     my $path = artic_primer_schemes_path . "/$primer->{path}/$scheme->{version}";
     $reference = "$path/$scheme->{reference}";
     $bed_file = "$path/$scheme->{primers}";
@@ -121,23 +159,32 @@ else
 
 -f $reference or die "Cannot read reference $reference\n";
 
-print STDERR "Processing bed file $bed_file\n";
-if (! -f $bed_file)
+my $bed_tmp;
+if ($ivar_bed && -f $ivar_bed)
 {
-    die "Bed file $bed_file is missing\n";
+    print STDERR "Using compiled bed file $ivar_bed for $bed_file\n";
+    $bed_tmp = $ivar_bed;
 }
-my $bed_tmp = File::Temp->new;
-open(I, "<", $bed_file) or die "cannot read $bed_file: $!\n";
-while (<I>)
+else
 {
-    chomp;
-    my @x = split m/\t/;
-    my $l = join("\t", @x[0..3], 60, $x[3]=~m/LEFT|(F$)/ ? "+" : "-") . "\n";
-    print $bed_tmp $l;
-    print STDERR $l;
+    print STDERR "Processing bed file $bed_file\n";
+    if (! -f $bed_file)
+    {
+	die "Bed file $bed_file is missing\n";
+    }
+    $bed_tmp = File::Temp->new;
+    open(I, "<", $bed_file) or die "cannot read $bed_file: $!\n";
+    while (<I>)
+    {
+	chomp;
+	my @x = split m/\t/;
+	my $l = join("\t", @x[0..3], 60, $x[3]=~m/LEFT|(F$)/ ? "+" : "-") . "\n";
+	print $bed_tmp $l;
+	print STDERR $l;
+    }
+    close(I);
+    close($bed_tmp);
 }
-close(I);
-close($bed_tmp);
 
 my @stats;
 
@@ -175,6 +222,11 @@ for my $i (0 .. $n1 - 1)
     push(@inputs, $opt->pe_read_1->[$i], $opt->pe_read_2->[$i]);
 }
 
+if ($opt->sra && @inputs)
+{
+    die "Read files may not be given with --sra\n";
+}
+
 #
 # Set output directories
 #
@@ -215,20 +267,51 @@ $output_name =~ s/\s+/_/g;
 # Determine mapping mode (short or long) based on average read size of the start of the input
 #
 
-open(F, "-|", "gunzip", "-c", "-q",  "-d", "-f", $inputs[0]) or die "Cannot open $inputs[0]: $!";
+my @probe;
 
-my($count, $total);
-while (<F>)
+#
+# With --sra the reads come from fasterq-dump on a pipe; mates of a pair are
+# adjacent with the same name, which minimap2 takes as a pair. We read the
+# first 400 lines off the pipe for the probe and hand them on to minimap2
+# ahead of the rest of the stream.
+#
+my($sra_h, $sra_fh, @fasterq);
+my $sra_head = '';
+if ($opt->sra)
 {
-    last if $. > 400;
-    if ($. % 4 == 2)
+    @fasterq = ("fasterq-dump", "--stdout", "--split-spot", "--skip-technical");
+    push(@fasterq, "-t", $opt->sra_temp_dir) if $opt->sra_temp_dir;
+    push(@fasterq, $opt->sra);
+
+    ($sra_h, $sra_fh) = $runner->start_producer(\@fasterq);
+    while (($sra_head =~ tr/\n//) < 400)
     {
+	my $n = sysread($sra_fh, $sra_head, 1024 * 1024, length($sra_head));
+	defined($n) or die "Error reading from fasterq-dump: $!";
+	last if $n == 0;
+    }
+    @probe = split(/\n/, $sra_head, 401);
+    splice(@probe, 400) if @probe > 400;
+}
+else
+{
+    open(F, "-|", "gunzip", "-c", "-q",  "-d", "-f", $inputs[0]) or die "Cannot open $inputs[0]: $!";
+    while (<F>)
+    {
+	last if $. > 400;
 	chomp;
-	$count++;
-	$total += length($_);
+	push(@probe, $_);
     }
+    close(F);
 }
-close(F);
+
+my($count, $total);
+for (my $i = 1; $i < @probe; $i += 4)
+{
+    $count++;
+    $total += length($probe[$i]);
+}
+$count or die "No reads found in input\n";
 my $avg = $total / $count;
 
 my $mapping_mode = "sr";
@@ -244,48 +327,110 @@ my @minimap_opts = (-K => "20M", 	# Minibatch size
 		    -t => $opt->threads);
 
 # Trim polyA tail for alignment (33 bases)
+my $trim_length = 33;
 my $trimmed = "$int_dir/reference_trimmed.fa";
 
 #
 # Clean up the ID line too to eliminate warnings later.
 #
-my $ok = $runner->run(["perl", "-pe", 's/^(>\S+).*$/\1/', $reference],
-		      '|',
-		      ["seqtk", "trimfq", "-e", 33, '-'], '>',  $trimmed);
+my $make_trimmed = sub {
+    my($out) = @_;
+    my $ok = $runner->run(["perl", "-pe", 's/^(>\S+).*$/\1/', $reference],
+			  '|',
+			  ["seqtk", "trimfq", "-e", $trim_length, '-'], '>',  $out);
 
-$ok or die "Failure $? running seqtk\n";
+    $ok or die "Failure $? running seqtk\n";
+};
+
+#
+# minimap2 maps against $ref_index: the trimmed FASTA, or with a reference
+# cache, a prebuilt index for the mapping mode.
+#
+my $ref_index = $trimmed;
+if ($opt->reference_cache)
+{
+    my $cache = Bio::P3::ReferenceCache->new($opt->reference_cache);
+    my $entry = $cache->get($reference, ["onecodex", "scheme=$scheme_version", "trim=$trim_length"], sub {
+	my($dir) = @_;
+	$make_trimmed->("$dir/reference_trimmed.fa");
+	for my $mode (qw(sr map-ont))
+	{
+	    $runner->run(["minimap2", "-x", $mode, "-d", "$dir/reference_trimmed.$mode.mmi", "$dir/reference_trimmed.fa"]);
+	}
+    });
+    $trimmed = "$entry/reference_trimmed.fa";
+    $ref_index = "$entry/reference_trimmed.$mapping_mode.mmi";
+}
+else
+{
+    $make_trimmed->($trimmed);
+}
 
 #
 # Run the mapper
 # 
 
-$runner->run(["minimap2",
-	  @minimap_opts,
-	  $trimmed,
-	  @inputs,
-	  "-o", "$int_dir/minimap.out"]);
-
-if ($opt->delete_reads)
+my @sam_filter = ("samtools",
+		  "view",
+		  "-u",
+		  "-h",
+		  "-q", $opt->min_quality,
+		  "-F", 4);
+my @bam_sort = ("samtools",
+		"sort",
+		"--threads", $opt->threads,
+		"-o", "$int_dir/$base.sorted.bam",
+		"-");
+
+if ($opt->sra)
+{
+    #
+    # Neither the fastq nor the SAM output touches disk.
+    #
+    $runner->pump_fanout("fasterq-dump", undef, $sra_h, $sra_fh, $sra_head, \@fasterq,
+			 [["minimap2",
+			   @minimap_opts,
+			   $ref_index,
+			   "-"],
+			  '|', [@sam_filter, "-"], '|', \@bam_sort]);
+}
+elsif ($opt->stream_mapping)
 {
-    print STDERR "Deleting inputs @inputs\n";
-    unlink(@inputs);
+    #
+    # The SAM output never touches disk; the runner records how much
+    # data went through the stream in its report. The sort gets the
+    # same timeout as when it reads the SAM file below.
+    #
+    $runner->run_streamed("minimap2-sam", 960,
+			  ["minimap2",
+			   @minimap_opts,
+			   $ref_index,
+			   @inputs],
+			  [@sam_filter, "-"], '|', \@bam_sort);
+
+    if ($opt->delete_reads)
+    {
+	print STDERR "Deleting inputs @inputs\n";
+	unlink(@inputs);
+    }
 }
+else
+{
+    $runner->run(["minimap2",
+		  @minimap_opts,
+		  $ref_index,
+		  @inputs,
+		  "-o", "$int_dir/minimap.out"]);
 
-$runner->run_with_timeout(960, ["samtools",
-			    "view",
-			    "-u",
-			    "-h",
-			    "-q", $opt->min_quality,
-			    "-F", 4,
-			    "$int_dir/minimap.out"],
-		      '|',
-		      ["samtools",
-		       "sort",
-		       "--threads", $opt->threads,
-		       "-o", "$int_dir/$base.sorted.bam",
-		       "-"]
-		     );
-unlink("$int_dir/minimap.out");
+    if ($opt->delete_reads)
+    {
+	print STDERR "Deleting inputs @inputs\n";
+	unlink(@inputs);
+    }
+
+    $runner->run_with_timeout(960, [@sam_filter, "$int_dir/minimap.out"], '|', \@bam_sort);
+    unlink("$int_dir/minimap.out");
+}
 $runner->run(["samtools", "index", "$int_dir/$base.sorted.bam"]);
 
 my $ivar_file = "$int_dir/$base.ivar";
@@ -361,38 +506,51 @@ $runner->run_with_timeout($opt->samtools_sort_timeout, ["samtools",
 
 $runner->run(["samtools", "index", "$int_dir/$base.isorted.bam"]);
 
-$runner->run(["samtools",
-	  "mpileup",
-	  "--fasta-ref", $reference,
-	  "--max-depth", $opt->max_depth,
-	  "--count-orphans",
-	  "--no-BAQ",
-	  "--min-BQ", 0,
-	  "$int_dir/${base}.isorted.bam"],
-	 '>',
-	 "$int_dir/$base.pileup");
-
-my $pileup_compress_handle = start(["gzip", "-c", "$int_dir/$base.pileup"],
-				   '>',
-				   "$out_dir/$base.pileup.gz");
+my @mpileup = ("samtools",
+	       "mpileup",
+	       "--fasta-ref", $reference,
+	       "--max-depth", $opt->max_depth,
+	       "--count-orphans",
+	       "--no-BAQ",
+	       "--min-BQ", 0,
+	       "$int_dir/${base}.isorted.bam");
+my @ivar_variants = ("ivar",
+		     "variants",
+		     "-p", $ivar_file,
+		     "-r", $reference,
+		     "-g", reference_gff_path,
+		     "-t", 0.6);
+my @ivar_consensus = ("ivar",
+		      "consensus",
+		      "-p", $ivar_file,
+		      "-m", $opt->min_depth,
+		      "-t", 0.6,
+		      "-n", "N");
+
+my $pileup_compress_handle;
+if ($opt->stream_pileup)
+{
+    #
+    # One mpileup pass feeds all three consumers; the uncompressed
+    # pileup is never written.
+    #
+    $runner->run_fanout("mpileup", undef,
+			\@mpileup,
+			[["gzip", "-c"], '>', "$out_dir/$base.pileup.gz"],
+			[\@ivar_variants],
+			[\@ivar_consensus]);
+}
+else
+{
+    $runner->run(\@mpileup, '>', "$int_dir/$base.pileup");
 
-$runner->run(["ivar",
-	  "variants",
-	  "-p", $ivar_file,
-	  "-r", $reference,
-	  "-g", reference_gff_path,
-	  "-t", 0.6],
-	 "<",
-	 "$int_dir/$base.pileup");
+    $pileup_compress_handle = start(["gzip", "-c", "$int_dir/$base.pileup"],
+				    '>',
+				    "$out_dir/$base.pileup.gz");
 
-$runner->run(["ivar",
-	  "consensus",
-	  "-p", $ivar_file,
-	  "-m", $opt->min_depth,
-	  "-t", 0.6,
-	  "-n", "N"],
-	 "<",
-	 "$int_dir/$base.pileup");
+    $runner->run(\@ivar_variants, "<", "$int_dir/$base.pileup");
+    $runner->run(\@ivar_consensus, "<", "$int_dir/$base.pileup");
+}
 
 $runner->run(["sed",
 	  '/>/ s/$/ | One Codex consensus sequence/'],
@@ -403,13 +561,66 @@ $runner->run(["sed",
 	 ">",
 	 "$out_dir/$base.fasta");
 
-$runner->run(["cat", $reference, "$out_dir/$base.fasta"],
-	 '|',
-	 ["mafft", "--auto", "-"],
-	 '>',
-	 "$out_dir/$base.align");
+if ($opt->anchored_align)
+{
+    #
+    # The consensus was assembled against the reference, so a k-mer
+    # anchored pairwise alignment gives what mafft does without starting
+    # mafft and choosing a strategy for every sample.
+    #
+    $runner->run(["sars2-align-consensus",
+		  "--reference", $reference,
+		  "$out_dir/$base.fasta", "$out_dir/$base.align"]);
+}
+else
+{
+    $runner->run(["cat", $reference, "$out_dir/$base.fasta"],
+		 '|',
+		 ["mafft", "--auto", "-"],
+		 '>',
+		 "$out_dir/$base.align");
+}
 
 
+#
+# sars2-coverage-stats needs matplotlib for the plots. Without it we fall
+# through to gnuplot and PDL rather than leave the run without plots.
+#
+my $python_stats = $opt->python_stats;
+if ($python_stats && system("sars2-coverage-stats", "--check-plots") != 0)
+{
+    warn "sars2-coverage-stats cannot draw coverage plots (no matplotlib); using gnuplot and PDL\n";
+    $python_stats = 0;
+}
+
+if ($python_stats)
+{
+    #
+    # Depth statistics, N statistics and all three coverage plots from a
+    # single read of the samtools depth output, in place of the gnuplot
+    # and PDL steps below.
+    #
+    system("mv", "$int_dir/$base.isorted.bam", "$out_dir/$base.sorted.bam");
+    system("mv", "$int_dir/$base.isorted.bam.bai", "$out_dir/$base.sorted.bam.bai");
+    system("mv", "$ivar_file.tsv", "$out_dir/$base.variants.tsv");
+
+    eval {
+	$runner->run(["sars2-coverage-stats",
+		      "--bam", "$out_dir/$base.sorted.bam",
+		      "--depth-output", "$out_dir/$base.depth",
+		      "--fasta", "$out_dir/$base.fasta",
+		      "--variants", "$out_dir/$base.variants.tsv",
+		      (map { ("--stat", @$_) } @stats),
+		      $base, $out_dir]);
+    };
+    if ($@)
+    {
+	warn "Error processing statistics: $@";
+    }
+    finish_run();
+    exit(0);
+}
+
 #
 # Create coverage plot
 #
@@ -518,7 +729,19 @@ if ($@)
 }
     
 
-print STDERR "Waiting for pileup gzip to finish\n";
-$pileup_compress_handle->finish();
+finish_run();
+
+#
+# Wait for the pileup compression, if it ran in the background, and
+# write the run report.
+#
+sub finish_run
+{
+    if ($pileup_compress_handle)
+    {
+	print STDERR "Waiting for pileup gzip to finish\n";
+	$pileup_compress_handle->finish();
+    }
 
-print STDERR  JSON::XS->new->pretty(1)->canonical(1)->encode($runner->report);
+    print STDERR  JSON::XS->new->pretty(1)->canonical(1)->encode($runner->report);
+}
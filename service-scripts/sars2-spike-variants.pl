@@ -0,0 +1,67 @@
+=head1 NAME
+
+    sars2-spike-variants - call spike protein variants without BLAST
+
+=head1 SYNOPSIS
+
+    sars2-spike-variants [-r] [-q spike.aa] contigs.fa [contigs.fa ...]
+
+=head1 DESCRIPTION
+
+Writes the same table as sars2-get-blast-variants -b tblastn: for each
+contig with an alignment to the reference spike protein, the contig ID,
+the frames of the alignments (with -r), the insertions and the variants,
+tab separated.
+
+The alignment is done in-process by L<Bio::P3::SpikeVariants>, so there
+is no BLAST database to build; any number of genomes may be given, in
+one or more FASTA files, and the reference is loaded once for all of them.
+
+Exits with status 2 if no contig has an alignment.
+
+=cut
+
+use strict;
+use Getopt::Long::Descriptive;
+use gjoseqlib;
+use Bio::P3::SpikeVariants;
+use Bio::P3::SARS2Assembly qw(reference_spike_aa_path);
+
+my($opt, $usage) = describe_options("%c %o [contigs.fa ...]",
+				    ["q=s" => "Spike protein reference", { default => reference_spike_aa_path }],
+				    ["s=s@" => "Contig FASTA file (may be repeated)", { default => [] }],
+				    ["l=i" => "Minimum alignment length", { default => 50 }],
+				    ["p=f" => "Minimum alignment fraction identity", { default => 0.85 }],
+				    ["g=s" => "Character for reference positions with no alignment", { default => "X" }],
+				    ["f" => "Strip contig IDs at the first whitespace"],
+				    ["r" => "Show frames"],
+				    ["help|h" => "Show this help message"],
+				   );
+print($usage->text), exit 0 if $opt->help;
+
+my @files = (@{$opt->s}, @ARGV);
+die($usage->text) if @files == 0;
+
+my $caller = Bio::P3::SpikeVariants->new(reference => $opt->q,
+					 min_len => $opt->l,
+					 min_pid => $opt->p,
+					 gap_char => $opt->g);
+
+my $hits = 0;
+for my $file (@files)
+{
+    open(my $fh, "<", $file) or die "Cannot open $file: $!";
+    while (my($id, $def, $seq) = read_next_fasta_seq($fh))
+    {
+	my $call = $caller->call($opt->f || !$def ? $id : "$id $def", $seq) or next;
+	print $caller->format_call($call, $opt->r);
+	$hits++;
+    }
+    close($fh);
+}
+
+if ($hits == 0)
+{
+    print STDERR "No hits found\n";
+    exit(2);
+}
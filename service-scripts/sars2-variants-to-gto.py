@@ -0,0 +1,10 @@
+#
+# Add ivar variants.tsv files to GTOs as computed variants, many samples
+# at a time.
+#
+
+import sys
+import gto_variants
+
+if __name__ == "__main__":
+    sys.exit(gto_variants.main())
@@ -0,0 +1,32 @@
+import random
+
+import consensus_align
+from consensus_align import Reference, global_align
+
+def check_pairs(pairs, i0, i1, j0, j1):
+    assert [i for i, j in pairs if i is not None] == list(range(i0, i1))
+    assert [j for i, j in pairs if j is not None] == list(range(j0, j1))
+
+def test_global_align_unequal_gaps():
+    pairs = global_align("ACGTACGT", "ACGACGT", 0, 8, 0, 7)
+    check_pairs(pairs, 0, 8, 0, 7)
+    assert sum(1 for i, j in pairs if j is None) == 1
+
+    pairs = global_align("ACGACGT", "ACGTACGT", 0, 7, 0, 8)
+    check_pairs(pairs, 0, 7, 0, 8)
+    assert sum(1 for i, j in pairs if i is None) == 1
+
+def test_global_align_cell_cap():
+    n = consensus_align.MAX_CELLS
+    pairs = global_align("A" * n, "A" * (n - 10), 0, n, 0, n - 10)
+    check_pairs(pairs, 0, n, 0, n - 10)
+
+def test_align_deletion_next_to_snp():
+    rng = random.Random(1)
+    ref = "".join(rng.choice("ACGT") for x in range(600))
+    snp = "G" if ref[300] != "G" else "C"
+    query = ref[:300] + snp + ref[304:]
+
+    ins, cols = Reference("ref", ref).align(query)
+    assert "".join(ins[i] + cols[i] for i in range(len(cols))).replace("-", "") + ins[-1] == query
+    assert cols.count("-") == 3
@@ -0,0 +1,58 @@
+import os
+
+from hpc import status_index
+
+def make_tree(base, prefix, n):
+    ids = [f"{prefix}{i:03d}" for i in range(n)]
+    for sra in ids:
+        path = status_index.create_sample_dir(str(base), sra)
+        with open(os.path.join(path, f"{sra}.gto"), "w") as fh:
+            fh.write("{}")
+        status_index.record_outputs(str(base), sra, ["gto"])
+    return ids
+
+def count_stats(monkeypatch):
+    calls = []
+    real_stat = os.stat
+    def stat(*args, **kwargs):
+        calls.append(args[0])
+        return real_stat(*args, **kwargs)
+    monkeypatch.setattr(os, "stat", stat)
+    return calls
+
+def test_manifest_read_is_constant_per_prefix(tmp_path, monkeypatch):
+    ids = make_tree(tmp_path, "SRR1000", 100) + make_tree(tmp_path, "SRR2000", 100)
+
+    calls = count_stats(monkeypatch)
+    done = status_index.completed(str(tmp_path), {"SRR1000", "SRR2000"}, "gto", workers=1)
+    assert done == set(ids)
+    assert len(calls) <= 2 * 2
+
+def test_created_sample_dir_keeps_manifest_fresh(tmp_path, monkeypatch):
+    ids = make_tree(tmp_path, "SRR1000", 10)
+    status_index.create_sample_dir(str(tmp_path), "SRR1000999")
+
+    calls = count_stats(monkeypatch)
+    assert status_index.completed(str(tmp_path), {"SRR1000"}, "gto", workers=1) == set(ids)
+    assert len(calls) <= 2
+
+def test_unrecorded_sample_dir_forces_scan(tmp_path):
+    ids = make_tree(tmp_path, "SRR1000", 3)
+    pdir = tmp_path / "SRR1000"
+    (pdir / "SRR1000999").mkdir()
+    (pdir / "SRR1000999" / "SRR1000999.gto").write_text("{}")
+    manifest_mtime = os.stat(pdir / status_index.MANIFEST).st_mtime
+    os.utime(pdir, (manifest_mtime + 10, manifest_mtime + 10))
+
+    done = status_index.completed(str(tmp_path), {"SRR1000"}, "gto", workers=1)
+    assert done == set(ids) | {"SRR1000999"}
+
+def test_verify_checks_only_requested_ids(tmp_path, monkeypatch):
+    ids = make_tree(tmp_path, "SRR1000", 20)
+    os.unlink(tmp_path / "SRR1000" / ids[0] / f"{ids[0]}.gto")
+
+    calls = count_stats(monkeypatch)
+    done = status_index.completed(str(tmp_path), {"SRR1000"}, "gto", workers=1,
+                                  ids={ids[0], ids[1]}, verify=True)
+    assert done == {ids[1]}
+    assert len(calls) <= 2 + 2
@@ -0,0 +1,20 @@
+import pickle
+
+import pytest
+
+from hpc import work_item
+from sra_sample import SraSample
+
+def test_round_trip():
+    sra = SraSample("SRR1234567", 3, "/feeder")
+    sra.size_hint = 1000
+    sra.cost = 2.5
+
+    item = work_item.decode(work_item.encode(sra), "/out")
+    assert (item.id, item.idx, item.size_hint, item.cost) == ("SRR1234567", 3, 1000, 2.5)
+    assert str(item.path) == "/out/SRR1234/SRR1234567"
+
+def test_rejects_pickled_and_unknown_versions():
+    for data in (pickle.dumps(SraSample("SRR1234567", 1, "/out")), b"2\tSRR1234567\t1"):
+        with pytest.raises(ValueError, match="not a version 1 record"):
+            work_item.decode(data, "/out")
@@ -0,0 +1,74 @@
+import pickle
+import time
+from types import SimpleNamespace
+
+from hpc import work_queue
+from hpc.local_redis import LocalRedis
+
+def samples(*ids):
+    return [SimpleNamespace(id=i) for i in ids]
+
+def test_ack_removes_from_processing_list():
+    conn = LocalRedis()
+    work_queue.seed(conn, samples("SRR1", "SRR2"))
+    q = work_queue.ReliableQueue(conn, worker_id="a")
+
+    item = q.pop()
+    assert item.id == "SRR1"
+    assert conn.llen(q.processing) == 1
+    q.ack(item)
+    assert conn.llen(q.processing) == 0
+    assert conn.llen("sra") == 1
+
+def test_expired_lease_is_requeued():
+    conn = LocalRedis()
+    work_queue.seed(conn, samples("SRR1", "SRR2", "SRR3"))
+
+    dead = work_queue.ReliableQueue(conn, worker_id="dead", lease_time=0.05)
+    taken = dead.pop_many(2)
+    assert [i.id for i in taken] == ["SRR1", "SRR2"]
+
+    live = work_queue.ReliableQueue(conn, worker_id="live", lease_time=60)
+    assert live.reap() == 0
+    time.sleep(0.1)
+    assert live.reap() == 2
+    assert conn.llen(dead.processing) == 0
+
+    #
+    # Requeued samples go to the dequeue end, ahead of the rest.
+    #
+    assert sorted(i.id for i in live.pop_many(2)) == ["SRR1", "SRR2"]
+    assert live.pop().id == "SRR3"
+
+def test_orphaned_processing_list_is_reaped_at_startup():
+    conn = LocalRedis()
+    work_queue.seed(conn, samples("SRR1"))
+    conn.rpush("sra:processing:earlier.123", pickle.dumps(SimpleNamespace(id="SRR9")))
+
+    q = work_queue.ReliableQueue(conn, worker_id="a", lease_time=60)
+    q.start_heartbeat(interval=60)
+    try:
+        assert conn.llen("sra:processing:earlier.123") == 0
+        assert q.pop().id == "SRR9"
+    finally:
+        q.close()
+
+def test_close_requeues_held_samples():
+    conn = LocalRedis()
+    work_queue.seed(conn, samples("SRR1", "SRR2"))
+    q = work_queue.ReliableQueue(conn, worker_id="a")
+    q.pop()
+    q.close()
+    assert conn.llen("sra") == 2
+    assert conn.zscore("sra:leases", "a") is None
+
+def test_ack_of_repeated_id_removes_each_payload():
+    conn = LocalRedis()
+    work_queue.seed(conn, [SimpleNamespace(id="SRR1", idx=1), SimpleNamespace(id="SRR1", idx=2)])
+    q = work_queue.ReliableQueue(conn, worker_id="a")
+
+    first, second = q.pop_many(2)
+    assert conn.llen(q.processing) == 2
+    q.ack(first)
+    q.ack(second)
+    assert conn.llen(q.processing) == 0